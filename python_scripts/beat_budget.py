@@ -0,0 +1,193 @@
+import time
+from collections import deque
+from typing import Deque, Dict, Tuple
+
+# Deadline-aware load shedding for the beat callback.
+#
+# Every beat gets a deadline, a few milliseconds after it starts. The sustained harmony (the
+# chord change and its notes) always runs, but the stages after it are optional, and each
+# has a priority. A stage only runs if there's still time for it (going by how long it
+# usually takes) and for every higher-priority stage still to come in the beat. Otherwise
+# it's shed: melodies and SFX re-fire checks are musical, so late is no better than never and
+# they're dropped (the next beat picks them up again), while the stale-scene cleanup and the
+# history append are deferred to the frame tick, which works through them a little each frame.
+# The melody and SFX stages draw from their own generators, reseeded every beat whether they
+# run or not, so shedding one never changes what the rest of the show draws.
+#
+# What's shed is counted in the driver's metrics (driver_deferred_stages_total and
+# driver_dropped_stages_total), next to the beat latency histogram.
+
+# region Constants
+
+BEAT_BUDGET_SECONDS = 0.008 # Half a frame at 60 FPS, as TouchDesigner needs the rest of it
+FRAME_BUDGET_SECONDS = 0.002 # For the deferred stages, each frame
+MAX_DEFERRED = 64 # Deferred stages past this drop the oldest, if the frames can't keep up
+COST_SMOOTHING = 0.2 # How quickly a stage's expected cost follows how long it's been taking
+
+# endregion
+
+class Stage:
+	# Props
+	name: str
+	priority: int # Lower goes first when there isn't time for everything
+	deferrable: bool # Whether it can run on a later frame, else it's dropped when shed
+	expected_seconds: float # Smoothed from how long it's taken
+
+	# Methods
+	def __init__(self, name: str, priority: int, deferrable: bool):
+		self.name = name
+		self.priority = priority
+		self.deferrable = deferrable
+		self.expected_seconds = 0.0
+
+# The beat's optional stages (the harmony isn't one, it always runs)
+STAGES = (
+	Stage('melody', priority=1, deferrable=False),
+	Stage('sfx', priority=2, deferrable=False),
+	Stage('cleanup', priority=3, deferrable=True),
+	Stage('history', priority=4, deferrable=True),
+)
+
+class BeatBudget:
+	# Props
+	budget_seconds: float
+	frame_budget_seconds: float
+	stages: Dict[str, Stage]
+	deadline: float # perf_counter time the current beat has to be done by
+	stages_run: set # The stages that have had their turn this beat
+	stages_shed: int # How many of them were shed
+	decisions: list # (stage name, whether it ran now) for every turn a stage had this beat, in order
+	stage_start: float # When the stage should_run() last let through started
+	deferred: Deque[Tuple[Stage, object, tuple]] # (stage, function, args) still to run, oldest first
+	metrics: object # The DriverMetrics the shed stages are counted in
+
+	# Methods
+	def __init__(self, metrics, budget_seconds: float = BEAT_BUDGET_SECONDS, frame_budget_seconds: float = FRAME_BUDGET_SECONDS):
+		self.budget_seconds = budget_seconds
+		self.frame_budget_seconds = frame_budget_seconds
+		self.stages = {stage.name: Stage(stage.name, stage.priority, stage.deferrable) for stage in STAGES}
+		self.deadline = float('inf')
+		self.stages_run = set()
+		self.stages_shed = 0
+		self.decisions = []
+		self.stage_start = 0.0
+		self.deferred = deque()
+		self.metrics = metrics
+
+	def start(self, beat_start):
+		"""Starts a beat's budget.
+
+		Args:
+			beat_start (float): When the beat started, in perf_counter seconds.
+		"""
+		self.deadline = beat_start + self.budget_seconds
+		self.stages_run.clear()
+		self.stages_shed = 0
+		self.decisions = []
+
+	def has_time_for(self, stage):
+		"""Checks if there's time left in the beat for a stage, and for the higher-priority stages still to come."""
+		needed_seconds = stage.expected_seconds
+		for other_stage in self.stages.values():
+			if other_stage.priority < stage.priority and other_stage.name not in self.stages_run:
+				needed_seconds += other_stage.expected_seconds
+		return time.perf_counter() + needed_seconds <= self.deadline
+
+	def should_run(self, stage_name):
+		"""Checks if a stage that can't be deferred should run, counting it as dropped if not. Call finished() after running it.
+
+		Args:
+			stage_name (str): The name of the stage, from STAGES.
+
+		Returns:
+			bool: Whether to run it.
+		"""
+		stage = self.stages[stage_name]
+		self.stages_run.add(stage_name)
+		if not self.has_time_for(stage):
+			self.shed(stage)
+			self.decisions.append((stage_name, False))
+			self.metrics.dropped_stages.inc(stage_name)
+			return False
+		self.decisions.append((stage_name, True))
+		self.stage_start = time.perf_counter()
+		return True
+
+	def finished(self, stage_name):
+		"""Records how long a stage took, after should_run() let it run."""
+		self.record(self.stages[stage_name], time.perf_counter() - self.stage_start)
+
+	def run(self, stage_name, function, *args):
+		"""Runs a stage if there's time, else defers or drops it.
+
+		A stage that already has work deferred is deferred again, so its work still happens in order.
+
+		Args:
+			stage_name (str): The name of the stage, from STAGES.
+			function (function): The stage's work.
+			*args: Args for the function.
+
+		Returns:
+			bool: Whether it ran now.
+		"""
+		stage = self.stages[stage_name]
+		self.stages_run.add(stage_name)
+		if self.has_time_for(stage) and not (stage.deferrable and self.is_deferred(stage)):
+			self.decisions.append((stage_name, True))
+			stage_start = time.perf_counter()
+			function(*args)
+			self.record(stage, time.perf_counter() - stage_start)
+			return True
+
+		self.shed(stage)
+		self.decisions.append((stage_name, False))
+		if stage.deferrable:
+			if len(self.deferred) >= MAX_DEFERRED:
+				self.metrics.dropped_stages.inc(self.deferred.popleft()[0].name)
+			self.deferred.append((stage, function, args))
+			self.metrics.deferred_stages.inc(stage_name)
+		else:
+			self.metrics.dropped_stages.inc(stage_name)
+		return False
+
+	def run_deferred(self, frame_start):
+		"""Works through the deferred stages, oldest first, as far as the frame's budget goes. Meant to be called every frame.
+
+		Args:
+			frame_start (float): When the frame started, in perf_counter seconds.
+
+		Returns:
+			int: How many stages ran.
+		"""
+		deadline = frame_start + self.frame_budget_seconds
+		ran = 0
+		while self.deferred:
+			stage, function, args = self.deferred[0]
+			if ran and time.perf_counter() + stage.expected_seconds > deadline:
+				break # Always at least one a frame, so a stage that's grown too slow for the budget can't hold up the rest forever
+			self.deferred.popleft()
+			stage_start = time.perf_counter()
+			function(*args)
+			self.record(stage, time.perf_counter() - stage_start)
+			ran += 1
+		return ran
+
+	def clear_deferred(self):
+		"""Drops every deferred stage without running it (like when the music's reset), counting them as dropped."""
+		while self.deferred:
+			self.metrics.dropped_stages.inc(self.deferred.popleft()[0].name)
+
+	def is_deferred(self, stage):
+		for deferred_stage, _, _ in self.deferred:
+			if deferred_stage is stage:
+				return True
+		return False
+
+	def record(self, stage, seconds):
+		stage.expected_seconds += (seconds - stage.expected_seconds) * COST_SMOOTHING
+
+	def shed(self, stage):
+		self.stages_shed += 1
+
+		# Lower the stage's expected cost a little, so one slow run (like a segment write) can't keep it shed forever
+		stage.expected_seconds *= 1 - COST_SMOOTHING
@@ -0,0 +1,356 @@
+import asyncio
+import os
+import time
+from typing import Dict, List, Tuple
+
+from event_scheduler import BEATS_PER_PULSE
+from simulated_td import DEFAULT_PULSE_SECONDS, SimulatedShow
+from theory import load_theory
+
+# The generator as a stream of structured beats.
+#
+# BeatEngine runs the driver scripts on the headless OP layer from simulated_td, and turns
+# what they send to the instruments into structured events: harmony changes, note ons and
+# offs, melody clips (with their notes), percussion hits and sfx fires. engine.beats()
+# yields one Beat per Beat CHOP pulse, with every event of the pulse in time order, and
+# only works out the next beat when it's asked for, so nothing piles up ahead of the
+# consumer. engine.abeats() is the same as an async iterator, optionally paced in real time.
+#
+# The out-of-process engine (music_engine), the MIDI file writer (write_midi_file) and the
+# preview renderer (render_preview) all consume this stream.
+#
+# NOTE: The stream wraps the driver, rather than the driver being built on the stream. The
+# generator is still the driver script, which the project runs straight off the Beat CHOP,
+# and the events are read back from the messages it sends. So in TouchDesigner neither the
+# beat callback nor the OSC exporter (which reads the state snapshots) goes through this;
+# only the engine and the offline tools do.
+
+# region Constants
+
+REFERENCE_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'reference_data')
+
+TICKS_PER_BEAT = 16 # How finely events are timed (the frame tick runs this many times a beat)
+
+# Song state an engine can be started from, and its defaults (the same as reset_op_storage)
+INITIAL_STATE = {
+	'key': 'C',
+	'scale_mode': 'ionian',
+	'chord': 'I',
+	'chord_variation': 'major triad',
+	'chord_notes': ['0', '4', '7'],
+}
+
+# endregion
+
+# region Events
+
+class HarmonyChange:
+	# Props
+	seconds: float # Show time of the pulse
+	key: str
+	scale_mode: str
+	chord: str
+	chord_variation: str
+	chord_notes: List[str]
+	current_scene: str
+	active_melody: str # The melody number, or 'none'
+	song_state: int # All of the above (except the notes) as one word, see song_state
+
+	# Methods
+	def __init__(self, seconds: float, key: str, scale_mode: str, chord: str, chord_variation: str, chord_notes: List[str], current_scene: str, active_melody: str, song_state: int):
+		self.seconds = seconds
+		self.key = key
+		self.scale_mode = scale_mode
+		self.chord = chord
+		self.chord_variation = chord_variation
+		self.chord_notes = chord_notes
+		self.current_scene = current_scene
+		self.active_melody = active_melody
+		self.song_state = song_state
+
+class NoteOn:
+	# Props
+	seconds: float
+	instrument_name: str
+	pitch: int
+	velocity: int
+
+	# Methods
+	def __init__(self, seconds: float, instrument_name: str, pitch: int, velocity: int):
+		self.seconds = seconds
+		self.instrument_name = instrument_name
+		self.pitch = pitch
+		self.velocity = velocity
+
+class NoteOff:
+	# Props
+	seconds: float
+	instrument_name: str
+	pitch: int
+
+	# Methods
+	def __init__(self, seconds: float, instrument_name: str, pitch: int):
+		self.seconds = seconds
+		self.instrument_name = instrument_name
+		self.pitch = pitch
+
+class AllNotesOff:
+	# Props
+	seconds: float
+	instrument_name: str
+
+	# Methods
+	def __init__(self, seconds: float, instrument_name: str):
+		self.seconds = seconds
+		self.instrument_name = instrument_name
+
+class PercussionHit:
+	# Props
+	seconds: float
+	instrument_name: str
+	pitch: int
+	velocity: int
+
+	# Methods
+	def __init__(self, seconds: float, instrument_name: str, pitch: int, velocity: int):
+		self.seconds = seconds
+		self.instrument_name = instrument_name
+		self.pitch = pitch
+		self.velocity = velocity
+
+class MelodyClip:
+	# Props
+	seconds: float # When the clip fires
+	instrument_name: str
+	notes: Tuple[tuple, ...] # The clip's notes, as (pitch, start beat, length in beats, velocity, mute)
+
+	# Methods
+	def __init__(self, seconds: float, instrument_name: str, notes: Tuple[tuple, ...]):
+		self.seconds = seconds
+		self.instrument_name = instrument_name
+		self.notes = notes
+
+class ClipStop:
+	# Props
+	seconds: float
+	instrument_name: str
+
+	# Methods
+	def __init__(self, seconds: float, instrument_name: str):
+		self.seconds = seconds
+		self.instrument_name = instrument_name
+
+class SfxFire:
+	# Props
+	seconds: float
+	instrument_name: str
+
+	# Methods
+	def __init__(self, seconds: float, instrument_name: str):
+		self.seconds = seconds
+		self.instrument_name = instrument_name
+
+class Beat:
+	# Props
+	index: int
+	seconds: float # Show time of the pulse
+	harmony: HarmonyChange
+	events: list # Every event of the pulse, in time order (the harmony change first)
+	playing_notes: Dict[str, Tuple[str, ...]] # What every instrument is holding after the pulse, like in playing_notes
+
+	# Methods
+	def __init__(self, index: int, seconds: float, harmony: HarmonyChange, events: list, playing_notes: Dict[str, Tuple[str, ...]]):
+		self.index = index
+		self.seconds = seconds
+		self.harmony = harmony
+		self.events = events
+		self.playing_notes = playing_notes
+
+# endregion
+
+class BeatEngine:
+	# Props
+	show: SimulatedShow
+	seconds_per_beat: float
+	instrument_roles: Dict[str, str]
+	clip_notes: Dict[str, tuple] # What each melody clip holds, so fires carry their notes
+	pending: list # Events of the beat being worked out
+
+	# Methods
+	def __init__(self, seed: int = None, pulse_seconds: float = DEFAULT_PULSE_SECONDS, initial_state: dict = None, deadlines: bool = False):
+		theory = load_theory(REFERENCE_DATA_DIR)
+		self.instrument_roles = {
+			instrument_name: instrument_props['instrument_role']
+			for scene_instruments in theory.roster.values()
+			for instrument_name, instrument_props in scene_instruments.items()
+		}
+		self.seconds_per_beat = pulse_seconds / BEATS_PER_PULSE
+		self.clip_notes = {}
+		self.pending = []
+		self.show = SimulatedShow(seed=seed, pulse_seconds=pulse_seconds, sink=self.on_message, ticks_per_pulse=BEATS_PER_PULSE * TICKS_PER_BEAT, deadlines=deadlines)
+
+		for storage_key, value in (initial_state or {}).items():
+			if storage_key not in INITIAL_STATE:
+				raise ValueError(f'Can\'t start an engine from "{storage_key}", only from {", ".join(INITIAL_STATE)}')
+			self.show.storage.store(storage_key, value)
+
+	def on_message(self, seconds, instrument_name, message, args):
+		"""Turns a message the driver sent to an instrument into an event."""
+		role = self.instrument_roles.get(instrument_name)
+		if role is None:
+			return
+
+		match message:
+			case 'midi' if args[0] == 'note':
+				pitch, velocity = args[1], args[2]
+				if velocity == 0:
+					self.pending.append(NoteOff(seconds, instrument_name, pitch))
+				elif role == 'percussion':
+					self.pending.append(PercussionHit(seconds, instrument_name, pitch, velocity))
+				else:
+					self.pending.append(NoteOn(seconds, instrument_name, pitch, velocity))
+			case 'midi' if args[0] == 'flush':
+				self.pending.append(AllNotesOff(seconds, instrument_name))
+			case 'set_notes':
+				self.clip_notes[instrument_name] = tuple(args)
+			case 'remove_notes':
+				self.clip_notes[instrument_name] = ()
+			case 'fireclip':
+				if role == 'sfx':
+					self.pending.append(SfxFire(seconds, instrument_name))
+				else:
+					self.pending.append(MelodyClip(seconds, instrument_name, self.clip_notes.get(instrument_name, ())))
+			case 'stopclip':
+				self.pending.append(ClipStop(seconds, instrument_name))
+
+	def next_beat(self, index):
+		"""Works out one beat."""
+		pulse_start = self.show.td.absTime.seconds
+		self.pending = []
+		self.show.beat()
+
+		storage = self.show.storage
+		harmony = HarmonyChange(
+			seconds=pulse_start,
+			key=storage.fetch('key'),
+			scale_mode=storage.fetch('scale_mode'),
+			chord=storage.fetch('chord'),
+			chord_variation=storage.fetch('chord_variation'),
+			chord_notes=list(storage.fetch('chord_notes')),
+			current_scene=storage.fetch('current_scene'),
+			active_melody=storage.fetch('active_melody'),
+			song_state=storage.fetch('song_state'),
+		)
+		playing_notes = {
+			instrument_name: tuple(instrument_props.playing_notes)
+			for scene_instruments in storage.fetch('instruments', {}).values()
+			for instrument_name, instrument_props in scene_instruments.items()
+		}
+		return Beat(index, pulse_start, harmony, [harmony] + self.pending, playing_notes)
+
+	def beats(self, count=None):
+		"""Yields beats, only working each out when it's asked for.
+
+		Args:
+			count (int, optional): How many beats to yield. Defaults to forever.
+		"""
+		index = 0
+		while count is None or index < count:
+			yield self.next_beat(index)
+			index += 1
+
+	async def abeats(self, count=None, realtime=False):
+		"""Yields beats asynchronously, only working each out when it's asked for.
+
+		Args:
+			count (int, optional): How many beats to yield. Defaults to forever.
+			realtime (bool, optional): Hold each beat back until its pulse is due, from when iterating started. Defaults to False.
+		"""
+		start = time.monotonic()
+		index = 0
+		while count is None or index < count:
+			beat = self.next_beat(index)
+			await asyncio.sleep(max(0.0, beat.seconds - (time.monotonic() - start)) if realtime else 0)
+			yield beat
+			index += 1
+
+# region Consumers
+
+class PlayedNote:
+	# Props
+	instrument_name: str
+	kind: str # 'note', 'percussion', 'melody' or 'sfx'
+	pitch: int # 0 for sfx, which have none
+	velocity: int
+	start: float # Show time
+	end: float
+
+	# Methods
+	def __init__(self, instrument_name: str, kind: str, pitch: int, velocity: int, start: float, end: float):
+		self.instrument_name = instrument_name
+		self.kind = kind
+		self.pitch = pitch
+		self.velocity = velocity
+		self.start = start
+		self.end = end
+
+def played_notes(beats, seconds_per_beat, end_seconds, sfx_seconds):
+	"""Turns a stream of beats into the notes that actually sound, pairing note ons with offs and laying out melody clips.
+
+	Args:
+		beats (iterable of Beats): The stream, like engine.beats().
+		seconds_per_beat (float): The tempo, for laying out clip notes.
+		end_seconds (float): Anything still sounding stops here (and later beats are ignored).
+		sfx_seconds (float): How long an sfx fire plays for (unless stopped), as the clips' lengths aren't known.
+
+	Returns:
+		list[PlayedNote]: Every note, in the order they started.
+	"""
+	notes = []
+	held = {} # (instrument_name, pitch) -> the held note
+	playing_clips = {} # instrument_name -> the notes its clip is playing
+
+	def end_note(note, seconds):
+		note.end = min(note.end, seconds)
+
+	for beat in beats:
+		if beat.seconds >= end_seconds:
+			break
+
+		for event in beat.events:
+			match event:
+				case NoteOn() | PercussionHit():
+					held_note = held.pop((event.instrument_name, event.pitch), None)
+					if held_note is not None:
+						end_note(held_note, event.seconds)
+					held_note = PlayedNote(event.instrument_name, 'percussion' if isinstance(event, PercussionHit) else 'note', event.pitch, event.velocity, event.seconds, end_seconds)
+					held[(event.instrument_name, event.pitch)] = held_note
+					notes.append(held_note)
+				case NoteOff():
+					held_note = held.pop((event.instrument_name, event.pitch), None)
+					if held_note is not None:
+						end_note(held_note, event.seconds)
+				case AllNotesOff():
+					for held_key in [held_key for held_key in held if held_key[0] == event.instrument_name]:
+						end_note(held.pop(held_key), event.seconds)
+				case MelodyClip() | SfxFire():
+					# Firing a clip restarts it
+					for clip_note in playing_clips.pop(event.instrument_name, ()):
+						end_note(clip_note, event.seconds)
+					if isinstance(event, SfxFire):
+						clip_notes = [PlayedNote(event.instrument_name, 'sfx', 0, 100, event.seconds, min(event.seconds + sfx_seconds, end_seconds))]
+					else:
+						clip_notes = [
+							PlayedNote(event.instrument_name, 'melody', pitch, velocity, event.seconds + start_beats * seconds_per_beat, min(event.seconds + (start_beats + length_beats) * seconds_per_beat, end_seconds))
+							for pitch, start_beats, length_beats, velocity, _ in event.notes
+						]
+					playing_clips[event.instrument_name] = clip_notes
+					notes += clip_notes
+				case ClipStop():
+					for clip_note in playing_clips.pop(event.instrument_name, ()):
+						end_note(clip_note, event.seconds)
+
+	# Notes cut off before they'd even started (like a clip stopped straight away) don't sound
+	return [note for note in notes if note.end > note.start]
+
+# endregion
@@ -0,0 +1,148 @@
+import random
+import statistics
+import sys
+import time
+
+from instrument import Instrument
+from event_scheduler import EventScheduler, max_events_per_frame_for
+from musical_clock import KEY_CHANGE_BEATS
+from simulated_td import DEFAULT_PULSE_SECONDS, SimulatedTD
+
+# Offline benchmark for the batched voicing path of the beat callback.
+#
+# Builds a synthetic roster of hundreds of sustained instruments, then walks chords and
+# variations from the reference tables, changing keys as often as the driver does. Every beat
+# goes through the driver's own change_notes_for_scene (run against the simulated OPs), so
+# it's timed planning the notes (plan_scene_notes, including the lead_across_keys search on a
+# key change) and scheduling the MIDI. The frame tick then dispatches the scheduled MIDI like
+# it does in the project, with the scheduler's per-frame limit sized from the synthetic roster
+# like reset_op_storage sizes it, and the busiest frames are timed too. It fails if the beats
+# don't fit in a frame, or if any MIDI goes out a frame (or more) late.
+#
+# Usage: python benchmark_voicing.py [num_instruments] [num_beats] [fps]
+
+DEFAULT_FPS = 60
+DELAY_TOLERANCE_MS = 0.001 # What's scheduled on the pulse goes out on the next frame's tick, so up to a frame (give or take rounding) is expected
+
+def make_roster(num_instruments, rng):
+	"""Makes a synthetic scene with the same mix of roles, ranges and voice counts as the real scenes."""
+	roster = {}
+	for i in range(num_instruments):
+		instrument_role = rng.choice(['chords', 'chords', 'effects', 'bass'])
+		if instrument_role == 'bass':
+			base_note, num_voices = rng.choice([24, 36]), 1
+		else:
+			base_note, num_voices = rng.choice([48, 60, 72]), rng.choice([1, 4])
+		roster['synthetic_' + str(i)] = Instrument(base_note=base_note, num_voices=num_voices, instrument_role=instrument_role, scene='synthetic', playing_notes=[])
+	return roster
+
+def percentile(times_ms, fraction):
+	"""Gets a percentile of some sorted times (the worst one if there are only a few)."""
+	return times_ms[max(int(len(times_ms) * fraction) - 1, 0)] if times_ms else 0.0
+
+def run(num_instruments=500, num_beats=2000, seed=0, fps=DEFAULT_FPS):
+	"""Runs the benchmark, ticking frames at a frame rate.
+
+	Returns:
+		multiple:
+			- list[float]: How long every beat took to plan and schedule its notes, in ms
+			- list[float]: The same, for just the beats with a key change
+			- list[float]: How long every frame that dispatched MIDI took, in ms
+			- int: How many MIDI messages were sent
+			- int: How many of them were dispatched a frame (or more) late
+			- float: The longest any of them waited past when it was due, in ms
+	"""
+	rng = random.Random(seed)
+	frame_seconds = 1 / fps
+	td = SimulatedTD()
+	driver = td.load_script('music_driver.py')
+	scheduler_tick = td.load_script('event_scheduler_tick.py')
+	theory = driver.theory
+
+	chords = list(theory.chords.values())
+	chord_variations = list(theory.chord_variations.values())
+	scale_notes = theory.scale_notes[rng.choice(list(theory.scale_notes))]
+
+	instruments = make_roster(num_instruments, rng)
+	scheduler = EventScheduler(max_events_per_frame_for(sum(instrument.num_voices for instrument in instruments.values())))
+	td.op('storage_op').store('event_scheduler', scheduler)
+	key = 'C'
+	key_change_countdown = rng.randint(*KEY_CHANGE_BEATS)
+	current_notes = ['0', '4', '7']
+	beat_times_ms = []
+	key_change_times_ms = []
+	frame_times_ms = []
+
+	for _ in range(num_beats):
+		previous_key_offset = theory.keys[key]['offset']
+		key_change_countdown -= 1
+		if key_change_countdown <= 0:
+			# Change keys like the driver does, landing on the new key's I
+			key_change_countdown = rng.randint(*KEY_CHANGE_BEATS)
+			key = theory.keys[key]['key_changes'][rng.randint(0, 3)]
+			new_notes = [scale_notes[0], scale_notes[2], scale_notes[4]]
+		else:
+			# Land on a random chord, optionally as a variation
+			chord = rng.choice(chords)
+			new_notes = chord['notes']
+			if rng.randint(0, 1) == 0:
+				new_notes = [str(int(note) + chord['base_note']) for note in rng.choice(chord_variations)['notes']]
+
+		pulse_seconds = td.absTime.seconds
+		start = time.perf_counter()
+		scheduler.on_pulse(pulse_seconds)
+		driver.change_notes_for_scene(driver.harmonic_plan.reset(current_notes, new_notes, theory.keys[key]['offset'], previous_key_offset), instruments)
+		beat_ms = (time.perf_counter() - start) * 1000
+		beat_times_ms.append(beat_ms)
+		if theory.keys[key]['offset'] != previous_key_offset:
+			key_change_times_ms.append(beat_ms)
+
+		# Tick frames until everything the beat scheduled is out, then skip to the next pulse
+		while scheduler.queue:
+			td.absTime.seconds += frame_seconds
+			dispatched = scheduler.events_dispatched
+			start = time.perf_counter()
+			scheduler_tick.onFrameStart(0)
+			if scheduler.events_dispatched != dispatched:
+				frame_times_ms.append((time.perf_counter() - start) * 1000)
+		td.absTime.seconds = pulse_seconds + DEFAULT_PULSE_SECONDS
+
+		current_notes = new_notes
+
+	messages_sent = sum(count for (op_name, message), count in td.counts.items() if message == 'midi')
+	return beat_times_ms, key_change_times_ms, frame_times_ms, messages_sent, scheduler.events_late, scheduler.worst_delay_seconds * 1000
+
+def main():
+	num_instruments = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+	num_beats = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+	fps = float(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_FPS
+	frame_budget_ms = 1000 / fps
+
+	beat_times_ms, key_change_times_ms, frame_times_ms, messages_sent, events_late, worst_delay_ms = run(num_instruments, num_beats, fps=fps)
+	for times_ms in (beat_times_ms, key_change_times_ms, frame_times_ms):
+		times_ms.sort()
+	p99 = percentile(beat_times_ms, 0.99)
+	key_change_p99 = percentile(key_change_times_ms, 0.99)
+
+	print(f'{num_instruments} instruments, {num_beats} beats ({len(key_change_times_ms)} key changes), {messages_sent} MIDI messages ({events_late} dispatched late, worst delay {worst_delay_ms:.3f} ms)')
+	print(f'beat latency (ms): mean {statistics.mean(beat_times_ms):.3f}, p50 {statistics.median(beat_times_ms):.3f}, p99 {p99:.3f}, max {beat_times_ms[-1]:.3f}')
+	if key_change_times_ms:
+		print(f'key change beat latency (ms): p50 {statistics.median(key_change_times_ms):.3f}, p99 {key_change_p99:.3f}, max {key_change_times_ms[-1]:.3f}')
+	print(f'dispatching frame latency (ms): p50 {statistics.median(frame_times_ms):.3f}, p99 {percentile(frame_times_ms, 0.99):.3f}, max {frame_times_ms[-1]:.3f}')
+	print(f'frame budget (ms): {frame_budget_ms:.3f}')
+
+	# Fail loudly if the batch path no longer fits in a frame, on an ordinary beat or a key change, or if its MIDI
+	# doesn't go out on time
+	problems = []
+	if p99 > frame_budget_ms or key_change_p99 > frame_budget_ms:
+		problems.append('p99 beat latency is over the frame budget!')
+	if events_late:
+		problems.append(f'{events_late} MIDI messages went out a frame (or more) late!')
+	if worst_delay_ms > frame_budget_ms + DELAY_TOLERANCE_MS:
+		problems.append(f'MIDI waited up to {worst_delay_ms:.3f} ms, over a frame!')
+	for problem in problems:
+		print(problem)
+	sys.exit(1 if problems else 0)
+
+if __name__ == '__main__':
+	main()
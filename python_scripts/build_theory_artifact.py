@@ -0,0 +1,35 @@
+import os
+import sys
+import time
+
+from theory import ARTIFACT_FILE_NAME, TABLE_FILE_NAMES, compile_tables, hash_sources, load_theory, read_table, write_artifact
+
+# Build step for the theory artifact the driver loads on a cold start.
+#
+# Compiles reference_data/*.tsv, the melody bank and the instrument roster into
+# reference_data/theory.bin. Re-run it after editing any of those; until then, the
+# driver notices the hash mismatch and falls back to compiling the TSVs itself.
+#
+# Usage: python build_theory_artifact.py [reference_data folder] [artifact path]
+
+REFERENCE_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'reference_data')
+
+def main():
+	reference_dir = sys.argv[1] if len(sys.argv) > 1 else REFERENCE_DATA_DIR
+	artifact_path = sys.argv[2] if len(sys.argv) > 2 else os.path.join(reference_dir, ARTIFACT_FILE_NAME)
+
+	tables = {file_name: read_table(reference_dir, file_name) for file_name in TABLE_FILE_NAMES}
+	source_hash = hash_sources(reference_dir)
+	artifact_size = write_artifact(artifact_path, compile_tables(tables), source_hash)
+	print(f'wrote {artifact_path} ({artifact_size} bytes, sources {source_hash.hex()[:16]})')
+
+	# Make sure the driver will actually pick it up, and show how long that takes
+	start = time.perf_counter()
+	theory = load_theory(reference_dir, artifact_path)
+	load_ms = (time.perf_counter() - start) * 1000
+	print(f'loaded from {theory.loaded_from} in {load_ms:.3f} ms')
+	if theory.loaded_from != 'artifact':
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
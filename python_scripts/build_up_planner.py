@@ -0,0 +1,265 @@
+import heapq
+import time
+from collections import deque
+
+# Build-up planner for scene transitions.
+#
+# Normally the chord and variation changes are a random walk over the transition tables. For
+# the last few beats before a scene starts crossfading, the driver asks this planner for its
+# chord and variation instead. It beam-searches the chord/variation graph (chords.tsv and
+# chord_variations.tsv, with exactly the moves the driver can make, so the verified state
+# space stays the same) for a path whose tension builds beat by beat and then resolves to I,
+# on a resolved variation, on the transition beat: the first beat after the crossfade starts,
+# which is when the driver moves on to the next scene. Key changes wait until after it.
+#
+# The tension of a (chord, variation) comes from the tables too: how many chord changes the
+# chord is from I, plus a bump for tension variations and diminished or augmented chords.
+#
+# The search runs once per build-up (again only if the song leaves the plan, like after a
+# hot reload), with a strict time budget. If the budget runs out or nothing fits, the driver
+# falls back to the random walk for that beat and the planner tries again on the next one.
+
+# region Constants
+
+BUILD_UP_BEATS = 6 # How many beats before the crossfade the build-up starts
+BEAM_WIDTH = 8
+BUDGET_SECONDS = 0.004 # Per search (well under a frame, and it's only once per build-up)
+
+TENSION_VARIATION_BUMP = 2 # Tension variations need resolving before the chord can change, so they pull hardest
+DISSONANT_CHORD_TYPES = ('diminished', 'augmented')
+REPEAT_PENALTY = 2.0 # For going back to a state the build-up already passed through, so it doesn't just rock between two
+HOME_CHORD = 'I'
+
+# endregion
+
+class BuildUpStep:
+	# Props
+	chord: str
+	chord_variation: str
+	move: str # 'chord' or 'variation', like the driver's change types
+
+	# Methods
+	def __init__(self, chord: str, chord_variation: str, move: str):
+		self.chord = chord
+		self.chord_variation = chord_variation
+		self.move = move
+
+class BuildUpPlanner:
+	# Props
+	beam_width: int
+	budget_seconds: float
+	graph_theory: object # The theory the graph below was built from (it's rebuilt when a reload swaps the theory)
+	states: list # (chord, variation) of every state
+	state_ids: dict # (chord, variation) -> index into states
+	successors: list # Per state, the (state, move) the driver can go to next
+	tensions: list # Per state
+	peak_tension: int # The highest tension of any state, which the build-up climbs towards
+	goal_distances: list # Per state, the fewest moves to a resolved I (None if it can't get there)
+	layer_scores: list # Per depth of the search, the best score into every state (None where it wasn't reached)
+	layer_parents: list # Per depth of the search, the (state, move) every state was best reached from
+	empty_layer: list
+	plan: list # BuildUpSteps still to play, the last one on the transition beat
+	transition_seconds: float # Show time of the crossfade being built up to, or None
+	plans: int # Searches that found a path
+	fallbacks: int # Searches that ran out of budget or found nothing
+
+	# Methods
+	def __init__(self, beam_width: int = BEAM_WIDTH, budget_seconds: float = BUDGET_SECONDS):
+		self.beam_width = beam_width
+		self.budget_seconds = budget_seconds
+		self.graph_theory = None
+		self.plan = []
+		self.transition_seconds = None
+		self.plans = 0
+		self.fallbacks = 0
+
+	def build_graph(self, theory):
+		"""Lays out the chord/variation graph of a theory, with each state's tension and distance from a resolved I."""
+		self.graph_theory = theory
+		self.states = [(chord, variation) for chord in theory.chords for variation in theory.chord_variation_names]
+		self.state_ids = {state: i for i, state in enumerate(self.states)}
+
+		# How many chord changes each chord is from I (chords that can't get there count as one further than the furthest)
+		home_distances = {HOME_CHORD: 0} if HOME_CHORD in theory.chords else {}
+		queue = deque(home_distances)
+		while queue:
+			to_chord = queue.popleft()
+			for chord, chord_props in theory.chords.items():
+				if chord not in home_distances and to_chord in chord_props['transitions']:
+					home_distances[chord] = home_distances[to_chord] + 1
+					queue.append(chord)
+		unreachable_distance = max(home_distances.values(), default=0) + 1
+
+		self.successors = []
+		self.tensions = []
+		for chord, variation in self.states:
+			variation_props = theory.chord_variations[variation]
+			successors = {}
+			for new_variation in variation_props['transitions']:
+				successors.setdefault((chord, new_variation), 'variation')
+
+			# Like the driver, the chord can only change out of a resolved variation, onto its plain triad or any variant
+			if variation_props['resolution'] != 'tension':
+				for new_chord in theory.chords[chord]['transitions']:
+					for new_variation in [theory.chords[new_chord]['type'] + ' triad'] + theory.chord_variation_names:
+						successors.setdefault((new_chord, new_variation), 'chord')
+			self.successors.append([(self.state_ids[state], move) for state, move in successors.items() if state in self.state_ids])
+
+			tension = home_distances.get(chord, unreachable_distance)
+			if variation_props['resolution'] == 'tension':
+				tension += TENSION_VARIATION_BUMP
+			if theory.chords[chord]['type'] in DISSONANT_CHORD_TYPES:
+				tension += 1
+			self.tensions.append(tension)
+		self.peak_tension = max(self.tensions)
+
+		# Room for the longest build-up (a plan is one step longer than the beats it spans, as it includes the transition beat)
+		self.empty_layer = [None] * len(self.states)
+		self.layer_scores = [list(self.empty_layer) for _ in range(BUILD_UP_BEATS + 3)]
+		self.layer_parents = [list(self.empty_layer) for _ in range(BUILD_UP_BEATS + 3)]
+
+		# Walk back from the goals to find how far every state is from resolving
+		predecessors = [[] for _ in self.states]
+		for state_id, successors in enumerate(self.successors):
+			for successor_id, _ in successors:
+				predecessors[successor_id].append(state_id)
+		self.goal_distances = [None] * len(self.states)
+		queue = deque()
+		for state_id, (chord, variation) in enumerate(self.states):
+			if chord == HOME_CHORD and theory.chord_variations[variation]['resolution'] == 'resolution':
+				self.goal_distances[state_id] = 0
+				queue.append(state_id)
+		while queue:
+			state_id = queue.popleft()
+			for predecessor_id in predecessors[state_id]:
+				if self.goal_distances[predecessor_id] is None:
+					self.goal_distances[predecessor_id] = self.goal_distances[state_id] + 1
+					queue.append(predecessor_id)
+
+	def search(self, start_id, num_steps, deadline):
+		"""Beam-searches for the build-up from a state.
+
+		Args:
+			start_id (int): The state the song is in.
+			num_steps (int): How many moves to plan, the last one landing on the transition beat.
+			deadline (float): When to give up, in perf_counter seconds.
+
+		Returns:
+			list[tuple]: The (state, move) of every step, or None if the budget ran out or nothing fits.
+		"""
+		if num_steps >= len(self.layer_scores):
+			return None
+
+		# Each layer holds the best score into every state at that depth, and where it came from. The score of what
+		# comes next only depends on the state, so only the best way into each one needs keeping (the layers are
+		# reused from search to search, so a search hardly allocates anything)
+		for layer in range(num_steps + 1):
+			self.layer_scores[layer][:] = self.empty_layer
+		self.layer_scores[0][start_id] = 0.0
+		beam = [start_id]
+		for depth in range(1, num_steps + 1):
+			remaining = num_steps - depth
+			previous_scores, scores, parents = self.layer_scores[depth - 1], self.layer_scores[depth], self.layer_parents[depth]
+			reached = []
+			for state_id in beam:
+				if time.perf_counter() > deadline:
+					return None
+
+				score = previous_scores[state_id]
+				tension = self.tensions[state_id]
+				path_ids = self.path_ids(state_id, depth - 1)
+				for successor_id, move in self.successors[state_id]:
+					goal_distance = self.goal_distances[successor_id]
+					if goal_distance is None or goal_distance > remaining:
+						continue
+
+					if remaining:
+						# Climb steadily, from where the song is towards the peak on the beat before the transition
+						target_tension = self.peak_tension * depth / (num_steps - 1)
+						new_score = score - abs(self.tensions[successor_id] - target_tension)
+						if successor_id in path_ids:
+							new_score -= REPEAT_PENALTY
+					else:
+						# Resolve, the higher the tension it resolves from the better
+						new_score = score + tension
+
+					best_score = scores[successor_id]
+					if best_score is None:
+						reached.append(successor_id)
+					if best_score is None or new_score > best_score:
+						scores[successor_id] = new_score
+						parents[successor_id] = (state_id, move)
+
+			beam = heapq.nlargest(self.beam_width, reached, key=scores.__getitem__)
+			if not beam:
+				return None
+
+		# Walk back from the best resolution
+		path = []
+		state_id = beam[0]
+		for depth in range(num_steps, 0, -1):
+			parent_id, move = self.layer_parents[depth][state_id]
+			path.append((state_id, move))
+			state_id = parent_id
+		path.reverse()
+		return path
+
+	def path_ids(self, state_id, depth):
+		"""Gets the states on the best way into a state at a depth of the search, so the build-up can avoid going back to them."""
+		path_ids = [state_id]
+		for layer in range(depth, 0, -1):
+			state_id = self.layer_parents[layer][state_id][0]
+			path_ids.append(state_id)
+		return path_ids
+
+	def step(self, theory, chord, chord_variation, show_seconds, seconds_to_transition, beat_seconds):
+		"""Gets this beat's chord and variation, if it's part of a build-up.
+
+		Args:
+			theory (Theory): The live theory.
+			chord (str): The current chord.
+			chord_variation (str): The current chord variation.
+			show_seconds (float): The time of this beat, in seconds since the show started.
+			seconds_to_transition (float): The time until the next scene crossfade starts.
+			beat_seconds (float): The time between beats.
+
+		Returns:
+			BuildUpStep: What to change to this beat, or None to do the usual random walk.
+		"""
+		# Work out how many beats are left until the transition beat, the first one after the crossfade starts (when the driver moves to the next scene)
+		if self.transition_seconds is not None and show_seconds > self.transition_seconds + beat_seconds:
+			self.transition_seconds = None
+			self.plan = []
+		if self.transition_seconds is None:
+			if seconds_to_transition > BUILD_UP_BEATS * beat_seconds:
+				return None
+			self.transition_seconds = show_seconds + seconds_to_transition
+		if show_seconds > self.transition_seconds:
+			num_steps = 1
+		else:
+			num_steps = int((self.transition_seconds - show_seconds) / beat_seconds) + 2
+
+		# Keep following the plan, unless the song left it (a key change, or a reloaded theory)
+		if theory is not self.graph_theory:
+			self.build_graph(theory)
+			self.plan = []
+		start_id = self.state_ids.get((chord, chord_variation))
+		if start_id is None:
+			return None
+		if len(self.plan) != num_steps + 1 or self.plan[0][0] != start_id:
+			path = self.search(start_id, num_steps, time.perf_counter() + self.budget_seconds)
+			if path is None:
+				self.plan = []
+				self.fallbacks += 1
+				return None
+			self.plans += 1
+			self.plan = [(start_id, None)] + path
+
+		# The plan starts with the state it was made from, followed by a step per beat
+		self.plan.pop(0)
+		state_id, move = self.plan[0]
+		if num_steps == 1:
+			self.transition_seconds = None
+			self.plan = []
+		new_chord, new_variation = self.states[state_id]
+		return BuildUpStep(new_chord, new_variation, move)
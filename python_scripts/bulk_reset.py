@@ -0,0 +1,120 @@
+import time
+
+# Bulk teardown of instruments, shared by the music reset and the driver's scene kills.
+#
+# Rather than stopping instruments one at a time, each with its own lookups and storage
+# writes, the work is grouped into phases (scheduled events, MIDI notes, clips, state), and
+# storage is written once at the end. Every MIDI instrument has its own OP (its own Ableton
+# track), so each still gets its own all-notes-off.
+# Every phase is timed, so slow resets show up.
+
+def time_phase(timings, phase, start):
+	"""Records how long a phase took, and starts timing the next one.
+
+	Args:
+		timings (dict[str, float]): The timings so far, in milliseconds by phase.
+		phase (str): The name of the phase that just finished.
+		start (float): When the phase started, from time.perf_counter().
+
+	Returns:
+		float: When the next phase starts.
+	"""
+	now = time.perf_counter()
+	timings[phase] = (now - start) * 1000
+	return now
+
+def silence_instruments(instruments, storage, get_op, timings=None):
+	"""Stops every instrument of a set of scenes, with an all-notes-off per MIDI instrument and one batch of clip stops.
+
+	Args:
+		instruments (dictionary of Instruments): Instruments to stop, grouped by scene.
+		storage (OP): The storage OP, which holds the melody clip contents and the event scheduler.
+		get_op (function): Gets the OP of an instrument by name.
+		timings (dict[str, float], optional): Timings to add the phases to. Defaults to a new dict.
+
+	Returns:
+		dict[str, float]: How long each phase took, in milliseconds.
+	"""
+	timings = {} if timings is None else timings
+	start = time.perf_counter()
+
+	# Group the instruments by how they're stopped
+	midi_names, melody_names, sfx_names = [], [], []
+	for scene_instruments in instruments.values():
+		for instrument_name, instrument_props in scene_instruments.items():
+			if instrument_props.instrument_role == 'melody':
+				melody_names.append(instrument_name)
+			elif instrument_props.instrument_role == 'sfx':
+				sfx_names.append(instrument_name)
+			else:
+				midi_names.append(instrument_name)
+			instrument_props.playing_notes = []
+	start = time_phase(timings, 'group', start)
+
+	# Drop anything still scheduled for them, so nothing plays after they're stopped
+	scheduler = storage.fetch('event_scheduler', None)
+	if scheduler is not None:
+		scheduler.cancel(set(midi_names) | set(melody_names) | set(sfx_names))
+	start = time_phase(timings, 'scheduler', start)
+
+	# An all-notes-off for every MIDI instrument
+	for instrument_name in midi_names:
+		instrument_op = get_op(instrument_name)
+		instrument_op.SendMIDI('flush')
+		instrument_op.par.Clearchop.pulse()
+	start = time_phase(timings, 'notes_off', start)
+
+	# Empty the melody clips that aren't already empty, then stop all the clips
+	melody_clips = storage.fetch('melody_clips', {})
+	for instrument_name in melody_names:
+		if melody_clips.get(instrument_name) != ():
+			get_op(instrument_name).RemoveNotes(timeStart=0, pitchStart=0, timeEnd=16, pitchEnd=127)
+			melody_clips[instrument_name] = ()
+	for instrument_name in melody_names + sfx_names:
+		get_op(instrument_name).par.Stopclip.pulse()
+	start = time_phase(timings, 'clips', start)
+
+	# Write the state back in one go
+	storage.store('melody_clips', melody_clips)
+	storage.store('instruments', storage.fetch('instruments', {}) | instruments)
+	time_phase(timings, 'state', start)
+
+	return timings
+
+def reset_music(storage, chord_history, get_op):
+	"""Resets all the music between shows: the schedule, the deferred beat stages, the chord history, and every instrument of every scene.
+
+	Args:
+		storage (OP): The storage OP.
+		chord_history (OP): The chord history table DAT.
+		get_op (function): Gets the OP of an instrument by name.
+
+	Returns:
+		dict[str, float]: How long each phase took, in milliseconds, plus the 'total'.
+	"""
+	timings = {}
+	reset_start = start = time.perf_counter()
+
+	# Drop anything that's still scheduled to play
+	scheduler = storage.fetch('event_scheduler', None)
+	if scheduler is not None:
+		scheduler.clear()
+
+	# And any beat stages that were put off to a later frame, so they don't run on the reset song
+	beat_budget = storage.fetch('beat_budget', None)
+	if beat_budget is not None:
+		beat_budget.clear_deferred()
+	start = time_phase(timings, 'clear_schedule', start)
+
+	# Truncate the chord history down to its header row, and write out what's left of the columnar history
+	chord_history.setSize(1, chord_history.numCols)
+	history_writer = storage.fetch('history_writer', None)
+	if history_writer is not None:
+		history_writer.flush()
+	start = time_phase(timings, 'history', start)
+
+	# Kill all the running instruments
+	silence_instruments(storage.fetch('instruments', {}), storage, get_op, timings)
+	time_phase(timings, 'total', reset_start)
+
+	return timings
@@ -0,0 +1,102 @@
+import argparse
+import gc
+import statistics
+import sys
+import time
+import tracemalloc
+
+from simulated_td import DEFAULT_PULSE_SECONDS, SimulatedShow
+
+# Allocation budget check for the driver's beat.
+#
+# Runs the driver against the simulated OP layer and, for a few thousand beats, measures
+# what the beat callback (onOffToOn) allocates: the peak of traced memory (tracemalloc)
+# above what was live before the beat, and how many young-generation garbage collections
+# the beat set off, since those are the pauses that land in TouchDesigner's frame. Exits
+# non-zero if the beat goes over any of the budgets below.
+#
+# The frame tick's dispatching isn't measured, and the beat's scheduled events count
+# towards its peak, as they're what the beat is for.
+#
+# Usage: python check_allocations.py [--beats 3000] [--pulse-seconds 8] [--seed 0]
+
+WARMUP_BEATS = 500 # Let storage, the schedule and the caches settle first
+
+# Budgets
+MEDIAN_PEAK_BUDGET_BYTES = 3584
+P99_PEAK_BUDGET_BYTES = 7168 # Above the median for beats that change keys or trigger a melody (beats that write a history segment are rarer than 1 in 100)
+GEN0_COLLECTIONS_BUDGET = 10 # Per 1000 beats
+
+def run(num_beats, pulse_seconds, seed):
+	"""Runs the beats and measures each one's allocations.
+
+	Returns:
+		multiple:
+			- list[int]: Each beat's peak of traced memory above what was live before it, in bytes
+			- int: Young-generation collections set off during the beats
+	"""
+	show = SimulatedShow(seed=seed, pulse_seconds=pulse_seconds)
+	for _ in range(WARMUP_BEATS):
+		show.beat()
+
+	# Count the young-generation collections that start while the beat callback runs
+	in_beat = False
+	collections = 0
+	def on_gc(phase, info):
+		nonlocal collections
+		if in_beat and phase == 'start' and info['generation'] == 0:
+			collections += 1
+	gc.callbacks.append(on_gc)
+
+	tracemalloc.start()
+	peaks = []
+	try:
+		for _ in range(num_beats):
+			pulse_start = show.td.absTime.seconds
+			tracemalloc.reset_peak()
+			live_bytes = tracemalloc.get_traced_memory()[0]
+
+			in_beat = True
+			show.pulse()
+			in_beat = False
+
+			peaks.append(tracemalloc.get_traced_memory()[1] - live_bytes)
+			show.tick_frames(pulse_start)
+	finally:
+		tracemalloc.stop()
+		gc.callbacks.remove(on_gc)
+
+	return peaks, collections
+
+def main():
+	parser = argparse.ArgumentParser(description='Check what the driver\'s beat allocates against a budget.')
+	parser.add_argument('--beats', type=int, default=3000, help='how many beats to measure')
+	parser.add_argument('--pulse-seconds', type=float, default=DEFAULT_PULSE_SECONDS, help='show time between Beat CHOP pulses')
+	parser.add_argument('--seed', type=int, default=0)
+	args = parser.parse_args()
+
+	start = time.perf_counter()
+	peaks, collections = run(args.beats, args.pulse_seconds, args.seed)
+	peaks.sort()
+	median_peak = statistics.median(peaks)
+	p99_peak = peaks[int(len(peaks) * 0.99)]
+	collections_per_1000 = collections * 1000 / len(peaks)
+
+	print(f'peak allocated per beat: median {median_peak:.0f} B, p99 {p99_peak} B, max {peaks[-1]} B')
+	print(f'young-generation collections: {collections} ({collections_per_1000:.1f} per 1000 beats)')
+
+	problems = []
+	if median_peak > MEDIAN_PEAK_BUDGET_BYTES:
+		problems.append(f'median peak {median_peak:.0f} B is over the budget of {MEDIAN_PEAK_BUDGET_BYTES} B')
+	if p99_peak > P99_PEAK_BUDGET_BYTES:
+		problems.append(f'p99 peak {p99_peak} B is over the budget of {P99_PEAK_BUDGET_BYTES} B')
+	if collections_per_1000 > GEN0_COLLECTIONS_BUDGET:
+		problems.append(f'{collections_per_1000:.1f} collections per 1000 beats is over the budget of {GEN0_COLLECTIONS_BUDGET}')
+
+	for problem in problems:
+		print('  - ' + problem)
+	print(f'\nmeasured {len(peaks)} beats in {time.perf_counter() - start:.1f} s')
+	sys.exit(1 if problems else 0)
+
+if __name__ == '__main__':
+	main()
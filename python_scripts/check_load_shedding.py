@@ -0,0 +1,102 @@
+import argparse
+import sys
+
+import numpy as np
+
+from beat_budget import BeatBudget
+from history_store import load_history
+from simulated_td import DEFAULT_PULSE_SECONDS, SimulatedShow
+
+# Checks the beat's load shedding against a budget too small for everything.
+#
+# Runs the driver against the simulated OP layer with a beat budget of a fraction of a
+# millisecond, so the optional stages get shed, and checks that:
+#   - the harmony still changed on every beat (every held instrument of the audible scenes
+#     is sounding exactly the notes it's holding once the beat's events are out),
+#   - something was actually shed, and counted,
+#   - every deferred history append still made it into the history, in order,
+#   - every scene that faded out was still cleaned up by the end.
+# Exits non-zero if any of them doesn't hold.
+#
+# Usage: python check_load_shedding.py [--beats 1000] [--budget-ms 0.15] [--seed 0]
+
+HELD_ROLES = ('bass', 'chords', 'effects')
+
+def main():
+	parser = argparse.ArgumentParser(description='Check the beat\'s load shedding with a budget too small for everything.')
+	parser.add_argument('--beats', type=int, default=1000)
+	parser.add_argument('--budget-ms', type=float, default=0.15, help='the beat budget (the default beat takes a couple of tenths of a millisecond)')
+	parser.add_argument('--pulse-seconds', type=float, default=DEFAULT_PULSE_SECONDS, help='show time between Beat CHOP pulses')
+	parser.add_argument('--seed', type=int, default=0)
+	args = parser.parse_args()
+
+	# Track what every instrument is sounding, from the MIDI it's sent
+	sounding = {}
+	def on_message(seconds, instrument_name, message, message_args):
+		if message != 'midi':
+			return
+		if message_args[0] == 'flush':
+			sounding.pop(instrument_name, None)
+		elif message_args[0] == 'note':
+			notes = sounding.setdefault(instrument_name, set())
+			if message_args[2] > 0:
+				notes.add(message_args[1])
+			else:
+				notes.discard(message_args[1])
+
+	show = SimulatedShow(seed=args.seed, pulse_seconds=args.pulse_seconds, sink=on_message)
+	metrics = show.storage.fetch('driver_metrics')
+	show.storage.store('beat_budget', BeatBudget(metrics, budget_seconds=args.budget_ms / 1000))
+
+	problems = []
+	harmony_mismatches = 0
+	for _ in range(args.beats):
+		show.beat()
+
+		# Once the beat's events are all out, every audible held instrument should be sounding what it holds
+		current_scene = show.storage.fetch('current_scene')
+		audible_scenes = {current_scene, show.storage.fetch('scenes')[current_scene].next_scene_name}
+		for scene_name in audible_scenes:
+			for instrument_name, instrument_props in show.storage.fetch('instruments')[scene_name].items():
+				if instrument_props.instrument_role in HELD_ROLES and sounding.get(instrument_name, set()) != {int(note) for note in instrument_props.playing_notes}:
+					harmony_mismatches += 1
+	if harmony_mismatches:
+		problems.append(f'{harmony_mismatches} times an instrument wasn\'t sounding the notes it was holding after a beat')
+
+	deferred = metrics.deferred_stages.values
+	dropped = metrics.dropped_stages.values
+	if not deferred and not dropped:
+		problems.append('nothing was shed, so the budget didn\'t bite (try a smaller --budget-ms)')
+	beat_budget = show.storage.fetch('beat_budget')
+	if beat_budget.deferred:
+		problems.append(f'{len(beat_budget.deferred)} deferred stages never ran')
+
+	# Every beat's history row should be there (unless it was dropped), still in beat order
+	history_writer = show.storage.fetch('history_writer')
+	history_writer.flush()
+	history = load_history(show.history_dir.name)
+	if len(history) + dropped.get('history', 0) != args.beats:
+		problems.append(f'the history has {len(history)} rows, but {args.beats} beats ran and {dropped.get("history", 0)} appends were dropped')
+	if np.any(np.diff(history.columns['timestamp']) < 0):
+		problems.append('the history rows are out of order')
+
+	# Scenes that have faded out (the timer's moved on past the scene after them) shouldn't be holding anything once the
+	# deferred cleanup has caught up
+	scenes = show.storage.fetch('scenes')
+	audible_scenes.update(scene_name for scene_name, scene in scenes.items() if scene.next_scene_name == current_scene)
+	for scene_name in scenes:
+		if scene_name not in audible_scenes:
+			for instrument_name, instrument_props in show.storage.fetch('instruments')[scene_name].items():
+				if instrument_props.playing_notes:
+					problems.append(f'{instrument_name} in faded scene {scene_name} is still holding {len(instrument_props.playing_notes)} notes')
+
+	print(f'{args.beats} beats with a {args.budget_ms} ms budget')
+	print(f'  deferred: {dict(sorted(deferred.items()))}')
+	print(f'  dropped: {dict(sorted(dropped.items()))}')
+	print(f'  expected stage costs (ms): {", ".join(f"{stage.name} {stage.expected_seconds * 1000:.3f}" for stage in beat_budget.stages.values())}')
+	for problem in problems:
+		print('  - ' + problem)
+	sys.exit(1 if problems else 0)
+
+if __name__ == '__main__':
+	main()
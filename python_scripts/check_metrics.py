@@ -0,0 +1,97 @@
+import argparse
+import sys
+import urllib.request
+from collections import Counter
+
+from simulated_td import DEFAULT_PULSE_SECONDS, SimulatedShow
+
+# Checks the driver's metrics endpoint against what the driver actually did.
+#
+# Runs the driver against the simulated OP layer (which records every message the OPs are
+# sent), serves its metrics on a free localhost port, scrapes them over HTTP like Prometheus
+# would, and compares the beats, MIDI messages per instrument, clip uploads, storage writes
+# and kills against the recorded messages. Exits non-zero if anything doesn't match.
+#
+# Usage: python check_metrics.py [--beats 1000] [--pulse-seconds 8] [--seed 0]
+
+def parse_exposition(text):
+	"""Parses the Prometheus text format.
+
+	Returns:
+		dict[str, float]: Value by series, like 'driver_midi_messages_total{instrument="bass"}'.
+	"""
+	samples = {}
+	for line in text.splitlines():
+		if line and not line.startswith('#'):
+			series, value = line.rsplit(' ', 1)
+			samples[series] = float(value)
+	return samples
+
+def labelled(samples, name):
+	"""Gets the values of a labelled metric, by label value."""
+	prefix = name + '{'
+	return {series[series.index('"') + 1:series.rindex('"')]: value for series, value in samples.items() if series.startswith(prefix)}
+
+def main():
+	parser = argparse.ArgumentParser(description='Check the driver\'s metrics endpoint against what the driver did.')
+	parser.add_argument('--beats', type=int, default=1000)
+	parser.add_argument('--pulse-seconds', type=float, default=DEFAULT_PULSE_SECONDS, help='show time between Beat CHOP pulses')
+	parser.add_argument('--seed', type=int, default=0)
+	args = parser.parse_args()
+
+	# Record the notes and clip rewrites as they're sent (kills send flushes, which are MIDI too, but aren't notes)
+	sent = Counter()
+	def on_message(seconds, instrument_name, message, message_args):
+		if message == 'midi' and message_args[0] == 'note':
+			sent['note', instrument_name] += 1
+		elif message in ('set_notes', 'remove_notes'):
+			sent[message, instrument_name] += 1
+
+	show = SimulatedShow(seed=args.seed, pulse_seconds=args.pulse_seconds, sink=on_message)
+	metrics = show.storage.fetch('driver_metrics')
+	if not metrics.start(port=0):
+		sys.exit(1)
+
+	stores_before = show.td.counts['storage_op', 'store'] - show.timer.scene_changes
+	for _ in range(args.beats):
+		show.beat()
+	stores = show.td.counts['storage_op', 'store'] - show.timer.scene_changes - stores_before
+
+	host, port = metrics.address
+	with urllib.request.urlopen(f'http://{host}:{port}/metrics', timeout=5) as response:
+		content_type = response.headers['Content-Type']
+		samples = parse_exposition(response.read().decode('utf-8'))
+	metrics.stop()
+
+	problems = []
+	def expect(what, got, wanted):
+		if got != wanted:
+			problems.append(f'{what}: the endpoint says {got}, expected {wanted}')
+
+	expect('content type', content_type.split(';')[0], 'text/plain')
+	expect('beats', samples.get('driver_beats_total'), args.beats)
+	expect('beat latency observations', samples.get('driver_beat_seconds_count'), args.beats)
+	expect('beat latency +Inf bucket', samples.get('driver_beat_seconds_bucket{le="+Inf"}'), args.beats)
+	expect('MIDI messages', labelled(samples, 'driver_midi_messages_total'), {name: count for (message, name), count in sent.items() if message == 'note'})
+	# Every storage write during the beats goes through the driver (other than the timer's scene changes)
+	expect('storage writes', sum(labelled(samples, 'driver_storage_writes_total').values()), stores)
+
+	# A clip rewrite always sends at least one of its notes or a clear, and kills only ever clear clips
+	clip_uploads = labelled(samples, 'driver_clip_uploads_total')
+	for instrument_name, uploads in clip_uploads.items():
+		if not 0 < uploads <= sent['set_notes', instrument_name] + sent['remove_notes', instrument_name]:
+			problems.append(f'clip uploads of {instrument_name}: the endpoint says {uploads}, but it was only sent {sent["set_notes", instrument_name]} note sets')
+	if not clip_uploads:
+		problems.append('no clip uploads were counted')
+	if not labelled(samples, 'driver_kills_total') and args.beats * args.pulse_seconds > 86400:
+		problems.append('a whole day ran without any scene being killed')
+
+	print(f'scraped {len(samples)} series from http://{host}:{port}/metrics after {args.beats} beats')
+	print(f'  beats {samples.get("driver_beats_total"):.0f}, MIDI messages {sum(labelled(samples, "driver_midi_messages_total").values()):.0f}, clip uploads {sum(clip_uploads.values()):.0f}, storage writes {stores}, kills {sum(labelled(samples, "driver_kills_total").values()):.0f}')
+	print(f'  mean beat {samples["driver_beat_seconds_sum"] / max(1, samples["driver_beat_seconds_count"]) * 1000:.3f} ms')
+	for problem in problems:
+		print('  - ' + problem)
+	sys.exit(1 if problems else 0)
+
+if __name__ == '__main__':
+	main()
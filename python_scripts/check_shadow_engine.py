@@ -0,0 +1,83 @@
+import argparse
+import sys
+
+from beat_budget import BeatBudget
+from shadow_engine import ShadowEngine
+from simulated_td import DEFAULT_PULSE_SECONDS, SimulatedShow
+
+# Checks shadow mode against the simulated OP layer.
+#
+# Runs the same seeded show twice, once on its own and once with a shadow driver replaying
+# its beats, and checks that:
+#   - the live show sent exactly the same messages both times (the shadow didn't touch the
+#     live random generator, storage or OPs),
+#   - the shadow kept up (it compared every beat after it started, and never raised),
+#   - with the live driver as the shadow (the default), nothing differed at all, so the
+#     shadow really is replaying the same beats from the same state.
+# The live show has no wall-clock deadlines, so it plays the same every run. Give it a beat
+# budget (--beat-budget-ms) to check that the shadow sheds whatever the live beats shed.
+# With another --shadow-driver, what differed is printed rather than counted as a problem.
+# Exits non-zero if any of them doesn't hold.
+#
+# Usage: python check_shadow_engine.py [--beats 500] [--shadow-driver music_driver.py] [--seed 0] [--beat-budget-ms 0.15]
+
+LIVE_DRIVER_SCRIPT = 'music_driver.py'
+
+def run(beats, pulse_seconds, seed, shadow_driver, beat_budget_seconds=None):
+	"""Runs a show, with a shadow driver if one's given, and a beat budget if one's given (else it never sheds).
+
+	Returns:
+		multiple:
+			- list[tuple]: Every message the live instruments were sent
+			- ShadowEngine: The shadow, or None
+	"""
+	messages = []
+	show = SimulatedShow(seed=seed, pulse_seconds=pulse_seconds, sink=lambda *message: messages.append(message), deadlines=False)
+	if beat_budget_seconds is not None:
+		show.storage.store('beat_budget', BeatBudget(show.storage.fetch('driver_metrics'), budget_seconds=beat_budget_seconds))
+	shadow_engine = None
+	if shadow_driver:
+		shadow_engine = ShadowEngine(shadow_driver)
+		show.storage.store('shadow_engine', shadow_engine)
+	for _ in range(beats):
+		show.beat()
+	return messages, shadow_engine
+
+def main():
+	parser = argparse.ArgumentParser(description='Check that the shadow driver replays the live beats without affecting them.')
+	parser.add_argument('--beats', type=int, default=500)
+	parser.add_argument('--pulse-seconds', type=float, default=DEFAULT_PULSE_SECONDS, help='show time between Beat CHOP pulses')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--shadow-driver', default=LIVE_DRIVER_SCRIPT, help='the driver script to run as the shadow')
+	parser.add_argument('--beat-budget-ms', type=float, default=None, help='give the live beats a budget, so they shed stages (their messages are only compared with the shadow\'s then)')
+	args = parser.parse_args()
+	beat_budget_seconds = None if args.beat_budget_ms is None else args.beat_budget_ms / 1000
+
+	# What a budgeted beat sheds depends on the machine, so the same show can only be played twice without one
+	live_messages = None
+	if beat_budget_seconds is None:
+		live_messages, _ = run(args.beats, args.pulse_seconds, args.seed, None)
+	shadowed_messages, shadow_engine = run(args.beats, args.pulse_seconds, args.seed, args.shadow_driver, beat_budget_seconds)
+	summary = shadow_engine.summary()
+
+	problems = []
+	if live_messages is not None and shadowed_messages != live_messages:
+		problems.append(f'the live show sent {len(shadowed_messages)} messages with the shadow running, but {len(live_messages)} without it (or different ones)')
+	if summary['errors']:
+		problems.append(f'the shadow raised {summary["errors"]} times, last {summary["last error"]}')
+	# The first beat goes by while the shadow starts from the live state, and the last is still queued
+	if summary['beats compared'] < args.beats - 2 or summary['syncs'] != 1:
+		problems.append(f'the shadow only compared {summary["beats compared"]} of {args.beats} beats, skipping {summary["skipped beats"]} and starting {summary["syncs"]} times')
+	if args.shadow_driver == LIVE_DRIVER_SCRIPT and summary['beats differing']:
+		first = next(record for record in shadow_engine.records if record.differing_fields or record.differing_instruments)
+		problems.append(f'the live driver differed from itself on {summary["beats differing"]} beats, first {first}')
+
+	print(f'{args.beats} beats, shadowed by {args.shadow_driver}')
+	for name, value in summary.items():
+		print(f'  {name}: {value}')
+	for problem in problems:
+		print('  - ' + problem)
+	sys.exit(1 if problems else 0)
+
+if __name__ == '__main__':
+	main()
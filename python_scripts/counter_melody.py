@@ -0,0 +1,272 @@
+import time
+from array import array
+from typing import Dict
+
+# Counter-melody generator.
+#
+# When a melody is triggered, the driver asks this for a second line to go with it, which
+# goes into the same clip, a little quieter. The counter-line plays on the melody's rhythm
+# and sits below it, within about an octave and a half of the instrument's base note (or
+# above it, if the melody's too close to the bottom of that range for a line to fit under it).
+#
+# Each note is picked from the chord that's playing, or from the scale mode on a short note
+# (as a passing tone), by a small dynamic programme over the whole line that scores:
+#   - the interval with the melody note (3rds and 6ths best, then 5ths and octaves, never a
+#     2nd or 7th, and never closer than a minor 3rd),
+#   - the step from the last counter note (small steps best, big leaps worst),
+#   - the motion against the melody (contrary best, parallel 5ths and octaves only when
+#     nothing else fits).
+#
+# A line only depends on the shape of the melody and the harmony under it, so each one is
+# cached by those, relative to the melody's lowest note (the same melody in another key, or
+# an octave up, is the same line moved), and only a cache miss is solved, within a strict
+# time budget. If the budget runs out, the melody plays on its own that time, and the next
+# trigger tries again. Chords and scale modes are passed around as 12-bit pitch class masks,
+# and the cache keys and lines are packed into ints (like the song state is), so a cache
+# entry is two untracked ints and a hit only builds the notes it returns.
+
+# region Constants
+
+COUNTER_MELODY_VELOCITY = 72 # Under the melody's
+BUDGET_SECONDS = 0.001 # Per line
+MAX_CACHED_LINES = 4096 # Oldest go first past this
+
+RANGE_SEMITONES = 19 # How far above the instrument's base note the counter-line can go
+CLOSEST_SEMITONES = 3 # The counter-line stays at least a minor 3rd from the melody...
+FURTHEST_SEMITONES = 16 # ...and within a 10th of it
+PASSING_TONE_BEATS = 1.0 # Notes shorter than this can be passing tones from the scale, rather than chord tones
+MAX_LINE_NOTES = 32 # Longer melodies don't get a counter-line (none has more than 8 notes)
+MAX_CANDIDATES = MAX_LINE_NOTES * (FURTHEST_SEMITONES - CLOSEST_SEMITONES + 1) # Across a whole line, which the solver's scratch arrays hold
+
+# Packing the cache: every melody note's pitch above the lowest, and every counter note's pitch from it (biased, as
+# they can be below it), takes a byte
+NOTE_BITS = 8
+NOTE_MASK = (1 << NOTE_BITS) - 1
+NOTE_BIAS = 128
+
+# Cost of each interval with the melody, by semitones mod 12 (None is never used)
+INTERVAL_COSTS = (2, None, None, 0, 0, 3, None, 1, 0, 0, None, None)
+PASSING_TONE_COST = 2
+REPEATED_NOTE_COST = 1
+LEAP_COSTS = ((2, 0), (4, 1), (7, 3)) # (up to semitones, cost), anything further costs LARGE_LEAP_COST
+LARGE_LEAP_COST = 6
+SIMILAR_MOTION_COST = 1
+PARALLEL_PERFECT_COST = 100 # Parallel 5ths and octaves, as good as never
+
+# endregion
+
+class CounterMelodyGenerator:
+	# Props
+	budget_seconds: float
+	lines: Dict[int, int] # Packed (melody shape, short notes, chord mask, scale mode mask, base note) -> packed counter pitches, all from the melody's lowest note, 0 where none fits
+	hits: int
+	misses: int
+	timeouts: int # Misses that ran out of budget
+	scratch: tuple # The solver's (pitches, costs, previous choices) arrays, made once and reused by every solve
+
+	# Methods
+	def __init__(self, budget_seconds: float = BUDGET_SECONDS):
+		self.budget_seconds = budget_seconds
+		self.lines = {}
+		self.hits = 0
+		self.misses = 0
+		self.timeouts = 0
+		self.scratch = (array('h', bytes(2 * MAX_CANDIDATES)), array('i', bytes(4 * MAX_CANDIDATES)), array('h', bytes(2 * MAX_CANDIDATES)))
+
+	def counter_notes(self, melody_notes, chord_mask, scale_mask, base_note):
+		"""Gets the counter-line of a melody, as clip notes.
+
+		Args:
+			melody_notes (tuple): The melody's clip notes, as (pitch, start, length, velocity, mute) tuples.
+			chord_mask (int): The pitch classes of the chord that's playing, from pitch_class_mask().
+			scale_mask (int): The pitch classes of the scale mode in the current key, from pitch_class_mask().
+			base_note (int): The lowest note the instrument can play.
+
+		Returns:
+			tuple: The counter-line's clip notes, or () if there isn't one.
+		"""
+		if not melody_notes or len(melody_notes) > MAX_LINE_NOTES:
+			return ()
+
+		# Look the line up relative to the melody's lowest note
+		lowest = melody_notes[0][0]
+		for note in melody_notes:
+			lowest = min(lowest, note[0])
+		short_notes = 0
+		cache_key = 0
+		for i, note in enumerate(melody_notes):
+			cache_key = (cache_key << NOTE_BITS) | (note[0] - lowest)
+			if note[2] < PASSING_TONE_BEATS:
+				short_notes |= 1 << i
+		chord_mask = rotate_mask(chord_mask, lowest)
+		scale_mask = rotate_mask(scale_mask, lowest)
+		base_note = int(base_note) - lowest
+		cache_key = (((((cache_key << MAX_LINE_NOTES | short_notes) << 12 | chord_mask) << 12 | scale_mask) << NOTE_BITS | (base_note + NOTE_BIAS)) << 6) | len(melody_notes)
+
+		line = self.lines.get(cache_key)
+		if line is None:
+			self.misses += 1
+			shape = tuple([note[0] - lowest for note in melody_notes])
+			solved_line = solve_line(shape, short_notes, chord_mask, scale_mask, base_note, time.perf_counter() + self.budget_seconds, self.scratch)
+			if solved_line is False:
+				# Out of time, so leave it uncached for next time
+				self.timeouts += 1
+				return ()
+			line = 0
+			for offset in reversed(solved_line):
+				line = (line << NOTE_BITS) | (offset + NOTE_BIAS)
+			if len(self.lines) >= MAX_CACHED_LINES:
+				del self.lines[next(iter(self.lines))]
+			self.lines[cache_key] = line
+		else:
+			self.hits += 1
+
+		if not line:
+			return ()
+		counter_notes = []
+		for note in melody_notes:
+			pitch = lowest + (line & NOTE_MASK) - NOTE_BIAS
+			if pitch > 127:
+				return ()
+			counter_notes.append((pitch, note[1], note[2], COUNTER_MELODY_VELOCITY, 0))
+			line >>= NOTE_BITS
+		return tuple(counter_notes)
+
+def pitch_class_mask(notes, key_offset):
+	"""Gets the pitch classes of some notes as a 12-bit mask.
+
+	Args:
+		notes (list[str]): The notes, in semitones from the key's root.
+		key_offset (int): The key's root, in semitones from C.
+
+	Returns:
+		int: A mask with bit n set if pitch class n (C being 0) is in the notes.
+	"""
+	mask = 0
+	for note in notes:
+		mask |= 1 << ((int(note) + key_offset) % 12)
+	return mask
+
+def rotate_mask(mask, semitones):
+	"""Moves a pitch class mask down some semitones, so bit n is set if pitch class n + semitones was."""
+	semitones %= 12
+	return ((mask >> semitones) | (mask << (12 - semitones))) & 0xFFF
+
+# region Solving
+
+def add_candidates(pitches, costs, start, melody_pitch, is_short, chord_mask, scale_mask, low, high, below):
+	"""Adds the notes the counter-line could play against a melody note, with what each costs on its own.
+
+	Args:
+		pitches (array): The candidates, to add to from start.
+		costs (array): What each costs, to add to from start.
+		start (int): Where this note's candidates go.
+
+	Returns:
+		int: How many candidates were added.
+	"""
+	added = 0
+	for pitch in range(low, high + 1):
+		distance = melody_pitch - pitch if below else pitch - melody_pitch
+		if not CLOSEST_SEMITONES <= distance <= FURTHEST_SEMITONES:
+			continue
+		interval_cost = INTERVAL_COSTS[distance % 12]
+		if interval_cost is None:
+			continue
+		if (chord_mask >> (pitch % 12)) & 1:
+			pitches[start + added] = pitch
+			costs[start + added] = interval_cost
+			added += 1
+		elif is_short and (scale_mask >> (pitch % 12)) & 1:
+			pitches[start + added] = pitch
+			costs[start + added] = interval_cost + PASSING_TONE_COST
+			added += 1
+	return added
+
+def transition_cost(previous_pitch, pitch, previous_melody_pitch, melody_pitch):
+	"""Scores moving from one counter note to the next, against the melody's move."""
+	leap = abs(pitch - previous_pitch)
+	if leap == 0:
+		cost = REPEATED_NOTE_COST
+	else:
+		cost = LARGE_LEAP_COST
+		for most_semitones, leap_cost in LEAP_COSTS:
+			if leap <= most_semitones:
+				cost = leap_cost
+				break
+
+	counter_motion = pitch - previous_pitch
+	melody_motion = melody_pitch - previous_melody_pitch
+	if counter_motion and melody_motion and (counter_motion > 0) == (melody_motion > 0):
+		cost += SIMILAR_MOTION_COST
+		if abs(melody_pitch - pitch) % 12 in (0, 7) and abs(previous_melody_pitch - previous_pitch) % 12 in (0, 7):
+			cost += PARALLEL_PERFECT_COST
+	return cost
+
+def solve_line(melody_pitches, short_notes, chord_mask, scale_mask, base_note, deadline, scratch):
+	"""Finds the cheapest counter-line for a melody, under it if one fits there, else over it.
+
+	Args:
+		melody_pitches (tuple[int]): The pitch of every melody note played, in order.
+		short_notes (int): A mask with bit n set if the nth note is short enough for a passing tone.
+		chord_mask (int): The pitch classes of the chord that's playing.
+		scale_mask (int): The pitch classes of the scale mode.
+		base_note (int): The lowest note the instrument can play.
+		deadline (float): When to give up, in perf_counter seconds.
+		scratch (tuple): The (pitches, costs, previous choices) arrays to work in, each MAX_CANDIDATES long.
+
+	Returns:
+		tuple[int]: A counter pitch per melody note, () if no line fits, or False if the deadline passed.
+	"""
+	# Under the melody, from the instrument's base note up
+	lowest, highest = min(melody_pitches), max(melody_pitches)
+	if lowest - CLOSEST_SEMITONES >= base_note:
+		line = solve_side(melody_pitches, short_notes, chord_mask, scale_mask, base_note, base_note + RANGE_SEMITONES, True, deadline, scratch)
+		if line != ():
+			return line
+
+	# Over the melody
+	low = max(base_note, lowest + CLOSEST_SEMITONES)
+	high = max(base_note + RANGE_SEMITONES, highest + FURTHEST_SEMITONES)
+	return solve_side(melody_pitches, short_notes, chord_mask, scale_mask, low, high, False, deadline, scratch)
+
+def solve_side(melody_pitches, short_notes, chord_mask, scale_mask, low, high, below, deadline, scratch):
+	"""Finds the cheapest counter-line on one side of a melody, within a range, one candidate per melody note.
+
+	Returns:
+		tuple[int]: A counter pitch per melody note, () if no line fits, or False if the deadline passed.
+	"""
+	# Every note's candidates, one after the other in the scratch arrays (so a solve barely allocates), with the best total
+	# cost into each and which candidate of the note before it that came from
+	pitches, costs, previous_choices = scratch
+	previous_start = start = 0
+	for i, melody_pitch in enumerate(melody_pitches):
+		if time.perf_counter() > deadline:
+			return False
+
+		added = add_candidates(pitches, costs, start, melody_pitch, (short_notes >> i) & 1, chord_mask, scale_mask, low, high, below)
+		if not added:
+			return ()
+
+		for j in range(start, start + added):
+			best_cost, best_previous = 0, -1
+			for k in range(previous_start, start if i else previous_start):
+				total = costs[k] + transition_cost(pitches[k], pitches[j], melody_pitches[i - 1], melody_pitch)
+				if best_previous < 0 or total < best_cost:
+					best_cost, best_previous = total, k
+			costs[j] += best_cost
+			previous_choices[j] = best_previous
+		previous_start, start = start, start + added
+
+	# Walk back from the cheapest last note
+	index = previous_start
+	for j in range(previous_start, start):
+		if costs[j] < costs[index]:
+			index = j
+	line = [0] * len(melody_pitches)
+	for i in range(len(melody_pitches) - 1, -1, -1):
+		line[i] = pitches[index]
+		index = previous_choices[index]
+	return tuple(line)
+
+# endregion
@@ -0,0 +1,189 @@
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Dict, List, Tuple
+
+# Counters and histograms for the driver, served over a local HTTP endpoint.
+#
+# The driver counts its beats, the clips it uploads, its storage writes, the instruments it
+# kills and the beat stages it sheds, and times its beat callback; the scheduler tick counts
+# the MIDI messages it sends to each instrument. All of them live in one DriverMetrics kept in storage, so they survive
+# the DATs being re-run, and a background thread serves them in the Prometheus text format
+# at http://127.0.0.1:9464/metrics, for Prometheus to scrape (or for curl) during a run.
+#
+# Only the serving happens off TouchDesigner's thread. The counting is a dictionary update
+# under a lock, so it's cheap enough to do for every message.
+
+# region Constants
+
+METRICS_HOST = '127.0.0.1' # Local only, nothing outside the machine needs to reach it
+METRICS_PORT = 9464
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+BEAT_SECONDS_BUCKETS = (0.0005, 0.001, 0.002, 0.004, 0.008, 0.016, 0.033, 0.066) # Up to a couple of frames at 60 FPS
+
+# endregion
+
+# region Metrics
+
+class Counter:
+	# Props
+	name: str
+	help: str
+	label_name: str # What the counts are split by (like instrument), or None for a single count
+	values: Dict[str, int] # Label value -> count ('' when there's no label)
+	lock: threading.Lock
+
+	# Methods
+	def __init__(self, name: str, help: str, lock: threading.Lock, label_name: str = None):
+		self.name = name
+		self.help = help
+		self.label_name = label_name
+		self.values = {}
+		self.lock = lock
+
+	def inc(self, label: str = '', amount: int = 1):
+		with self.lock:
+			self.values[label] = self.values.get(label, 0) + amount
+
+	def lines(self):
+		"""Gets the counter in the Prometheus text format (call with the lock held)."""
+		lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+		if self.label_name is None:
+			lines.append(f'{self.name} {self.values.get("", 0)}')
+		else:
+			for label, value in sorted(self.values.items()):
+				lines.append(f'{self.name}{{{self.label_name}="{escape_label(label)}"}} {value}')
+		return lines
+
+class Histogram:
+	# Props
+	name: str
+	help: str
+	buckets: Tuple[float, ...] # Upper bounds, ascending (+Inf is added when written out)
+	bucket_counts: List[int] # Observations per bucket, not cumulative (the last one is above every bound)
+	sum: float
+	count: int
+	lock: threading.Lock
+
+	# Methods
+	def __init__(self, name: str, help: str, lock: threading.Lock, buckets: Tuple[float, ...]):
+		self.name = name
+		self.help = help
+		self.buckets = tuple(buckets)
+		self.bucket_counts = [0] * (len(self.buckets) + 1)
+		self.sum = 0.0
+		self.count = 0
+		self.lock = lock
+
+	def observe(self, value: float):
+		bucket = bisect.bisect_left(self.buckets, value)
+		with self.lock:
+			self.bucket_counts[bucket] += 1
+			self.sum += value
+			self.count += 1
+
+	def lines(self):
+		"""Gets the histogram in the Prometheus text format (call with the lock held)."""
+		lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+		cumulative = 0
+		for bound, bucket_count in zip(self.buckets + (float('inf'),), self.bucket_counts):
+			cumulative += bucket_count
+			lines.append(f'{self.name}_bucket{{le="{"+Inf" if bound == float("inf") else repr(bound)}"}} {cumulative}')
+		lines.append(f'{self.name}_sum {self.sum!r}')
+		lines.append(f'{self.name}_count {self.count}')
+		return lines
+
+def escape_label(value):
+	return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# endregion
+
+class DriverMetrics:
+	# Props
+	beats: Counter
+	midi_messages: Counter # By instrument
+	clip_uploads: Counter # By instrument
+	storage_writes: Counter # By storage key
+	kills: Counter # Instruments killed, by scene
+	deferred_stages: Counter # Beat stages put off to a later frame, by stage (see beat_budget)
+	dropped_stages: Counter # Beat stages skipped, by stage
+	beat_seconds: Histogram # How long the beat callback took
+	lock: threading.Lock # Shared by every metric, so a scrape sees them all at one moment
+	server: HTTPServer
+	thread: threading.Thread
+
+	# Methods
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.beats = Counter('driver_beats_total', 'Beats the driver has run.', self.lock)
+		self.midi_messages = Counter('driver_midi_messages_total', 'MIDI messages sent to each instrument.', self.lock, 'instrument')
+		self.clip_uploads = Counter('driver_clip_uploads_total', 'Melody clip rewrites sent to each instrument.', self.lock, 'instrument')
+		self.storage_writes = Counter('driver_storage_writes_total', 'Writes to the storage OP, by key.', self.lock, 'key')
+		self.kills = Counter('driver_kills_total', 'Instruments silenced because their scene faded out, by scene.', self.lock, 'scene')
+		self.deferred_stages = Counter('driver_deferred_stages_total', 'Beat stages put off to a later frame because the beat ran out of time, by stage.', self.lock, 'stage')
+		self.dropped_stages = Counter('driver_dropped_stages_total', 'Beat stages skipped because the beat ran out of time, by stage.', self.lock, 'stage')
+		self.beat_seconds = Histogram('driver_beat_seconds', 'How long the beat callback took.', self.lock, BEAT_SECONDS_BUCKETS)
+		self.server = None
+		self.thread = None
+
+	def render(self):
+		"""Gets every metric in the Prometheus text format.
+
+		Returns:
+			str: The exposition, ending with a newline.
+		"""
+		with self.lock:
+			lines = []
+			for metric in (self.beats, self.midi_messages, self.clip_uploads, self.storage_writes, self.kills, self.deferred_stages, self.dropped_stages, self.beat_seconds):
+				lines += metric.lines()
+		return '\n'.join(lines) + '\n'
+
+	def start(self, host: str = METRICS_HOST, port: int = METRICS_PORT):
+		"""Starts serving the metrics in a background thread.
+
+		Args:
+			host (str, optional): The address to listen on. Defaults to localhost only.
+			port (int, optional): The port to listen on, or 0 for any free one. Defaults to METRICS_PORT.
+
+		Returns:
+			bool: Whether it's serving. If the port can't be opened, the metrics are still counted, just not served.
+		"""
+		metrics = self
+		class MetricsHandler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				if self.path.split('?')[0] not in ('/', '/metrics'):
+					self.send_error(404)
+					return
+				body = metrics.render().encode('utf-8')
+				self.send_response(200)
+				self.send_header('Content-Type', CONTENT_TYPE)
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				pass # Every scrape would print to the textport otherwise
+
+		try:
+			self.server = HTTPServer((host, port), MetricsHandler)
+		except OSError as error:
+			print(f'driver_metrics: couldn\'t serve the metrics on {host}:{port} ({error}), still counting them')
+			return False
+
+		self.thread = threading.Thread(target=self.server.serve_forever, name='driver_metrics', daemon=True)
+		self.thread.start()
+		return True
+
+	@property
+	def address(self):
+		"""The (host, port) being served on, or None."""
+		return None if self.server is None else self.server.server_address[:2]
+
+	def stop(self):
+		if self.server is not None:
+			self.server.shutdown()
+			self.server.server_close()
+			self.thread.join()
+			self.server = None
+			self.thread = None
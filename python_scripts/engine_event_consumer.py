@@ -0,0 +1,104 @@
+# me - this DAT
+#
+# frame - the current frame
+# state - True if the timeline is paused
+#
+# Make sure the corresponding toggle is enabled in the Execute DAT.
+#
+# Drains the out-of-process music engine's event ring (see music_engine) every frame, and
+# forwards the events to the real OPs. Only use this with the engine running, and with the
+# Beat CHOP Execute DAT and the event scheduler tick turned off, as the engine does their job.
+
+from event_ring import DEFAULT_RING_NAME, EventRing, RingConsumer
+from state_snapshots import publish_from_storage
+
+# region OPs
+storage = op('storage_op')
+
+# endregion
+
+# The consumer is made once the engine has made the ring
+consumer = None
+
+# Cache of instrument OPs, so the frame doesn't look every instrument up by name
+instrument_ops = {}
+
+def get_instrument_op(instrument_name):
+	instrument_op = instrument_ops.get(instrument_name)
+	if instrument_op is None or not instrument_op.valid:
+		instrument_op = op(instrument_name)
+		instrument_ops[instrument_name] = instrument_op
+	return instrument_op
+
+def dispatch_event(instrument_name, message, args):
+	"""Forwards an engine event to its OP, or to storage for state.
+
+	Args:
+		instrument_name (str): The name of the instrument OP ('' for state events).
+		message (str): What the event is, like 'midi' or 'state'.
+		args (tuple): The event's args.
+	"""
+	match message:
+		case 'midi':
+			get_instrument_op(instrument_name).SendMIDI(*args)
+		case 'set_notes':
+			get_instrument_op(instrument_name).SetNotes(notes=args)
+		case 'remove_notes':
+			get_instrument_op(instrument_name).RemoveNotes(timeStart=0, pitchStart=0, timeEnd=16, pitchEnd=127)
+		case 'fireclip':
+			get_instrument_op(instrument_name).par.Fireclip.pulse()
+		case 'stopclip':
+			get_instrument_op(instrument_name).par.Stopclip.pulse()
+		case 'clearchop':
+			get_instrument_op(instrument_name).par.Clearchop.pulse()
+		case 'state':
+			# The song state word the OSC exporter reads
+			storage_key, value = args
+			storage.store(storage_key, value)
+		case 'playing_notes':
+			# The playing notes the OSC exporter reads
+			for scene_instruments in storage.fetch('instruments', {}).values():
+				if instrument_name in scene_instruments:
+					scene_instruments[instrument_name].playing_notes = tuple(args)
+
+def onStart():
+	return
+
+def onCreate():
+	return
+
+def onExit():
+	return
+
+def onFrameStart(frame):
+	global consumer
+
+	# Attach once the engine's up
+	if consumer is None:
+		try:
+			consumer = RingConsumer(EventRing.attach(DEFAULT_RING_NAME))
+		except FileNotFoundError:
+			return
+
+	consumer.drain(dispatch_event)
+	storage.store('engine_ring_stats', consumer.stats())
+
+	# Publish what the events changed for the OSC exporter, like the driver does after each beat (nothing's made if they didn't change anything)
+	publish_from_storage(storage)
+
+	return
+
+def onFrameEnd(frame):
+	return
+
+def onPlayStateChange(state):
+	return
+
+def onDeviceChange():
+	return
+
+def onProjectPreSave():
+	return
+
+def onProjectPostSave():
+	return
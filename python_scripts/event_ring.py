@@ -0,0 +1,201 @@
+import marshal
+import multiprocessing
+import struct
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+# Lock-free single-producer, single-consumer ring of events in shared memory.
+#
+# The out-of-process engine (music_engine) publishes every instrument message and state
+# change into the ring, and the TouchDesigner side (engine_event_consumer) drains it every
+# frame, so the music keeps its own clock even when rendering hitches.
+#
+# Layout: a header, then slot_count fixed-size slots. The producer only ever writes the
+# write index (and its counters), the consumer only ever writes the read index, and each
+# index is only bumped after its slot is fully written or read, so no locks are needed.
+# The indexes count up forever; a slot is index % slot_count.
+#
+#   header: magic, version, slot count, slot size | write index, published, dropped | read index
+#   slot: wall time the event was published, payload length, payload (marshalled)
+#
+# If the consumer falls a whole ring behind, new events are dropped (and counted) rather
+# than overwriting ones it hasn't read.
+
+# region Constants
+
+RING_MAGIC = b'FTER'
+RING_VERSION = 1
+
+DEFAULT_RING_NAME = 'futerra_events'
+DEFAULT_SLOT_COUNT = 4096
+DEFAULT_SLOT_SIZE = 1024 # Big enough for a melody clip's notes
+
+RING_HEADER = struct.Struct('<4sHHII')
+WRITE_OFFSET = 64 # Write index, published and dropped, on their own cache line
+READ_OFFSET = 128 # Read index, on another
+SLOTS_OFFSET = 192
+COUNTERS = struct.Struct('<QQQ')
+INDEX = struct.Struct('<Q')
+SLOT_HEADER = struct.Struct('<dI')
+
+LATE_EVENT_SECONDS = 0.05 # Events consumed later than this after being published count as late
+
+# endregion
+
+class EventRing:
+	# Props
+	memory: shared_memory.SharedMemory
+	slot_count: int
+	slot_size: int
+	owner: bool # Whether this side made the ring (and so unlinks it when done)
+
+	# Methods
+	def __init__(self, memory: shared_memory.SharedMemory, owner: bool):
+		self.memory = memory
+		self.owner = owner
+		magic, version, _, self.slot_count, self.slot_size = RING_HEADER.unpack_from(memory.buf)
+		if magic != RING_MAGIC or version != RING_VERSION:
+			raise ValueError(f'{memory.name} is not a version {RING_VERSION} event ring')
+
+	@classmethod
+	def create(cls, name=DEFAULT_RING_NAME, slot_count=DEFAULT_SLOT_COUNT, slot_size=DEFAULT_SLOT_SIZE):
+		"""Makes a new ring, replacing any stale one left behind with the same name."""
+		try:
+			stale = shared_memory.SharedMemory(name=name)
+			stale.close()
+			stale.unlink()
+		except FileNotFoundError:
+			pass
+
+		memory = shared_memory.SharedMemory(name=name, create=True, size=SLOTS_OFFSET + slot_count * slot_size)
+		memory.buf[:SLOTS_OFFSET] = bytes(SLOTS_OFFSET)
+		RING_HEADER.pack_into(memory.buf, 0, RING_MAGIC, RING_VERSION, 0, slot_count, slot_size)
+		return cls(memory, owner=True)
+
+	@classmethod
+	def attach(cls, name=DEFAULT_RING_NAME):
+		"""Attaches to a ring another process made. Throws FileNotFoundError if it doesn't exist (yet)."""
+		memory = shared_memory.SharedMemory(name=name)
+		# A separate process (like TouchDesigner) gets its own resource tracker, which would unlink the ring when
+		# the process exits, from under its owner. Child processes share their parent's tracker, so leave theirs be.
+		if multiprocessing.parent_process() is None:
+			resource_tracker.unregister(memory._name, 'shared_memory')
+		return cls(memory, owner=False)
+
+	def counters(self):
+		"""Gets the producer's counters.
+
+		Returns:
+			multiple:
+				- int: The write index
+				- int: Events published
+				- int: Events dropped because the ring was full (or they didn't fit in a slot)
+		"""
+		return COUNTERS.unpack_from(self.memory.buf, WRITE_OFFSET)
+
+	def read_index(self):
+		return INDEX.unpack_from(self.memory.buf, READ_OFFSET)[0]
+
+	def publish(self, instrument_name, message, args=()):
+		"""Publishes an event. Only one process may publish to a ring.
+
+		Args:
+			instrument_name (str): The instrument the event is for ('' for state events).
+			message (str): What the event is, like 'midi' or 'state'.
+			args (tuple): The event's args, made of built-in types only.
+
+		Returns:
+			bool: False if the event was dropped.
+		"""
+		write_index, published, dropped = self.counters()
+		payload = marshal.dumps((instrument_name, message, args))
+		if write_index - self.read_index() >= self.slot_count or SLOT_HEADER.size + len(payload) > self.slot_size:
+			COUNTERS.pack_into(self.memory.buf, WRITE_OFFSET, write_index, published, dropped + 1)
+			return False
+
+		slot_offset = SLOTS_OFFSET + (write_index % self.slot_count) * self.slot_size
+		SLOT_HEADER.pack_into(self.memory.buf, slot_offset, time.time(), len(payload))
+		payload_offset = slot_offset + SLOT_HEADER.size
+		self.memory.buf[payload_offset:payload_offset + len(payload)] = payload
+
+		# Only now is the slot visible to the consumer
+		COUNTERS.pack_into(self.memory.buf, WRITE_OFFSET, write_index + 1, published + 1, dropped)
+		return True
+
+	def drain(self, handle, max_events=None):
+		"""Consumes the events published so far. Only one process may consume a ring.
+
+		Args:
+			handle (function): Called with (published_time, instrument_name, message, args) for every event, in order.
+			max_events (int, optional): Stop after this many. Defaults to all of them.
+
+		Returns:
+			int: How many events were consumed.
+		"""
+		write_index = self.counters()[0]
+		read_index = self.read_index()
+		end_index = write_index if max_events is None else min(write_index, read_index + max_events)
+
+		for index in range(read_index, end_index):
+			slot_offset = SLOTS_OFFSET + (index % self.slot_count) * self.slot_size
+			published_time, payload_size = SLOT_HEADER.unpack_from(self.memory.buf, slot_offset)
+			payload_offset = slot_offset + SLOT_HEADER.size
+			instrument_name, message, args = marshal.loads(self.memory.buf[payload_offset:payload_offset + payload_size])
+			handle(published_time, instrument_name, message, args)
+
+		# Hand the slots back to the producer in one go
+		INDEX.pack_into(self.memory.buf, READ_OFFSET, end_index)
+		return end_index - read_index
+
+	def close(self):
+		self.memory.close()
+		if self.owner:
+			self.memory.unlink()
+
+class RingConsumer:
+	"""Drains a ring into a dispatch function, counting the events that arrive late."""
+	# Props
+	ring: EventRing
+	late_seconds: float
+	consumed: int
+	late: int
+	worst_latency_seconds: float
+
+	# Methods
+	def __init__(self, ring: EventRing, late_seconds: float = LATE_EVENT_SECONDS):
+		self.ring = ring
+		self.late_seconds = late_seconds
+		self.consumed = 0
+		self.late = 0
+		self.worst_latency_seconds = 0.0
+
+	def drain(self, dispatch, max_events=None):
+		"""Consumes the events published so far, passing each to dispatch(instrument_name, message, args).
+
+		Returns:
+			int: How many events were consumed.
+		"""
+		now = time.time()
+
+		def handle(published_time, instrument_name, message, args):
+			latency_seconds = now - published_time
+			if latency_seconds > self.late_seconds:
+				self.late += 1
+			self.worst_latency_seconds = max(self.worst_latency_seconds, latency_seconds)
+			dispatch(instrument_name, message, args)
+
+		consumed = self.ring.drain(handle, max_events)
+		self.consumed += consumed
+		return consumed
+
+	def stats(self):
+		"""Gets the counters of both ends of the ring, as plain data (so they can go in storage)."""
+		write_index, published, dropped = self.ring.counters()
+		return {
+			'published': published,
+			'consumed': self.consumed,
+			'pending': write_index - self.ring.read_index(),
+			'dropped': dropped,
+			'late': self.late,
+			'worst_latency_ms': self.worst_latency_seconds * 1000,
+		}
@@ -0,0 +1,152 @@
+import heapq
+from typing import List, Tuple
+
+# Priority-queue scheduler for events at fractional beats.
+#
+# The beat callback schedules events (MIDI notes, clip fires, etc.) at a musical time
+# instead of firing them on the spot, and the frame tick dispatches whatever is due,
+# at most max_events_per_frame per frame. Events are plain data (instrument name,
+# action, args) so the scheduler can live in the storage OP.
+#
+# Musical time is in beats. Every Beat CHOP pulse is BEATS_PER_PULSE beats long, and
+# the tempo is worked out from the time between pulses. Frames aren't assumed to be any
+# length: an event counts as late if it was already due at the previous tick.
+#
+# The per-frame limit bounds the tick's work, but anything past it waits for the next
+# frame. A fixed limit of MAX_EVENTS_PER_FRAME makes notes late on any beat where more
+# than about half that many voices change at once (a note off and a note on each), so
+# the scheduler in storage is sized from the roster instead (see max_events_per_frame_for).
+
+# region Constants
+
+BEATS_PER_PULSE = 8
+DEFAULT_SECONDS_PER_BEAT = 0.5 # 120 BPM, until we've seen two pulses
+MAX_EVENTS_PER_FRAME = 64 # The per-frame limit for a roster with no held voices, leaving room for clips and percussion
+
+# Priorities for events landing on the same beat, lowest goes first
+PRIORITY_NOTE_OFF = 0
+PRIORITY_NOTE_ON = 1
+PRIORITY_CLIP = 2
+
+# endregion
+
+class EventScheduler:
+	# Props
+	queue: List[Tuple[float, int, int, str, str, tuple]] # (beat, priority, sequence, instrument_name, action, args)
+	max_events_per_frame: int
+	sequence: int # Tie-breaker, so events on the same beat and priority go in the order they were scheduled
+	pulse_beat: float # The beat the last pulse landed on
+	pulse_seconds: float # The time the last pulse landed on
+	seconds_per_beat: float
+	events_dispatched: int
+	events_late: int # Events that were dispatched a frame (or more) after they were due, due to the per-frame limit
+	worst_delay_seconds: float # Longest an event has waited past when it was due
+	last_tick_beat: float # The beat the last tick dispatched up to, or None before the first tick
+
+	# Methods
+	def __init__(self, max_events_per_frame: int = MAX_EVENTS_PER_FRAME):
+		self.queue = []
+		self.max_events_per_frame = max_events_per_frame
+		self.sequence = 0
+		self.pulse_beat = -BEATS_PER_PULSE
+		self.pulse_seconds = None
+		self.seconds_per_beat = DEFAULT_SECONDS_PER_BEAT
+		self.events_dispatched = 0
+		self.events_late = 0
+		self.worst_delay_seconds = 0.0
+		self.last_tick_beat = None
+
+	def on_pulse(self, seconds):
+		"""Moves musical time forward to the start of a new pulse.
+
+		Args:
+			seconds (float): The absolute time of the pulse, in seconds.
+
+		Returns:
+			float: The beat the pulse lands on.
+		"""
+		if self.pulse_seconds is not None and seconds > self.pulse_seconds:
+			self.seconds_per_beat = (seconds - self.pulse_seconds) / BEATS_PER_PULSE
+		self.pulse_beat += BEATS_PER_PULSE
+		self.pulse_seconds = seconds
+		return self.pulse_beat
+
+	def beat_at(self, seconds):
+		"""Converts an absolute time to musical time.
+
+		Args:
+			seconds (float): The absolute time, in seconds.
+
+		Returns:
+			float: The beat at the given time.
+		"""
+		if self.pulse_seconds is None:
+			return self.pulse_beat
+		return self.pulse_beat + (seconds - self.pulse_seconds) / self.seconds_per_beat
+
+	def schedule(self, beat_offset, instrument_name, action, args=(), priority=PRIORITY_CLIP):
+		"""Schedules an event, relative to the last pulse.
+
+		Args:
+			beat_offset (float): How many beats after the last pulse the event should fire (i.e., 0.5 for an 8th note later).
+			instrument_name (str): The name of the instrument OP the event is for.
+			action (str): What to do with the instrument: 'note', 'fireclip' or 'stopclip'.
+			args (tuple, optional): Args for the action, like (pitch, velocity) for notes. Defaults to ().
+			priority (int, optional): Order of events landing on the same beat, lowest first. Defaults to PRIORITY_CLIP.
+		"""
+		self.sequence += 1
+		heapq.heappush(self.queue, (self.pulse_beat + beat_offset, priority, self.sequence, instrument_name, action, args))
+
+	def cancel(self, instrument_names):
+		"""Drops all pending events for a set of instruments, i.e., when they're killed.
+
+		Args:
+			instrument_names (set[str]): The names of the instruments to drop events for.
+		"""
+		queue = [event for event in self.queue if event[3] not in instrument_names]
+		if len(queue) != len(self.queue):
+			heapq.heapify(queue)
+			self.queue = queue
+
+	def clear(self):
+		"""Drops all pending events and restarts musical time."""
+		self.__init__(self.max_events_per_frame)
+
+	def tick(self, seconds, dispatch):
+		"""Dispatches the events that are due, up to the per-frame limit. Meant to be called every frame.
+
+		Args:
+			seconds (float): The absolute time of the frame, in seconds.
+			dispatch (function): Called with (instrument_name, action, args) for every due event.
+
+		Returns:
+			int: The number of events dispatched.
+		"""
+		now = self.beat_at(seconds)
+		last_tick_beat = self.last_tick_beat
+		dispatched = 0
+		while self.queue and self.queue[0][0] <= now and dispatched < self.max_events_per_frame:
+			beat, priority, sequence, instrument_name, action, args = heapq.heappop(self.queue)
+			dispatch(instrument_name, action, args)
+			dispatched += 1
+			# Late if the previous frame could have sent it, however long the frames are
+			if last_tick_beat is not None and beat <= last_tick_beat:
+				self.events_late += 1
+			delay_seconds = (now - beat) * self.seconds_per_beat
+			if delay_seconds > self.worst_delay_seconds:
+				self.worst_delay_seconds = delay_seconds
+
+		self.last_tick_beat = now
+		self.events_dispatched += dispatched
+		return dispatched
+
+def max_events_per_frame_for(num_voices):
+	"""Sizes the per-frame limit for a roster, so a beat that changes every voice at once still goes out in one frame.
+
+	Args:
+		num_voices (int): How many voices the roster's held instruments have, across every scene.
+
+	Returns:
+		int: The per-frame limit, a note off and a note on for every voice on top of MAX_EVENTS_PER_FRAME.
+	"""
+	return MAX_EVENTS_PER_FRAME + 2 * num_voices
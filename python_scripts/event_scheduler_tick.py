@@ -0,0 +1,83 @@
+# me - this DAT
+# 
+# frame - the current frame
+# state - True if the timeline is paused
+# 
+# Make sure the corresponding toggle is enabled in the Execute DAT.
+
+import time
+
+# region OPs
+storage = op('storage_op')
+
+# endregion
+
+# Cache of instrument OPs, so the tick doesn't look every instrument up by name
+instrument_ops = {}
+
+def dispatch_event(instrument_name, action, args):
+	"""Sends a scheduled event to its instrument.
+
+	Args:
+		instrument_name (str): The name of the instrument OP.
+		action (str): What to do with the instrument: 'note', 'fireclip' or 'stopclip'.
+		args (tuple): Args for the action, like (pitch, velocity) for notes.
+	"""
+	instrument_op = instrument_ops.get(instrument_name)
+	if instrument_op is None or not instrument_op.valid:
+		instrument_op = op(instrument_name)
+		instrument_ops[instrument_name] = instrument_op
+
+	match action:
+		case 'note':
+			instrument_op.SendMIDI('note', *args)
+			metrics = storage.fetch('driver_metrics', None)
+			if metrics is not None:
+				metrics.midi_messages.inc(instrument_name)
+		case 'fireclip':
+			instrument_op.par.Fireclip.pulse()
+		case 'stopclip':
+			instrument_op.par.Stopclip.pulse()
+
+def onStart():
+	return
+
+def onCreate():
+	return
+
+def onExit():
+	return
+
+def onFrameStart(frame):
+	# Dispatch whatever the beat callback scheduled that's due by now (up to the scheduler's per-frame limit)
+	scheduler = storage.fetch('event_scheduler', None)
+	if scheduler is not None:
+		scheduler.tick(absTime.seconds, dispatch_event)
+
+	# Catch up on any beat stages the driver put off because it ran out of time
+	beat_budget = storage.fetch('beat_budget', None)
+	if beat_budget is not None and beat_budget.deferred:
+		beat_budget.run_deferred(time.perf_counter())
+
+	return
+
+def onFrameEnd(frame):
+	# Replay a live beat on the shadow driver, if there's one running and it has the time (after this frame's live beat, if any)
+	shadow_engine = storage.fetch('shadow_engine', None)
+	if shadow_engine is not None:
+		shadow_engine.run_pending(absTime.seconds, storage)
+
+	return
+
+def onPlayStateChange(state):
+	return
+
+def onDeviceChange():
+	return
+
+def onProjectPreSave():
+	return
+
+def onProjectPostSave():
+	return
+
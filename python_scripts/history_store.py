@@ -0,0 +1,329 @@
+import argparse
+import os
+import time
+from typing import List, Dict
+
+import numpy as np
+
+import song_state
+
+# Columnar, dictionary-encoded history of every beat, for analytics over long runs.
+#
+# Every beat appends one row: when it happened, the key, scale mode, chord, variation,
+# scene and change type (each stored as a small int code into a vocabulary, with the song
+# state's codes for all but the change type, see song_state), and the melody and percussion
+# decisions. Rows are buffered into fixed-size column chunks and each full chunk is written
+# out as one .npz segment, along with its vocabularies, so the tables can change without
+# breaking old logs.
+#
+# load_history() stitches the segments back together with one shared vocabulary per
+# column, and the query helpers (distribution, transition_matrix, dwell_times) work on
+# the code arrays directly with NumPy.
+#
+# Usage: python history_store.py [history folder]
+
+# region Constants
+
+HISTORY_CHUNK_ROWS = 512 # About an hour of beats, so a crash loses at most that
+
+ENCODED_COLUMNS = ('key', 'mode', 'chord', 'variation', 'scene', 'change_type')
+SONG_STATE_VOCABULARIES = {
+	'key': song_state.KEYS,
+	'mode': song_state.SCALE_MODES,
+	'chord': song_state.CHORDS,
+	'variation': song_state.CHORD_VARIATIONS,
+	'scene': song_state.SCENES,
+}
+COLUMN_TYPES = {
+	'timestamp': np.float64, # Unix time of the beat
+	'key': np.int8,
+	'mode': np.int8,
+	'chord': np.int8,
+	'variation': np.int8,
+	'scene': np.int8,
+	'change_type': np.int8,
+	'melody': np.int8, # The melody number, or -1 if no melody was triggered
+	'percussion': np.int8, # 1 if percussion was triggered
+}
+
+NO_MELODY = -1
+
+# endregion
+
+# region Writing
+
+class HistoryWriter:
+	# Props
+	directory: str
+	chunk_rows: int
+	vocabularies: Dict[str, List[str]] # Of the columns that aren't in the song state
+	codes: Dict[str, Dict[str, int]]
+	chunk: Dict[str, np.ndarray]
+	rows: int # Rows buffered in the current chunk
+	segments_written: int
+
+	# Methods
+	def __init__(self, directory: str, vocabularies: Dict[str, List[str]] = None, chunk_rows: int = HISTORY_CHUNK_ROWS):
+		self.directory = directory
+		self.chunk_rows = chunk_rows
+		self.vocabularies = {column: list((vocabularies or {}).get(column, ())) for column in ENCODED_COLUMNS if column not in SONG_STATE_VOCABULARIES}
+		self.codes = {column: {value: code for code, value in enumerate(vocabulary)} for column, vocabulary in self.vocabularies.items()}
+		self.chunk = {column: np.empty(chunk_rows, dtype=column_type) for column, column_type in COLUMN_TYPES.items()}
+		self.rows = 0
+		self.segments_written = 0
+
+	def encode(self, column, value):
+		"""Gets the code of a value, adding it to the column's vocabulary if it's new."""
+		code = self.codes[column].get(value)
+		if code is None:
+			code = len(self.vocabularies[column])
+			self.vocabularies[column].append(value)
+			self.codes[column][value] = code
+		return code
+
+	def append(self, timestamp, packed_state, change_type, percussion):
+		"""Adds a beat to the history, writing out a segment when the chunk fills up.
+
+		Args:
+			timestamp (float): The Unix time of the beat.
+			packed_state (int): The beat's song state word (key, scale mode, chord, variation, scene and the melody triggered).
+			change_type (str): What changed on the beat ("key", "chord", "chord variation" or "none").
+			percussion (bool): Whether the percussion was triggered.
+		"""
+		key_code, mode_code, chord_code, variation_code, scene_code, melody_code = song_state.codes(packed_state)
+		row = self.rows
+		chunk = self.chunk
+		chunk['timestamp'][row] = timestamp
+		chunk['key'][row] = key_code
+		chunk['mode'][row] = mode_code
+		chunk['chord'][row] = chord_code
+		chunk['variation'][row] = variation_code
+		chunk['scene'][row] = scene_code
+		chunk['change_type'][row] = self.encode('change_type', change_type)
+		chunk['melody'][row] = melody_code - 1 # The song state's melody code is one more than the melody, with 0 for none, so none is NO_MELODY
+		chunk['percussion'][row] = 1 if percussion else 0
+
+		self.rows += 1
+		if self.rows == self.chunk_rows:
+			self.flush()
+
+	def flush(self):
+		"""Writes the buffered rows out as a segment.
+
+		Returns:
+			str: The path of the segment, or None if there was nothing to write.
+		"""
+		if self.rows == 0:
+			return None
+
+		os.makedirs(self.directory, exist_ok=True)
+		arrays = {column: values[:self.rows] for column, values in self.chunk.items()}
+		for column, vocabulary in self.vocabularies.items():
+			arrays['vocabulary_' + column] = np.array(vocabulary, dtype=str)
+		for column, vocabulary in SONG_STATE_VOCABULARIES.items():
+			arrays['vocabulary_' + column] = np.array(vocabulary.names, dtype=str)
+
+		# Write to a temp file and swap it in, so a reader never sees a half-written segment
+		segment_name = f'history_{int(self.chunk["timestamp"][0] * 1000):015d}_{self.segments_written:06d}.npz'
+		segment_path = os.path.join(self.directory, segment_name)
+		with open(segment_path + '.tmp', 'wb') as segment_file:
+			np.savez(segment_file, **arrays)
+		os.replace(segment_path + '.tmp', segment_path)
+
+		self.rows = 0
+		self.segments_written += 1
+		return segment_path
+
+# endregion
+
+# region Reading
+
+class HistoryTable:
+	# Props
+	columns: Dict[str, np.ndarray]
+	vocabularies: Dict[str, List[str]]
+
+	# Methods
+	def __init__(self, columns: Dict[str, np.ndarray], vocabularies: Dict[str, List[str]]):
+		self.columns = columns
+		self.vocabularies = vocabularies
+
+	def __len__(self):
+		return len(self.columns['timestamp'])
+
+	def code(self, column, value):
+		"""Gets the code of a value in a column, or -1 if it never shows up."""
+		vocabulary = self.vocabularies.get(column)
+		if vocabulary is None:
+			return value
+		return vocabulary.index(value) if value in vocabulary else -1
+
+	def mask(self, **equals):
+		"""Makes a mask of the beats where every given column has the given value, like mask(scene='evening')."""
+		beat_mask = np.ones(len(self), dtype=bool)
+		for column, value in equals.items():
+			beat_mask &= self.columns[column] == self.code(column, value)
+		return beat_mask
+
+	def labels(self, column):
+		"""Gets the label of every code in a column."""
+		vocabulary = self.vocabularies.get(column)
+		if vocabulary is not None:
+			return list(vocabulary)
+		return [str(value) for value in range(int(self.columns[column].max(initial=0)) + 1)]
+
+def load_history(directory):
+	"""Loads every segment in a folder into one table, with one shared vocabulary per column.
+
+	Args:
+		directory (str): The history folder.
+
+	Returns:
+		HistoryTable: All the beats, in time order.
+	"""
+	segment_names = sorted(name for name in os.listdir(directory) if name.startswith('history_') and name.endswith('.npz'))
+	vocabularies = {column: [] for column in ENCODED_COLUMNS}
+	codes = {column: {} for column in ENCODED_COLUMNS}
+	parts = {column: [] for column in COLUMN_TYPES}
+
+	for segment_name in segment_names:
+		with np.load(os.path.join(directory, segment_name)) as segment:
+			for column in COLUMN_TYPES:
+				values = segment[column]
+				if column in ENCODED_COLUMNS:
+					# Re-map the segment's codes onto the shared vocabulary
+					remap = np.empty(len(segment['vocabulary_' + column]), dtype=np.int16)
+					for segment_code, value in enumerate(segment['vocabulary_' + column].tolist()):
+						if value not in codes[column]:
+							codes[column][value] = len(vocabularies[column])
+							vocabularies[column].append(value)
+						remap[segment_code] = codes[column][value]
+					values = remap[values].astype(COLUMN_TYPES[column]) if len(remap) else values
+				parts[column].append(values)
+
+	columns = {column: np.concatenate(values) if values else np.empty(0, dtype=COLUMN_TYPES[column]) for column, values in parts.items()}
+	order = np.argsort(columns['timestamp'], kind='stable')
+	return HistoryTable({column: values[order] for column, values in columns.items()}, vocabularies)
+
+# endregion
+
+# region Queries
+
+def distribution(table, column, beat_mask=None):
+	"""Counts how many beats land on each value of a column, like distribution(table, 'variation', table.mask(scene='evening')).
+
+	Args:
+		table (HistoryTable): The history.
+		column (str): The column to count.
+		beat_mask (np.ndarray, optional): Only count these beats. Defaults to all of them.
+
+	Returns:
+		dict[str, int]: The number of beats for each value, most common first.
+	"""
+	values = table.columns[column] if beat_mask is None else table.columns[column][beat_mask]
+	labels = table.labels(column)
+	offset = 1 if column == 'melody' else 0 # Melody uses -1 for none
+	counts = np.bincount(values.astype(np.int64) + offset, minlength=len(labels) + offset)
+	named = {('none' if offset and code == 0 else labels[code - offset]): int(count) for code, count in enumerate(counts) if count}
+	return dict(sorted(named.items(), key=lambda item: -item[1]))
+
+def transition_matrix(table, column, beat_mask=None, include_repeats=False):
+	"""Counts the transitions between consecutive beats, like which key changes happen.
+
+	Args:
+		table (HistoryTable): The history.
+		column (str): The column to count transitions of.
+		beat_mask (np.ndarray, optional): Only count transitions out of these beats. Defaults to all of them.
+		include_repeats (bool, optional): Count staying on the same value as a transition. Defaults to False.
+
+	Returns:
+		multiple:
+			- list[str]: The labels of the rows and columns
+			- np.ndarray: Counts, from the row's value to the column's value
+	"""
+	labels = table.labels(column)
+	values = table.columns[column].astype(np.int64)
+	from_values, to_values = values[:-1], values[1:]
+	keep = np.ones(len(from_values), dtype=bool)
+	if beat_mask is not None:
+		keep &= beat_mask[:-1]
+	if not include_repeats:
+		keep &= from_values != to_values
+
+	size = len(labels)
+	counts = np.bincount(from_values[keep] * size + to_values[keep], minlength=size * size).reshape(size, size)
+	return labels, counts
+
+def top_transitions(table, column, count=10, beat_mask=None):
+	"""Gets the most common transitions of a column, like the dominant key change paths.
+
+	Returns:
+		list[tuple]: ((from, to), number of times) for the most common transitions.
+	"""
+	labels, counts = transition_matrix(table, column, beat_mask)
+	flat_order = np.argsort(counts, axis=None)[::-1][:count]
+	top = []
+	for flat_index in flat_order:
+		from_code, to_code = divmod(int(flat_index), len(labels))
+		if counts[from_code, to_code]:
+			top.append(((labels[from_code], labels[to_code]), int(counts[from_code, to_code])))
+	return top
+
+def dwell_times(table, column):
+	"""Measures how long the history stays on each value of a column before it changes.
+
+	Args:
+		table (HistoryTable): The history.
+		column (str): The column to measure.
+
+	Returns:
+		dict[str, np.ndarray]: For every value, the length of each stay in beats.
+	"""
+	values = table.columns[column]
+	if len(values) == 0:
+		return {}
+
+	run_starts = np.concatenate(([0], np.flatnonzero(np.diff(values)) + 1))
+	run_lengths = np.diff(np.concatenate((run_starts, [len(values)])))
+	run_values = values[run_starts]
+
+	labels = table.labels(column)
+	offset = 1 if column == 'melody' else 0
+	return {
+		('none' if offset and code == -1 else labels[code]): run_lengths[run_values == code]
+		for code in np.unique(run_values).tolist()
+	}
+
+# endregion
+
+def main():
+	parser = argparse.ArgumentParser(description='Summarize the columnar history the driver logs every beat to.')
+	parser.add_argument('directory', nargs='?', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'history'), help='the history folder (defaults to /history)')
+	args = parser.parse_args()
+	if not os.path.isdir(args.directory):
+		parser.error(f'there\'s no history folder at {args.directory} (the driver makes it when it writes its first segment)')
+
+	start = time.perf_counter()
+	table = load_history(args.directory)
+	print(f'{len(table)} beats loaded in {(time.perf_counter() - start) * 1000:.1f} ms')
+	if not len(table):
+		return
+
+	for scene in table.vocabularies['scene']:
+		scene_mask = table.mask(scene=scene)
+		variations = distribution(table, 'variation', scene_mask)
+		total = sum(variations.values())
+		print(f'\n{scene} ({total} beats) chord variations:')
+		for variation, count in variations.items():
+			print(f'  {variation:<20} {count / total:6.1%}')
+
+	print('\ntop key changes:')
+	for (from_key, to_key), count in top_transitions(table, 'key'):
+		print(f'  {from_key} -> {to_key}: {count}')
+
+	print('\nmean beats per key:')
+	for key, lengths in dwell_times(table, 'key').items():
+		print(f'  {key:<3} {lengths.mean():.1f}')
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,22 @@
+from typing import List
+
+# The Instrument objects kept in storage, grouped by scene.
+#
+# reset_op_storage builds one per roster entry, the driver changes their playing notes every
+# beat, and the offline tools (like benchmark_voicing) make their own, so they all share this.
+
+class Instrument:
+	# Props
+	base_note: int # NOTE: For melody instruments, the base note is treated as the minumum note an instrument can play; this is to avoid weirdness with the ranges of instruments when shifted up/down in a key or chord
+	num_voices: int
+	instrument_role: str # Possible roles: bass, chords, effects, melody, percussion, sfx (used to have event, but removed in favor of just using the params from TDAbleton + MIDI)
+	scene: str
+	playing_notes: List[int]
+
+	# Methods
+	def __init__(self, base_note: int, num_voices: int, instrument_role: str, scene: str, playing_notes: List[int]):
+		self.base_note = base_note
+		self.num_voices = num_voices
+		self.instrument_role = instrument_role
+		self.scene = scene
+		self.playing_notes = playing_notes
@@ -0,0 +1,191 @@
+from typing import Dict
+
+# The melody bank, as plain data.
+#
+# Every melody is a list of notes (string positions above the root of the chord, like the
+# chord tables) that get adjusted to the current scale mode, chord and key, plus a rhythm
+# that lays the adjusted notes out in the clip:
+#   (index into the adjusted notes, start beat, length in beats, octave shift in semitones)
+#
+# Melodies 3, 7, 11, and 15 are all the same, they're considered the "main" melody and are
+# included in every possible "bank"
+
+MELODY_VELOCITY = 100
+MAIN_MELODY_NUMBERS = (3, 7, 11, 15)
+
+MAIN_THEME = {
+	"name": "Main theme",
+	"notes": ['0', '5', '7', '12', '10', '7', '5', '7'],
+	"ignore_notes": [10], # Always want the flat 7
+	"rhythm": (
+		(0, 0.0, 1.0, 0),
+		(1, 1.0, 1.0, 0),
+		(2, 2.0, 1.0, 0),
+		(3, 3.0, 1.0, 0),
+		(4, 4.0, 1.0, 0),
+		(5, 5.0, 2.0, 0),
+		(6, 7.0, 1.0, 0),
+		(7, 8.0, 3.0, 0),
+	),
+}
+
+MELODIES: Dict[int, dict] = {
+	# night and morning
+	0: {
+		"name": "Main theme variant",
+		"notes": ['0', '7', '5', '4'],
+		"ignore_notes": [4, 10],
+		"rhythm": (
+			(0, 2.0, 1.0, 0),
+			(1, 3.0, 1.0, 0),
+			(2, 4.0, 3.0, 0),
+			(3, 7.0, 3.0, 0),
+		),
+	},
+	1: {
+		"name": "Discount Clair de Lune (sorry Debussy)",
+		"notes": ['7', '7', '4', '2', '4', '2'],
+		"ignore_notes": [],
+		"rhythm": (
+			(0, 0.0, 2.0, -12),
+			(1, 2.0, 3.0, 0),
+			(2, 5.0, 3.0, 0),
+			(3, 8.0, 0.5, 0),
+			(4, 8.5, 0.5, 0),
+			(5, 9.0, 3.0, 0),
+		),
+	},
+	2: {
+		"name": "Like Real People Do riff (sorry Hozier)",
+		"notes": ['9', '7', '4', '2', '4'],
+		"ignore_notes": [],
+		"rhythm": (
+			(0, 1.0, 1.0, 0),
+			(1, 2.0, 1.0, 0),
+			(2, 3.0, 1.0, 0),
+			(3, 4.0, 3.0, 0),
+			(4, 7.0, 3.0, 0),
+		),
+	},
+	3: MAIN_THEME,
+	# morning and day
+	4: {
+		"name": "Discount Ranz des Vaches (sorry Rossini)",
+		"notes": ['12', '14', '7', '12', '16', '7'],
+		"ignore_notes": [],
+		"rhythm": (
+			(0, 0.0, 1.0, 0),
+			(1, 1.0, 2.0, 0),
+			(2, 3.0, 1.0, 0),
+			(3, 4.0, 1.0, 0),
+			(4, 5.0, 2.0, 0),
+			(5, 7.0, 3.0, 0),
+		),
+	},
+	5: {
+		"name": "Variant of main theme",
+		"notes": ['0', '7', '9', '5', '7'],
+		"ignore_notes": [10],
+		"rhythm": (
+			(0, 0.0, 1.0, 0),
+			(1, 1.0, 1.0, 0),
+			(2, 2.0, 1.0, 0),
+			(3, 3.0, 1.0, 0),
+			(4, 4.0, 3.0, 0),
+		),
+	},
+	6: {
+		"name": "OMG an original! A little woodwind run riff",
+		"notes": ['0', '5', '7', '12', '14', '12'],
+		"ignore_notes": [],
+		"rhythm": (
+			(0, 0.0, 0.25, 0),
+			(1, 0.25, 0.25, 0),
+			(2, 0.5, 0.25, 0),
+			(3, 0.75, 0.25, 0),
+			(4, 1.0, 3.0, 0),
+			(5, 4.0, 3.0, 0),
+		),
+	},
+	7: MAIN_THEME,
+	# day and evening
+	8: {
+		"name": "Discount Hyrule Field from OOT (the intro)",
+		"notes": ['2', '10', '7', '2', '10', '7'],
+		"ignore_notes": [10],
+		"rhythm": (
+			(0, 1.0, 0.5, 0),
+			(1, 1.5, 0.5, -12),
+			(2, 2.5, 1.0, 0),
+			(3, 3.0, 0.5, 0),
+			(4, 3.5, 0.5, -12),
+			(5, 4.0, 1.0, 0),
+		),
+	},
+	9: {
+		"name": "Seikilos epitaph (measure #1)",
+		"notes": ['0', '7', '7', '9', '7'],
+		"ignore_notes": [],
+		"rhythm": (
+			(0, 0.0, 2.0, 0),
+			(1, 2.0, 3.0, 0),
+			(2, 5.0, 0.125, 0),
+			(3, 5.125, 0.125, 0),
+			(4, 5.25, 3.0, 0),
+		),
+	},
+	10: {
+		"name": "Some original smthn, a bit of a trumpet riff",
+		"notes": ['2', '4', '7', '4'],
+		"ignore_notes": [],
+		"rhythm": (
+			(0, 0.0, 0.166, 0),
+			(1, 0.166, 0.166, 0),
+			(2, 0.333, 0.166, 0),
+			(3, 0.5, 3.0, 0),
+		),
+	},
+	11: MAIN_THEME,
+	# evening and night
+	12: {
+		"name": "Discount Hyrule Field from OOT (main riff)",
+		"notes": ['0', '7', '0', '12', '10', '9', '7'],
+		"ignore_notes": [10],
+		"rhythm": (
+			(0, 0.0, 1.0, 0),
+			(1, 1.0, 1.0, -12),
+			(2, 2.0, 1.0, 0),
+			(3, 3.0, 1.0, 0),
+			(4, 4.0, 2.0, 0),
+			(5, 6.0, 2.0, 0),
+			(6, 8.0, 4.0, 0),
+		),
+	},
+	13: {
+		"name": "Main theme variant",
+		"notes": ['0', '7', '7', '7', '4'],
+		"ignore_notes": [],
+		"rhythm": (
+			(0, 0.0, 1.0, 0),
+			(1, 1.0, 1.0, 0),
+			(2, 2.0, 1.0, 0),
+			(3, 3.0, 1.0, 0),
+			(4, 4.0, 3.0, 0),
+		),
+	},
+	14: {
+		"name": "Seikilos epitaph (measure #5)",
+		"notes": ['0', '4', '7', '5', '4', '5', '4'],
+		"ignore_notes": [],
+		"rhythm": (
+			(0, 1.0, 1.0, 0),
+			(1, 2.0, 1.0, 0),
+			(2, 3.0, 1.0, 0),
+			(3, 4.0, 1.0, 0),
+			(4, 5.0, 1.0, 0),
+			(5, 6.0, 1.0, 0),
+			(6, 7.0, 3.0, 0),
+		),
+	},
+	15: MAIN_THEME,
+}
@@ -1,5 +1,24 @@
+import os
 import random
-from typing import List, Dict
+import time
+
+from beat_budget import BeatBudget
+from build_up_planner import BuildUpPlanner
+from bulk_reset import silence_instruments
+from counter_melody import CounterMelodyGenerator, pitch_class_mask
+from driver_metrics import DriverMetrics
+from event_scheduler import EventScheduler, PRIORITY_NOTE_OFF, PRIORITY_NOTE_ON, max_events_per_frame_for
+from history_store import HistoryWriter
+from melodies import MELODY_VELOCITY
+from musical_clock import MusicalClock
+from roster import START_SCENE, TIMINGS_MATCH_TIMER
+from shadow_engine import LiveBeat
+from song_state import pack, register_theory
+from state_snapshots import StateSnapshots
+from theory import load_theory
+from theory_reloader import TheoryReloader
+from time_of_day_engine import TimeOfDayEngine, AUDIBLE_GAIN, FULL_GAIN
+from voicing import HarmonicPlan, adjust_melody_to_proper_octave, adjust_to_chord_in_scale_mode, plan_scene_notes, should_override_scale_mode_notes
 
 # me - this DAT
 # 
@@ -10,154 +29,92 @@ from typing import List, Dict
 # 
 # Make sure the corresponding toggle is enabled in the CHOP Execute DAT.
 
-# region Classes
-
-class Instrument:
-	# Props
-	base_note: int # NOTE: For melody instruments, the base note is treated as the minumum note an instrument can play; this is to avoid weirdness with the ranges of instruments when shifted up/down in a key or chord
-	num_voices: int
-	instrument_role: str # Possible roles: bass, chords, effects, melody, percussion, sfx (used to have event, but removed in favor of just using the params from TDAbleton + MIDI)
-	scene: str
-	playing_notes: List[int]
-
-	# Methods
-	def __init__(self, base_note: int, num_voices: int, instrument_role: str, scene: str, playing_notes: List[int]):
-		self.base_note = base_note
-		self.num_voices = num_voices
-		self.instrument_role = instrument_role
-		self.scene = scene
-		self.playing_notes = playing_notes
-
-# endregion
-
 # region Reference OPs
 
-change_chord_driver = op('change_chord_driver')
-key_change_driver = op('key_change_driver')
-scale_notes_table = op('scale_notes')
-keys_table = op('keys')
-chord_table = op('chords')
-chord_variations_table = op('chord_variations')
 storage = op('storage_op')
 time_of_day = op('time_of_day')
 scene_transition_driver = op('scene_transition_driver')
 chord_history = op('chord_history')
-volumes = op('volumes')
-
-# endregion
+CHORD_HISTORY_MAX_ROWS = 512 # The newest chords go on top, so past this the oldest get dropped off the bottom
 
-# region Helper Functions
+# Every beat is also logged to the columnar history here, for analytics (see history_store)
+HISTORY_DIR = os.path.join(project.folder, '..', 'history')
 
-def kill_instruments(instruments, current_scene, next_scene):
-	"""Stops all the instruments from a provided list.
+# Cache of instrument OPs, so the beat doesn't look every instrument up by name
+instrument_ops = {}
 
-	Args:
-		instruments (dictionary of Instruments): A dictionary of Instruments to stop playing.
-		current_scene (str): The current scene playing.
-		next_scene (str): The upcoming scene.
-	"""
-	for scene_name, scene_instruments in instruments.items():
-		# Make an empty object for killing off instruments
-		empty_instruments = {}
+# Structures the beat reuses rather than rebuilding every time
+harmonic_plan = HarmonicPlan([], [], 0) # Reset for every beat's harmonic step
+role_groups = {} # (scene, next scene) -> (melody instruments, percussion instruments), for the instruments below
+role_groups_instruments = None # The instruments role_groups was grouped from (a reset makes new ones)
+sfx_position_channels = {} # Instrument name -> (out CHOP, clip position channel)
+sfx_clip_positions = {} # Instrument name -> the clip position last read, for the shadow driver to read the same (overwritten rather than cleared every beat)
 
-		# If the scene is the current scene or the volume is audible (i.e., the previous scene), send notes to it
-		if scene_name == current_scene or scene_name == next_scene or volumes[scene_name] > 0.35:
-			continue
+# The optional stages that draw random numbers draw from their own generators, reseeded from the song's generator every beat
+# whether they run or not, so shedding one (see beat_budget) doesn't change what anything after it draws
+melody_random = random.Random()
+sfx_random = random.Random()
 
-		for instrument_name, instrument_props in scene_instruments.items():
-			# If a melody, reset its clip
-			if instrument_props.instrument_role == 'melody':
-				# Remove all existing notes
-				op(instrument_name).RemoveNotes(timeStart=0, pitchStart=0, timeEnd=16, pitchEnd=127)
-				op(instrument_name).par.Stopclip.pulse()
+# The reference tables, melodies and roster, compiled once at startup (from the theory artifact if it's up to date),
+# then swapped for a rebuilt one between beats when the tables are edited (see theory_reloader)
+REFERENCE_DATA_DIR = os.path.join(project.folder, '..', 'reference_data')
+theory = load_theory(REFERENCE_DATA_DIR)
+register_theory(theory) # So any rows beyond the exporter's original ones get their song state codes in table order
 
-			# If it's SFX, reset the clip without doing anything MIDI-wise
-			elif instrument_props.instrument_role == 'sfx':
-				op(instrument_name).par.Stopclip.pulse()
+# Computes the scene gains from the show time, in place of reading the volumes CHOP
+time_of_day_engine = TimeOfDayEngine()
+previous_scene_names = {scene_props['next_scene_name']: scene_name for scene_name, scene_props in theory.scenes.items()} # Each scene's, so the driver knows what's still fading out
 
-			# Else, it's MIDI, so reset it
-			else:
-				op(instrument_name).SendMIDI('flush')
-				op(instrument_name).par.Clearchop.pulse()
+# endregion
 
-			# Also kill off its playing MIDI notes from state
-			# Add the new instrument object
-			new_instrument_props = instrument_props
-			new_instrument_props.playing_notes = []
-			empty_instruments[instrument_name] = Instrument(**vars(new_instrument_props))
+# region Timing
 
+CHORD_ENTRY_STAGGER_BEATS = 0.0625 # Each sustained instrument enters a 16th of a beat after the previous one...
+CHORD_ENTRY_STAGGER_STEPS = 4 # ...rolling over every 4 instruments
+PERCUSSION_NOTE_LENGTH_BEATS = 1.0
+SFX_MAX_OFFSET_BEATS = 1.0 # SFX clips fire somewhere in the first beat of the pulse
 
-		base_instruments = storage.fetch('instruments', {}) # We need to get the updated values from other scenes, so we have to directly fetch this from storage instead of passing in as a prop
-		storage.store('instruments', base_instruments | {
-			scene_name: empty_instruments
-		})
+# endregion
 
+# region Helper Functions
 
-def adjust_to_chord_in_scale_mode(notes, scale_mode_notes, chord_base_note, chord_notes, mode, ignore_notes=[], override_scale_mode_notes=False):
-	"""Changes a given set of notes to a specific chord (i.e., IV) in a given scale mode (i.e., dorian).
+def kill_instruments(instruments, current_scene, next_scene, faded_scenes):
+	"""Stops all the instruments of the scenes that have faded out.
 
 	Args:
-		notes (list[str]): An array of string numbers, indicating their position above the root of the chord (0).
-		scale_mode_notes (list[str]): An array of string numbers, which indicate all notes in a scale mode based on their position above the root (0).
-		chord_base_note (str): The base note of the chord, represented by a position above the root (0).
-		chord_notes (list[str]): An array of string numbers, which indicate all notes in a chord variation based on their position above the root (0).
-		mode (str): "chord" mode (which ignores specific chord notes) or "melody" mode (which ignores notes specified in ignore_notes)
-		ignore_notes (list[int], optional): A list of note positions that we should not adjust to a given mode. Defaults to [].
-		override_scale_mode_notes (bool, optional): Should we override the scale mode notes? Defaults to False.
-
-	Returns:
-		str[]: A string array of notes, adjusted to the above parameters.
+		instruments (dictionary of Instruments): A dictionary of Instruments to stop playing.
+		current_scene (str): The current scene playing.
+		next_scene (str): The upcoming scene.
+		faded_scenes (set[str]): The scenes that faded out since the last beat.
 	"""
+	# If the scene is the current scene or it hasn't faded out (i.e., the previous scene), leave it be
+	scenes_to_kill = {
+		scene_name: instruments[scene_name] for scene_name in faded_scenes
+		if scene_name != current_scene and scene_name != next_scene and scene_name in instruments
+	}
+	if scenes_to_kill:
+		silence_instruments(scenes_to_kill, storage, get_instrument_op)
 
-	# Convert input lists from strings to integers
-	notes = [(int(note) + int(chord_base_note)) for note in notes]
-	scale_mode_notes = [int(note) % 12 for note in scale_mode_notes]
-	chord_notes = [(int(note) + int(chord_base_note)) % 12 for note in chord_notes]  # Modulo 12 for chromatic scale
-
-	# Check each note and adjust it to the proper key / scale mode / chord
-	new_notes = notes[:]
-	for i, note in enumerate(new_notes):
-		note_in_scale = note % 12 in scale_mode_notes
-		note_in_chord = note % 12 in chord_notes
-		if ((mode == "chord" and i != 4) or (mode == "melody" and note % 12 not in ignore_notes)):
-			# Adjust all items NOT in the scale mode OR chord, depending on the override
-			if (not override_scale_mode_notes and not note_in_scale) or (override_scale_mode_notes and not note_in_chord):
-				note = note - 1  # Adjust down chromatically until it fits
-					
-		# Assign the adjusted note to the output list
-		new_notes[i] = note
-
-	# Convert the result back to strings
-	new_notes = [str(note) for note in new_notes]
-	return new_notes
-
-def find_closest_note(note, target_notes):
-	"""Finds the closest note in a list of target notes.
+		metrics = get_metrics()
+		for scene_name, scene_instruments in scenes_to_kill.items():
+			metrics.kills.inc(scene_name, len(scene_instruments))
+		metrics.storage_writes.inc('melody_clips') # silence_instruments writes these two back
+		metrics.storage_writes.inc('instruments')
 
-	Args:
-		note (int): The current note, in a position above the root (0) of a chord.
-		target_notes (list[int]): A list of target notes, in positions above the root (0) of a chord.
 
-	Returns:
-		ints:
-			- int: The new closest note
-			- int: The original note
-	"""
-	# Find the closest note in target_notes to the given note, considering both current and previous octaves
-	candidates = [(tn, tn) for tn in target_notes] + [(tn - 12, tn) for tn in target_notes]
-	closest_note, original = min(candidates, key=lambda x: abs(x[0] - note))
-	return closest_note, original
-
-def normalize_notes(notes):
-	"""Normalizes notes to a single octave.
+def kill_faded_scenes(faded_scenes):
+	"""Kills the scenes that faded out, unless they've become audible again. The beat's budget can put this off to a later frame.
 
 	Args:
-		notes (list[str]): A list of string notes, each a position above a root (0).
-
-	Returns:
-		list[int]: A list of notes normalized to one octave.
+		faded_scenes (set[str]): The scenes that faded out.
 	"""
-	return [int(note) % 12 for note in notes]
+	current_scene = storage.fetch('current_scene')
+	kill_instruments(
+		instruments=storage.fetch('instruments', {}),
+		current_scene=current_scene,
+		next_scene=storage.fetch('scenes', {})[current_scene].next_scene_name,
+		faded_scenes=faded_scenes,
+	)
 
 def adjust_octave(note, reference):
 	"""Adjusts the octave of a note to be within the same as a reference note.
@@ -180,436 +137,130 @@ def trigger_percussion(percussion_instruments):
 
 	Args:
 		percussion_instruments (Dictionary of Instruments): A dictionary of percussion instruments.
+
+	Returns:
+		bool: Whether the percussion was triggered.
 	"""
 	should_trigger_percussion = random.randint(0, 1) == 1
 	if should_trigger_percussion:
+		scheduler = get_scheduler()
 		for instrument_name, instrument_props in percussion_instruments.items():
-			op(instrument_name).SendMIDI('note', int(instrument_props.base_note), 0)
-			op(instrument_name).SendMIDI('note', int(instrument_props.base_note), 100)
+			scheduler.schedule(0, instrument_name, 'note', (int(instrument_props.base_note), 100), PRIORITY_NOTE_ON)
+			scheduler.schedule(PERCUSSION_NOTE_LENGTH_BEATS, instrument_name, 'note', (int(instrument_props.base_note), 0), PRIORITY_NOTE_OFF)
+	return should_trigger_percussion
 
-def adjust_melody_to_proper_octave(notes, base_note, scale_mode_notes, chord_base_note, chord_notes, override_scale_mode_notes, key_offset, ignore_notes=[]):
-	"""Adjusts a melody to a proper scale mode and octave.
+def write_melody_clip(instrument_name, notes):
+	"""Writes a set of notes into a melody instrument's clip, skipping the transfer when the clip already holds them.
+
+	The notes last written to every clip are tracked in storage, so clearing an already-empty clip or
+	re-uploading the same melody doesn't send anything to Ableton.
 
 	Args:
-		notes (list[str]): An array of string numbers, indicating their position above the root of the chord (0).
-		base_note (str): The "base" (lowest) note for a given melody instrument.
-		scale_mode_notes (list[str]): An array of string numbers, which indicate all notes in a scale mode based on their position above the root (0).
-		chord_base_note (str): The base note of the chord, represented by a position above the root (0).
-		chord_notes (list[str]): An array of string numbers, which indicate all notes in a chord variation based on their position above the root (0).
-		override_scale_mode_notes (bool): Should we override the scale mode notes?
-		key_offset (str): The pitch offset for a given key.
-		ignore_notes (list[int], optional): A list of note positions that we should not adjust to a given mode. Defaults to [].
+		instrument_name (str): The name of the melody instrument.
+		notes (tuple): The notes to write, as (pitch, start, length, velocity, mute) tuples. Empty to clear the clip.
 
 	Returns:
-		list[int]: A list of melody notes adjusted to a given octave/key/scale mode.
+		bool: True if the clip had to be rewritten.
 	"""
-	# Get the adjusted notes, then shift them to the proper octave for the instrument
-	melody_notes = adjust_to_chord_in_scale_mode(
-		notes=notes,
-		scale_mode_notes=scale_mode_notes,
-		chord_base_note=chord_base_note,
-		chord_notes=chord_notes,
-		mode="melody",
-		override_scale_mode_notes=override_scale_mode_notes,
-		ignore_notes=ignore_notes
-	)
-	instrument_melody_notes = [(int(note) + int(key_offset)) for note in melody_notes]
-	while min(instrument_melody_notes) < int(base_note):
-		instrument_melody_notes = [note + 12 for note in instrument_melody_notes]
+	melody_clips = storage.fetch('melody_clips', {})
+	notes = tuple(notes)
+
+	# None means we don't know what's in the clip, so it always gets cleared
+	clip_notes = melody_clips.get(instrument_name)
+	if clip_notes == notes:
+		return False
 
-	return instrument_melody_notes
+	if clip_notes is None or clip_notes:
+		get_instrument_op(instrument_name).RemoveNotes(timeStart=0, pitchStart=0, timeEnd=16, pitchEnd=127)
+	if notes:
+		get_instrument_op(instrument_name).SetNotes(notes=notes)
 
+	melody_clips[instrument_name] = notes
+	store('melody_clips', melody_clips)
+	get_metrics().clip_uploads.inc(instrument_name)
+	return True
 
-def trigger_melody(melody_instruments, chord, chord_variation, key, scale_mode, scene):
+def trigger_melody(melody_instruments, chord, chord_variation, chord_notes, key, scale_mode, scene, is_transitioning_scenes):
 	"""Triggers a melody for all applicable melody instruments.
 
 	Args:
 		melody_instruments (Dictionary of Instruments): A dictionary of all melody instruments to trigger.
 		chord (str): A given chord to play (ii, VI, etc.)
 		chord_variation (str): A chord variation to play (sus2, dim, etc.)
+		chord_notes (list[str]): The notes of the chord that's playing, from the key's root, for the counter-line to pick from.
 		key (str): The current key of the song.
 		scale_mode (str): The current scale mode of the song (dorian, lydian, etc.)
-		scene (str): The current scene (day, evening, etc.)
+		scene (Scene): The current scene, which has the melody banks to pick from.
+		is_transitioning_scenes (bool): Whether the scene's still fading in, so it picks from its transition bank.
+
+	Returns:
+		int: The melody that was triggered, or None.
 	"""
 	# Clear out the currently-playing melody
-	storage.store('active_melody', 'none')
+	store('active_melody', 'none')
 
 	# Get the notes and the base scale for the melody
-	scale_notes = scale_notes_table[scale_notes_table.findCell(scale_mode, caseSensitive=True).row, 'Notes'].val.split(',')
-	chord_base_note = min(int(note) for note in chord_table[chord_table.findCell(chord, caseSensitive=True).row, 'Notes Above Root'].val.split(','))
-	chord_variation_notes = chord_variations_table[chord_variations_table.findCell(chord_variation, caseSensitive=True).row, 'Notes Above Root'].val.split(',')
-	chord_type = chord_table[chord_table.findCell(chord, caseSensitive=True).row, 'Type'].val
-	new_variation_type = chord_variations_table[chord_variations_table.findCell(chord_variation, caseSensitive=True).row, 'Type'].val
-	override_scale_mode_notes = new_variation_type != 'major' and new_variation_type != 'suspended' and new_variation_type != 'dominant' and chord_type not in ['II', 'III', 'VI', 'VII']
-	key_offset = keys_table[keys_table.findCell(key, caseSensitive=True).row, 'Offset'].val
+	scale_notes = theory.scale_notes[scale_mode]
+	chord_base_note = theory.chords[chord]['base_note']
+	chord_variation_notes = theory.chord_variations[chord_variation]['notes']
+	chord_type = theory.chords[chord]['type']
+	new_variation_type = theory.chord_variations[chord_variation]['type']
+	override_scale_mode_notes = should_override_scale_mode_notes(new_variation_type, chord_type)
+	key_offset = theory.keys[key]['offset']
 
 	# Get the melody we should use
-	is_transitioning_scenes = volumes[scene] < 0.65 # Not quite full volume but the other scene should be quiet enough at this point
-	melody_number = random.randint(0, 3 if is_transitioning_scenes else 7) # If transitioning, limit to intersection scenes
-	
-	# If the scene is NOT transitioning, then allow pulling from the next melody group in the bank
-	match scene:
-		# 0-4, 12-15
-		case 'morning':
-			melody_number -= 4
-			if melody_number < 0:
-				melody_number += 16
-		# 0-8
-		case 'day':
-			melody_number += 0
-		# 4-11
-		case 'evening':
-			melody_number += 4
-		# 8-15
-		case 'night':
-			melody_number += 8
-		# Whatevs
-		case _:
-			melody_number += 0
-
-
-	should_trigger_melody = random.randint(0, 1) == 1
+	# If transitioning, limit to the melodies shared with the previous scene, else allow pulling from the scene's whole bank
+	melody_bank = scene.transition_melody_bank if is_transitioning_scenes else scene.melody_bank
+	melody_number = melody_bank[melody_random.randint(0, len(melody_bank) - 1)]
+
+	should_trigger_melody = melody_random.randint(0, 1) == 1
+
+	# The pitch classes the counter-line can use (only worked out if there's a melody to go under)
+	if should_trigger_melody:
+		chord_mask = pitch_class_mask(chord_notes, key_offset)
+		scale_mask = pitch_class_mask(scale_notes, key_offset)
+		counter_melody_generator = get_counter_melody_generator()
 
 	# For each melody instrument:
 	for instrument_name, instrument_props in melody_instruments.items():
 		# Get the instrument's base note
 		base_note = instrument_props.base_note
 
-		# Remove all existing notes from the thing
-		op(instrument_name).RemoveNotes(timeStart=0, pitchStart=0, timeEnd=16, pitchEnd=127)
-		# op(instrument_name).par.Stopclip.pulse()
+		# If we're not triggering a melody, make sure the clip is empty (which is a no-op if it already is)
+		if not should_trigger_melody:
+			write_melody_clip(instrument_name, ())
+			# op(instrument_name).par.Stopclip.pulse()
+			continue
 
 		# If we should trigger a melody, choose an available melody from the bank
 		# Some notes:
 		# Melodies 3, 7, 11, and 15 are all the same, they're considered the "main" melody and are included in every possible "bank"
-		if should_trigger_melody:
-			storage.store('active_melody', str(melody_number))
-
-			match melody_number:
-				# night and morning
-				case 0:
-					# Main theme variant
-					instrument_melody_notes = adjust_melody_to_proper_octave(
-						notes=['0', '7', '5', '4'],
-						base_note=base_note,
-						scale_mode_notes=scale_notes,
-						chord_base_note=chord_base_note,
-						chord_notes=chord_variation_notes,
-						override_scale_mode_notes=override_scale_mode_notes,
-						key_offset=key_offset,
-						ignore_notes=[4, 10]
-					)
-					notes = (
-						(instrument_melody_notes[0], 2.0, 1.0, 100, 0), 
-						(instrument_melody_notes[1], 3.0, 1.0, 100, 0), 
-						(instrument_melody_notes[2], 4.0, 3.0, 100, 0), 
-						(instrument_melody_notes[3], 7.0, 3.0, 100, 0),
-					)
-				case 1:
-					# Discount Clair de Lune (sorry Debussy)
-					instrument_melody_notes = adjust_melody_to_proper_octave(
-						notes=['7', '7', '4', '2', '4', '2'],
-						base_note=base_note,
-						scale_mode_notes=scale_notes,
-						chord_base_note=chord_base_note,
-						chord_notes=chord_variation_notes,
-						override_scale_mode_notes=override_scale_mode_notes,
-						key_offset=key_offset
-					)
-					notes = (
-						(instrument_melody_notes[0] - 12, 0.0, 2.0, 100, 0), 
-						(instrument_melody_notes[1], 2.0, 3.0, 100, 0), 
-						(instrument_melody_notes[2], 5.0, 3.0, 100, 0), 
-						(instrument_melody_notes[3], 8.0, 0.5, 100, 0),
-						(instrument_melody_notes[4], 8.5, 0.5, 100, 0),
-						(instrument_melody_notes[5], 9.0, 3.0, 100, 0), 
-					)
-				case 2:
-					# Like Real People Do riff (sorry Hozier)
-					instrument_melody_notes = adjust_melody_to_proper_octave(
-						notes=['9', '7', '4', '2', '4'],
-						base_note=base_note,
-						scale_mode_notes=scale_notes,
-						chord_base_note=chord_base_note,
-						chord_notes=chord_variation_notes,
-						override_scale_mode_notes=override_scale_mode_notes,
-						key_offset=key_offset
-					)
-					notes = (
-						(instrument_melody_notes[0], 1.0, 1.0, 100, 0), 
-						(instrument_melody_notes[1], 2.0, 1.0, 100, 0), 
-						(instrument_melody_notes[2], 3.0, 1.0, 100, 0), 
-						(instrument_melody_notes[3], 4.0, 3.0, 100, 0),
-						(instrument_melody_notes[4], 7.0, 3.0, 100, 0),
-					)
-				case 3:
-					# Main theme
-					instrument_melody_notes = adjust_melody_to_proper_octave(
-						notes=['0', '5', '7', '12', '10', '7', '5', '7'],
-						base_note=base_note,
-						scale_mode_notes=scale_notes,
-						chord_base_note=chord_base_note,
-						chord_notes=chord_variation_notes,
-						override_scale_mode_notes=override_scale_mode_notes,
-						key_offset=key_offset,
-						ignore_notes=[10]
-					)
-					notes = (
-						(instrument_melody_notes[0], 0.0, 1.0, 100, 0), 
-						(instrument_melody_notes[1], 1.0, 1.0, 100, 0), 
-						(instrument_melody_notes[2], 2.0, 1.0, 100, 0), 
-						(instrument_melody_notes[3], 3.0, 1.0, 100, 0), # Always want the flat 7
-						(instrument_melody_notes[4], 4.0, 1.0, 100, 0),
-						(instrument_melody_notes[5], 5.0, 2.0, 100, 0),
-						(instrument_melody_notes[6], 7.0, 1.0, 100, 0),
-						(instrument_melody_notes[7], 8.0, 3.0, 100, 0),
-					)
-				# morning and day
-				case 4:
-					# Discount Ranz des Vaches (sorry Rossini)
-					instrument_melody_notes = adjust_melody_to_proper_octave(
-						notes=['12', '14', '7', '12', '16', '7'],
-						base_note=base_note,
-						scale_mode_notes=scale_notes,
-						chord_base_note=chord_base_note,
-						chord_notes=chord_variation_notes,
-						override_scale_mode_notes=override_scale_mode_notes,
-						key_offset=key_offset,
-					)
-					notes = (
-						(instrument_melody_notes[0], 0.0, 1.0, 100, 0), 
-						(instrument_melody_notes[1], 1.0, 2.0, 100, 0), 
-						(instrument_melody_notes[2], 3.0, 1.0, 100, 0), 
-						(instrument_melody_notes[3], 4.0, 1.0, 100, 0),
-						(instrument_melody_notes[4], 5.0, 2.0, 100, 0),
-						(instrument_melody_notes[5], 7.0, 3.0, 100, 0),
-					)
-				case 5:
-					# Variant of main theme
-					instrument_melody_notes = adjust_melody_to_proper_octave(
-						notes=['0', '7', '9', '5', '7'],
-						base_note=base_note,
-						scale_mode_notes=scale_notes,
-						chord_base_note=chord_base_note,
-						chord_notes=chord_variation_notes,
-						override_scale_mode_notes=override_scale_mode_notes,
-						key_offset=key_offset,
-						ignore_notes=[10]
-					)
-					notes = (
-						(instrument_melody_notes[0], 0.0, 1.0, 100, 0), 
-						(instrument_melody_notes[1], 1.0, 1.0, 100, 0), 
-						(instrument_melody_notes[2], 2.0, 1.0, 100, 0), 
-						(instrument_melody_notes[3], 3.0, 1.0, 100, 0),
-						(instrument_melody_notes[4], 4.0, 3.0, 100, 0), 
-					)
-				case 6:
-					# OMG an original! A little woodwind run riff
-					instrument_melody_notes = adjust_melody_to_proper_octave(
-						notes=['0', '5', '7', '12', '14', '12'],
-						base_note=base_note,
-						scale_mode_notes=scale_notes,
-						chord_base_note=chord_base_note,
-						chord_notes=chord_variation_notes,
-						override_scale_mode_notes=override_scale_mode_notes,
-						key_offset=key_offset
-					)
-					notes = (
-						(instrument_melody_notes[0], 0.0, 0.25, 100, 0), 
-						(instrument_melody_notes[1], 0.25, 0.25, 100, 0), 
-						(instrument_melody_notes[2], 0.5, 0.25, 100, 0), 
-						(instrument_melody_notes[3], 0.75, 0.25, 100, 0),
-						(instrument_melody_notes[4], 1.0, 3.0, 100, 0),
-						(instrument_melody_notes[5], 4.0, 3.0, 100, 0),
-					)
-				case 7:
-					# Main theme
-					instrument_melody_notes = adjust_melody_to_proper_octave(
-						notes=['0', '5', '7', '12', '10', '7', '5', '7'],
-						base_note=base_note,
-						scale_mode_notes=scale_notes,
-						chord_base_note=chord_base_note,
-						chord_notes=chord_variation_notes,
-						override_scale_mode_notes=override_scale_mode_notes,
-						key_offset=key_offset,
-						ignore_notes=[10]
-					)
-					notes = (
-						(instrument_melody_notes[0], 0.0, 1.0, 100, 0), 
-						(instrument_melody_notes[1], 1.0, 1.0, 100, 0), 
-						(instrument_melody_notes[2], 2.0, 1.0, 100, 0), 
-						(instrument_melody_notes[3], 3.0, 1.0, 100, 0), # Always want the flat 7
-						(instrument_melody_notes[4], 4.0, 1.0, 100, 0),
-						(instrument_melody_notes[5], 5.0, 2.0, 100, 0),
-						(instrument_melody_notes[6], 7.0, 1.0, 100, 0),
-						(instrument_melody_notes[7], 8.0, 3.0, 100, 0),
-					)
-				# day and evening
-				case 8:
-					# Discount Hyrule Field from OOT (the intro)
-					instrument_melody_notes = adjust_melody_to_proper_octave(
-						notes=['2', '10', '7', '2', '10', '7'],
-						base_note=base_note,
-						scale_mode_notes=scale_notes,
-						chord_base_note=chord_base_note,
-						chord_notes=chord_variation_notes,
-						override_scale_mode_notes=override_scale_mode_notes,
-						key_offset=key_offset,
-						ignore_notes=[10] # Always want the flat 7
-					)
-					notes = (
-						(instrument_melody_notes[0], 1.0, 0.5, 100, 0), 
-						(instrument_melody_notes[1] - 12, 1.5, 0.5, 100, 0), 
-						(instrument_melody_notes[2], 2.5, 1.0, 100, 0), 
-						(instrument_melody_notes[3], 3.0, 0.5, 100, 0), 
-						(instrument_melody_notes[4] - 12 , 3.5, 0.5, 100, 0), 
-						(instrument_melody_notes[5], 4.0, 1.0, 100, 0),
-					)
-				case 9:
-					# Seikilos epitaph (measure #1)
-					instrument_melody_notes = adjust_melody_to_proper_octave(
-						notes=['0', '7', '7', '9', '7'],
-						base_note=base_note,
-						scale_mode_notes=scale_notes,
-						chord_base_note=chord_base_note,
-						chord_notes=chord_variation_notes,
-						override_scale_mode_notes=override_scale_mode_notes,
-						key_offset=key_offset
-					)
-					notes = (
-						(instrument_melody_notes[0], 0.0, 2.0, 100, 0), 
-						(instrument_melody_notes[1], 2.0, 3.0, 100, 0), 
-						(instrument_melody_notes[2], 5.0, 0.125, 100, 0), 
-						(instrument_melody_notes[3], 5.125, 0.125, 100, 0),
-						(instrument_melody_notes[4], 5.25, 3.0, 100, 0),
-					)
-				case 10:
-					# Some original smthn, a bit of a trumpet riff
-					instrument_melody_notes = adjust_melody_to_proper_octave(
-						notes=['2', '4', '7', '4'],
-						base_note=base_note,
-						scale_mode_notes=scale_notes,
-						chord_base_note=chord_base_note,
-						chord_notes=chord_variation_notes,
-						override_scale_mode_notes=override_scale_mode_notes,
-						key_offset=key_offset
-					)
-					notes = (
-						(instrument_melody_notes[0], 0.0, 0.166, 100, 0), 
-						(instrument_melody_notes[1], 0.166, 0.166, 100, 0), 
-						(instrument_melody_notes[2], 0.333, 0.166, 100, 0), 
-						(instrument_melody_notes[3], 0.5, 3, 100, 0),
-					)
-				case 11:
-					# Main theme
-					instrument_melody_notes = adjust_melody_to_proper_octave(
-						notes=['0', '5', '7', '12', '10', '7', '5', '7'],
-						base_note=base_note,
-						scale_mode_notes=scale_notes,
-						chord_base_note=chord_base_note,
-						chord_notes=chord_variation_notes,
-						override_scale_mode_notes=override_scale_mode_notes,
-						key_offset=key_offset,
-						ignore_notes=[10]
-					)
-					notes = (
-						(instrument_melody_notes[0], 0.0, 1.0, 100, 0), 
-						(instrument_melody_notes[1], 1.0, 1.0, 100, 0), 
-						(instrument_melody_notes[2], 2.0, 1.0, 100, 0), 
-						(instrument_melody_notes[3], 3.0, 1.0, 100, 0), # Always want the flat 7
-						(instrument_melody_notes[4], 4.0, 1.0, 100, 0),
-						(instrument_melody_notes[5], 5.0, 2.0, 100, 0),
-						(instrument_melody_notes[6], 7.0, 1.0, 100, 0),
-						(instrument_melody_notes[7], 8.0, 3.0, 100, 0),
-					)
-				# evening and night
-				case 12:
-					# Discount Hyrule Field from OOT (main riff)
-					instrument_melody_notes = adjust_melody_to_proper_octave(
-						notes=['0', '7', '0', '12', '10', '9', '7'],
-						base_note=base_note,
-						scale_mode_notes=scale_notes,
-						chord_base_note=chord_base_note,
-						chord_notes=chord_variation_notes,
-						override_scale_mode_notes=override_scale_mode_notes,
-						key_offset=key_offset,
-						ignore_notes=[10] # Always want the flat 7
-					)
-					notes = (
-						(instrument_melody_notes[0], 0.0, 1.0, 100, 0), 
-						(instrument_melody_notes[1] - 12, 1.0, 1.0, 100, 0), 
-						(instrument_melody_notes[2], 2.0, 1.0, 100, 0), 
-						(instrument_melody_notes[3], 3.0, 1.0, 100, 0), 
-						(instrument_melody_notes[4], 4.0, 2.0, 100, 0), # Always want the flat 7
-						(instrument_melody_notes[5], 6.0, 2.0, 100, 0),
-						(instrument_melody_notes[6], 8.0, 4.0, 100, 0),
-					)
-				case 13:
-					# Main theme variant
-					instrument_melody_notes = adjust_melody_to_proper_octave(
-						notes=['0', '7', '7', '7', '4'],
-						base_note=base_note,
-						scale_mode_notes=scale_notes,
-						chord_base_note=chord_base_note,
-						chord_notes=chord_variation_notes,
-						override_scale_mode_notes=override_scale_mode_notes,
-						key_offset=key_offset
-					)
-					notes = (
-						(instrument_melody_notes[0], 0.0, 1.0, 100, 0), 
-						(instrument_melody_notes[1], 1.0, 1.0, 100, 0), 
-						(instrument_melody_notes[2], 2.0, 1.0, 100, 0), 
-						(instrument_melody_notes[3], 3.0, 1.0, 100, 0), 
-						(instrument_melody_notes[4], 4.0, 3.0, 100, 0), 
-					)
-				case 14:
-					# Seikilos epitaph (measure #5)
-					instrument_melody_notes = adjust_melody_to_proper_octave(
-						notes=['0', '4', '7', '5', '4', '5', '4'],
-						base_note=base_note,
-						scale_mode_notes=scale_notes,
-						chord_base_note=chord_base_note,
-						chord_notes=chord_variation_notes,
-						override_scale_mode_notes=override_scale_mode_notes,
-						key_offset=key_offset
-					)
-					notes = (
-						(instrument_melody_notes[0], 1.0, 1.0, 100, 0), 
-						(instrument_melody_notes[1], 2.0, 1.0, 100, 0), 
-						(instrument_melody_notes[2], 3.0, 1.0, 100, 0), 
-						(instrument_melody_notes[3], 4.0, 1.0, 100, 0),
-						(instrument_melody_notes[4], 5.0, 1.0, 100, 0),
-						(instrument_melody_notes[5], 6.0, 1.0, 100, 0),
-						(instrument_melody_notes[6], 7.0, 3.0, 100, 0),
-					)
-				case 15:
-					# Main theme
-					instrument_melody_notes = adjust_melody_to_proper_octave(
-						notes=['0', '5', '7', '12', '10', '7', '5', '7'],
-						base_note=base_note,
-						scale_mode_notes=scale_notes,
-						chord_base_note=chord_base_note,
-						chord_notes=chord_variation_notes,
-						override_scale_mode_notes=override_scale_mode_notes,
-						key_offset=key_offset,
-						ignore_notes=[10]
-					)
-					notes = (
-						(instrument_melody_notes[0], 0.0, 1.0, 100, 0), 
-						(instrument_melody_notes[1], 1.0, 1.0, 100, 0), 
-						(instrument_melody_notes[2], 2.0, 1.0, 100, 0), 
-						(instrument_melody_notes[3], 3.0, 1.0, 100, 0), # Always want the flat 7
-						(instrument_melody_notes[4], 4.0, 1.0, 100, 0),
-						(instrument_melody_notes[5], 5.0, 2.0, 100, 0),
-						(instrument_melody_notes[6], 7.0, 1.0, 100, 0),
-						(instrument_melody_notes[7], 8.0, 3.0, 100, 0),
-					)
-
-			# Add the melody's notes and play them
-			op(instrument_name).SetNotes(notes=notes)
-			op(instrument_name).par.Fireclip.pulse()
-
-def generate_chord_variant(chord, chord_variation, scale_mode, grab_random_variant = False):
+		store('active_melody', str(melody_number))
+
+		# Adjust the melody to the current key, chord and scale mode, then lay it out in the clip
+		melody = theory.melodies[melody_number]
+		instrument_melody_notes = adjust_melody_to_proper_octave(
+			notes=melody['notes'],
+			base_note=base_note,
+			scale_mode_notes=scale_notes,
+			chord_base_note=chord_base_note,
+			chord_notes=chord_variation_notes,
+			override_scale_mode_notes=override_scale_mode_notes,
+			key_offset=key_offset,
+			ignore_notes=melody['ignore_notes']
+		)
+		notes = tuple((instrument_melody_notes[i] + octave_shift, start, length, MELODY_VELOCITY, 0) for i, start, length, octave_shift in melody['rhythm'])
+
+		# Add a counter-line under (or over) it, from the chord that's playing
+		notes += counter_melody_generator.counter_notes(notes, chord_mask, scale_mask, base_note)
+
+		# Add the melody's notes (unless the clip already has them) and play them
+		write_melody_clip(instrument_name, notes)
+		get_scheduler().schedule(0, instrument_name, 'fireclip')
+
+	return melody_number if should_trigger_melody and melody_instruments else None
+
+def generate_chord_variant(chord, chord_variation, scale_mode, grab_random_variant = False, new_variation = None):
 	"""Generates the notes for a new chord variant, based on a given chord and scale mode.
 
 	Args:
@@ -617,36 +268,35 @@ def generate_chord_variant(chord, chord_variation, scale_mode, grab_random_varia
 		chord_variation (str): A chord variation to play (sus2, dim, etc.)
 		scale_mode (str): The current scale mode of the song (dorian, lydian, etc.)
 		grab_random_variant (bool, optional): Should we grab a random variation, or should we follow the transitional variants? Defaults to False.
+		new_variation (str, optional): A variation to use instead of choosing one, like a build-up's planned one. Defaults to None.
 
 	Returns:
 		multiple:
 			- list[int]: The notes of the chord variant, above a given root (0)
 			- str: the name of the new variation
 	"""
-	# Choose a chord variant based on the specified parameter
-	if grab_random_variant == True:
-		# Choose a random chord variation
-		new_variation_row = chord_variations_table.cell(random.randint(1, chord_variations_table.numRows - 1), 0).row
-	else:
-		# Grab a transition chord variation
-		possible_transitions = chord_variations_table[chord_variations_table.findCell(chord_variation, caseSensitive=True).row, 'Possible Transition Variations'].val.split(',')
-		new_variation_row = chord_variations_table.findCell(random.choice(possible_transitions), caseSensitive=True).row
+	# Choose a chord variant based on the specified parameter (unless we were given one)
+	if new_variation is None:
+		if grab_random_variant == True:
+			# Choose a random chord variation
+			new_variation = theory.chord_variation_names[random.randint(0, len(theory.chord_variation_names) - 1)]
+		else:
+			# Grab a transition chord variation
+			new_variation = random.choice(theory.chord_variations[chord_variation]['transitions'])
 	
 	# Get the new variation and update its note in it
-	new_variation = chord_variations_table[new_variation_row, 'Chord Variation'].val
-	new_variation_notes = chord_variations_table[new_variation_row, 'Notes Above Root'].val.split(',')
-	new_variation_notes = chord_variations_table[new_variation_row, 'Notes Above Root'].val.split(',')
-	new_variation_type = chord_variations_table[new_variation_row, 'Type'].val
-	storage.store('chord_variation', new_variation)
+	new_variation_notes = theory.chord_variations[new_variation]['notes']
+	new_variation_type = theory.chord_variations[new_variation]['type']
+	store('chord_variation', new_variation)
 	
 	# Get the necessary props for adjusting the chord to a given scale
-	scale_notes = scale_notes_table[scale_notes_table.findCell(scale_mode, caseSensitive=True).row, 'Notes'].val.split(',')
-	chord_base_note = min(int(note) for note in chord_table[chord_table.findCell(chord, caseSensitive=True).row, 'Notes Above Root'].val.split(','))
-	chord_type = chord_table[chord_table.findCell(chord, caseSensitive=True).row, 'Type'].val
-	chord_variation_notes = chord_variations_table[chord_variations_table.findCell(chord_variation, caseSensitive=True).row, 'Notes Above Root'].val.split(',')
+	scale_notes = theory.scale_notes[scale_mode]
+	chord_base_note = theory.chords[chord]['base_note']
+	chord_type = theory.chords[chord]['type']
+	chord_variation_notes = theory.chord_variations[chord_variation]['notes']
 
 	# Adjust the notes of the chord to the given scale mode and/or chord
-	override_scale_mode_notes = new_variation_type != 'major' and new_variation_type != 'suspended' and new_variation_type != 'dominant' and chord_type not in ['II', 'III', 'VI', 'VII']
+	override_scale_mode_notes = should_override_scale_mode_notes(new_variation_type, chord_type)
 	new_notes = adjust_to_chord_in_scale_mode(
 		notes=new_variation_notes,
 		scale_mode_notes=scale_notes,
@@ -658,104 +308,208 @@ def generate_chord_variant(chord, chord_variation, scale_mode, grab_random_varia
 
 	return new_notes, new_variation
 
-def change_notes_for_scene(current_chord_notes, new_chord_notes, key, instruments, scene):
-	"""Changes the notes of a set of instruments to match the chord's notes. Has code for smooth transitions of notes.
+def get_role_groups(instruments, current_scene, next_scene):
+	"""Gets the melody and percussion instruments of the audible scenes, grouping them the first time the scenes play together.
 
 	Args:
-		current_chord_notes (list[str]): The old (previous) notes that were played in a chord, in positions above a root (0).
-		new_chord_notes (list[str]): The new notes that were played in a chord, in positions above a root (0).
-		key (str): The current key of the song.
-		instruments (Dictionary of Instruments): A Dictionary of Instruments for a given scene.
-		scene (str): The current scene (day, evening, etc.)
-	"""
-	# Get the offset for the key
-	key_offset = keys_table[keys_table.findCell(key, caseSensitive=True).row, 'Offset']
+		instruments (dictionary of Instruments): Every instrument, grouped by scene.
+		current_scene (str): The current scene.
+		next_scene (str): The upcoming scene.
 
-	# For each instrument:
-	new_instruments = {}
-	for instrument_name, instrument_props in instruments.items():
-		# Get the MIDI notes that should play in the given key, chord, etc.
-		new_chord = []
+	Returns:
+		multiple:
+			- dict: The melody instruments of both scenes
+			- dict: The percussion instruments of both scenes
+	"""
+	global role_groups_instruments
+	if instruments is not role_groups_instruments:
+		role_groups.clear()
+		role_groups_instruments = instruments
+
+	groups = role_groups.get((current_scene, next_scene))
+	if groups is None:
+		audible_instruments = instruments[current_scene] | instruments[next_scene]
+		groups = tuple(
+			{instrument_name: instrument_props for instrument_name, instrument_props in audible_instruments.items() if instrument_props.instrument_role == role}
+			for role in ('melody', 'percussion')
+		)
+		role_groups[(current_scene, next_scene)] = groups
+	return groups
+
+def store(storage_key, value):
+	"""Writes a value to storage, counting the write."""
+	storage.store(storage_key, value)
+	get_metrics().storage_writes.inc(storage_key)
+
+def get_metrics():
+	"""Gets the driver's metrics out of storage, making one (and serving it) if it's not there yet."""
+	metrics = storage.fetch('driver_metrics', None)
+	if metrics is None:
+		metrics = DriverMetrics()
+		metrics.start()
+		storage.store('driver_metrics', metrics)
+		metrics.storage_writes.inc('driver_metrics')
+	return metrics
+
+def get_scheduler():
+	"""Gets the event scheduler from storage, making it if it doesn't exist yet.
 
-		# ===== Determine notes
-		# If a bass, just switch to the root note
-		if instrument_props.instrument_role == 'bass':
-			new_chord = normalize_notes([min([int(note) for note in new_chord_notes])])
-		
-		# If it's a melody, we handle that separately, so just add it back to instruments and call it a day
-		elif instrument_props.instrument_role == 'melody':
-			new_instrument_props = instrument_props
-			new_instrument_props.num_voices = 0 # Should be 0 on item already, but force to 0 for safely
-			new_instruments[instrument_name] = Instrument(**vars(new_instrument_props))
-			continue
+	Returns:
+		EventScheduler: The scheduler that the frame tick dispatches events from.
+	"""
+	scheduler = storage.fetch('event_scheduler', None)
+	if scheduler is None:
+		num_voices = sum(instrument_props['num_voices'] for scene_instruments in theory.roster.values() for instrument_props in scene_instruments.values())
+		scheduler = EventScheduler(max_events_per_frame_for(num_voices))
+		store('event_scheduler', scheduler)
+	return scheduler
+
+def get_history_writer():
+	"""Gets the history writer out of storage, making one if it's not there yet."""
+	history_writer = storage.fetch('history_writer', None)
+	if history_writer is None:
+		# The song state columns use the song state's codes, so only the change types need a vocabulary
+		history_writer = HistoryWriter(HISTORY_DIR, vocabularies={'change_type': ['key', 'chord', 'chord variation', 'none']})
+		store('history_writer', history_writer)
+	return history_writer
+
+def get_theory_reloader():
+	"""Gets the theory reloader out of storage, making (and starting) one if it's not there yet."""
+	theory_reloader = storage.fetch('theory_reloader', None)
+	if theory_reloader is None:
+		theory_reloader = TheoryReloader(REFERENCE_DATA_DIR, theory.source_hash)
+		theory_reloader.start()
+		store('theory_reloader', theory_reloader)
+	return theory_reloader
+
+def get_build_up_planner():
+	"""Gets the build-up planner out of storage, making one if it's not there yet."""
+	build_up_planner = storage.fetch('build_up_planner', None)
+	if build_up_planner is None:
+		build_up_planner = BuildUpPlanner()
+		store('build_up_planner', build_up_planner)
+	return build_up_planner
+
+def get_musical_clock():
+	"""Gets the musical clock out of storage, making one if it's not there yet (with everything due)."""
+	musical_clock = storage.fetch('musical_clock', None)
+	if musical_clock is None:
+		musical_clock = MusicalClock()
+		store('musical_clock', musical_clock)
+	return musical_clock
+
+def get_counter_melody_generator():
+	"""Gets the counter-melody generator (and its cache of counter-lines) out of storage, making one if it's not there yet."""
+	counter_melody_generator = storage.fetch('counter_melody_generator', None)
+	if counter_melody_generator is None:
+		counter_melody_generator = CounterMelodyGenerator()
+		store('counter_melody_generator', counter_melody_generator)
+	return counter_melody_generator
+
+def get_beat_budget():
+	"""Gets the beat's budget out of storage, making one if it's not there yet."""
+	beat_budget = storage.fetch('beat_budget', None)
+	if beat_budget is None:
+		beat_budget = BeatBudget(get_metrics())
+		store('beat_budget', beat_budget)
+	return beat_budget
+
+def get_state_snapshots():
+	"""Gets the state snapshots out of storage, making them if they're not there yet."""
+	state_snapshots = storage.fetch('state_snapshots', None)
+	if state_snapshots is None:
+		state_snapshots = StateSnapshots()
+		store('state_snapshots', state_snapshots)
+	return state_snapshots
+
+def get_instrument_op(instrument_name):
+	"""Gets the OP for an instrument, caching the lookup for later beats.
 
-		# If it's percussion, we also handle it separately
-		elif instrument_props.instrument_role == 'percussion':
-			new_instrument_props = instrument_props
-			new_instruments[instrument_name] = Instrument(**vars(new_instrument_props))
-			continue
+	Args:
+		instrument_name (str): The name of the instrument (and its OP).
 
-		# If it's SFX, just make sure it's playing if it's not
-		elif instrument_props.instrument_role == 'sfx':
-			new_instrument_props = instrument_props
-			new_instruments[instrument_name] = Instrument(**vars(new_instrument_props))
+	Returns:
+		OP: The TDAbleton OP of the instrument.
+	"""
+	instrument_op = instrument_ops.get(instrument_name)
+	if instrument_op is None or not instrument_op.valid:
+		instrument_op = op(instrument_name)
+		instrument_ops[instrument_name] = instrument_op
+	return instrument_op
 
-			# Only play the clip if it's not currently playing (via a hacky way of getting if the clip is playing LOL)
-			if op(instrument_name + '/out1')['song/_' + instrument_name.replace("_", " ").title().replace(" ", "_") + '/__clip__/0/playing_position'] <= 0:
-				# If it's a randomly-triggered clip (manually set bc I'm lazy), then do a chance before kicking it off
-				if instrument_name == 'owl_hoots' and random.randint(0, 2) == 0:
-					op(instrument_name).par.Fireclip.pulse()
-				elif instrument_name != 'owl_hoots':
-					op(instrument_name).par.Fireclip.pulse()
+def change_notes_for_scene(harmonic_plan, instruments):
+	"""Changes the notes of a set of instruments to match the chord's notes. Has code for smooth transitions of notes.
 
-			continue
+	Args:
+		harmonic_plan (HarmonicPlan): The beat's harmonic step, shared by every audible scene.
+		instruments (Dictionary of Instruments): A Dictionary of Instruments for a given scene.
+	"""
+	scheduler = get_scheduler()
 
-		# Else, we actually care about notes
-		else:
-			current_notes = normalize_notes(current_chord_notes[:instrument_props.num_voices])
-			target_notes = normalize_notes(new_chord_notes[:instrument_props.num_voices])
-			for i, note in enumerate(current_notes):
-				# While we have notes to voice-lead on:
-				if target_notes:
-					closest_note, original = find_closest_note(current_notes[i], target_notes)
-					new_chord.append(note - (note % 12) + closest_note)
-					target_notes.remove(original)  # Remove the original target note to prevent reuse
-				else:
-					break  # No more target notes to match
-			new_chord.extend(target_notes)  # Add remaining target notes if any
-
-		new_instrument_notes = []
-		for note in new_chord:
-			new_instrument_notes.append(str(instrument_props.base_note + int(note) + int(key_offset))) # For example, 60 + 5 would 65, so F
-
-		# ===== Trigger the new MIDI messages
-		current_instrument_notes = instrument_props.playing_notes
-		# Find notes to turn off (in current_chord but not in new_chord)
-		notes_to_off = [note for note in current_instrument_notes if note not in new_instrument_notes]
+	# Work out the notes of all the bass, chord and effects instruments as one batch, then schedule the new MIDI messages
+	# Notes are released on the pulse, and the new ones roll in slightly staggered across the instruments
+	entry_step = 0
+	for instrument_name, notes_to_off, notes_to_on, new_instrument_notes in plan_scene_notes(instruments, harmonic_plan):
 		for note in notes_to_off:
-			op(instrument_name).SendMIDI('note', int(note), 0)
+			scheduler.schedule(0, instrument_name, 'note', (int(note), 0), PRIORITY_NOTE_OFF)
+		if notes_to_on:
+			entry_offset = (entry_step % CHORD_ENTRY_STAGGER_STEPS) * CHORD_ENTRY_STAGGER_BEATS
+			for note in notes_to_on:
+				scheduler.schedule(entry_offset, instrument_name, 'note', (int(note), 100), PRIORITY_NOTE_ON)
+			entry_step += 1
 
- 		# Find notes to turn on (in new_chord but not in current_chord)
-		notes_to_on = [note for note in new_instrument_notes if note not in current_instrument_notes]
-		for note in notes_to_on:
-			op(instrument_name).SendMIDI('note', int(note), 100)
+		instruments[instrument_name].playing_notes = new_instrument_notes
 
-		# Add the new instrument object
-		new_instrument_props = instrument_props
-		new_instrument_props.playing_notes = new_instrument_notes
-		new_instruments[instrument_name] = Instrument(**vars(new_instrument_props))
-	
-	# Store the new values in the dictionary
-	base_instruments = storage.fetch('instruments', {}) # We need to get the updated values from other scenes, so we have to directly fetch this from storage instead of passing in as a prop
-	storage.store('instruments', base_instruments | {
-		scene: new_instruments
-	})
+def refire_sfx(instruments):
+	"""Fires the SFX clips of a scene that have stopped playing.
+
+	Args:
+		instruments (Dictionary of Instruments): A Dictionary of Instruments for a given scene.
+	"""
+	scheduler = get_scheduler()
+
+	# If it's SFX, just make sure it's playing if it's not (melodies and percussion are handled separately)
+	for instrument_name, instrument_props in instruments.items():
+		if instrument_props.instrument_role != 'sfx':
+			continue
+
+		# Only play the clip if it's not currently playing (via a hacky way of getting if the clip is playing LOL)
+		position_channel = sfx_position_channels.get(instrument_name)
+		if position_channel is None:
+			position_channel = (instrument_name + '/out1', 'song/_' + instrument_name.replace("_", " ").title().replace(" ", "_") + '/__clip__/0/playing_position')
+			sfx_position_channels[instrument_name] = position_channel
+		clip_position = op(position_channel[0])[position_channel[1]]
+		sfx_clip_positions[instrument_name] = clip_position
+		if clip_position <= 0:
+			# If it's a randomly-triggered clip (manually set bc I'm lazy), then do a chance before kicking it off
+			if instrument_name == 'owl_hoots' and sfx_random.randint(0, 2) == 0:
+				scheduler.schedule(sfx_random.uniform(0, SFX_MAX_OFFSET_BEATS), instrument_name, 'fireclip')
+			elif instrument_name != 'owl_hoots':
+				scheduler.schedule(sfx_random.uniform(0, SFX_MAX_OFFSET_BEATS), instrument_name, 'fireclip')
 
 # endregion
 
 # region Main Functions
 
 def onOffToOn(channel, sampleIndex, val, prev):
+	# If a shadow driver's running, it replays this beat later from the same random state (saved before the beat's budget starts)
+	shadow_engine = storage.fetch('shadow_engine', None)
+	random_state = random.getstate() if shadow_engine is not None else None
+
+	beat_start = time.perf_counter()
+
+	# Everything after the harmony only runs if the beat has time for it (see beat_budget)
+	beat_budget = get_beat_budget()
+	beat_budget.start(beat_start)
+
+	# Move musical time to this pulse, so everything below is scheduled relative to it, and count down to the next changes
+	get_scheduler().on_pulse(absTime.seconds)
+	musical_clock = get_musical_clock()
+	musical_clock.tick()
+	# Reseed the optional stages' own generators, before anything can be shed
+	melody_random.seed(random.getrandbits(32))
+	sfx_random.seed(random.getrandbits(32))
+
 	# Get the current props of the song
 	key = storage.fetch('key', 'C')
 	scale_mode = storage.fetch('scale_mode', 'ionian')
@@ -764,70 +518,147 @@ def onOffToOn(channel, sampleIndex, val, prev):
 	current_notes = storage.fetch('chord_notes', ['0', '4', '7'])
 	scenes = storage.fetch('scenes', {})
 
+	# Swap in the rebuilt theory if the tables were edited, as long as the song's current state is still in them
+	global theory
+	new_theory = get_theory_reloader().take(lambda new_theory: key in new_theory.keys and scale_mode in new_theory.scale_notes and chord in new_theory.chords and chord_variation in new_theory.chord_variations)
+	if new_theory is not None:
+		theory = new_theory
+		register_theory(theory)
+
 	new_notes = []
-	chord_resolution_type = chord_variations_table[chord_variations_table.findCell(chord_variation, caseSensitive=True).row, 'Tension / Resolution'].val
+	chord_resolution_type = theory.chord_variations[chord_variation]['resolution']
+	previous_key_offset = theory.keys[key]['offset'] # What the playing notes are voiced in, so a key change can keep the ones it shares
 
 	# Do any scene-related music controls, which may have changed during time of day operation
-	current_scene = storage.fetch('current_scene', 'day')
+	# The Compound_Timer decides the current scene (as it also drives the sky and the OSC cues), so the time of day engine's
+	# clock is kept in step with it
+	current_scene = storage.fetch('current_scene', START_SCENE)
+	show_start_seconds = storage.fetch('show_start_seconds', 0)
+	show_seconds = time_of_day_engine.follow(current_scene, absTime.seconds - show_start_seconds)
+	if show_seconds != absTime.seconds - show_start_seconds:
+		store('show_start_seconds', absTime.seconds - show_seconds)
+	last_beat_show_seconds = storage.fetch('last_beat_show_seconds', None)
+	store('last_beat_show_seconds', show_seconds)
+
 	current_scene_info = scenes[current_scene]
 	next_scene = current_scene_info.next_scene_name
+	previous_scene = previous_scene_names.get(current_scene, current_scene)
+
+	# React to the gain thresholds the time of day engine crossed since the last beat
+	crossings = time_of_day_engine.crossings_between(last_beat_show_seconds, show_seconds) if last_beat_show_seconds is not None else []
+	for crossing in crossings:
+		# The current scene's done transitioning once it's nearly at full volume
+		if crossing.rising and crossing.threshold == FULL_GAIN and crossing.scene == current_scene:
+			store('settled_scene', current_scene)
+	is_transitioning_scenes = storage.fetch('settled_scene', current_scene) != current_scene
+
+	# Every other scene that's faded out gets silenced, once, even if the beat it faded on was missed or its cleanup never
+	# ran (the current and next scenes are played to again, so they'll need silencing again when they fade)
+	# The timer's moved on from the scene after a scene by the time that scene's faded out, however long the real crossfade
+	# is, so that's what's waited for. Only once the roster's timings are the timer's are the engine's fades trusted to
+	# say it sooner
+	silenced_scenes = storage.fetch('silenced_scenes', set())
+	if current_scene in silenced_scenes or next_scene in silenced_scenes:
+		silenced_scenes = silenced_scenes - {current_scene, next_scene}
+		store('silenced_scenes', silenced_scenes)
+	faded_scenes = {
+		scene_name for scene_name in scenes
+		if scene_name != current_scene and scene_name != next_scene and scene_name != previous_scene and scene_name not in silenced_scenes
+	}
+	if TIMINGS_MATCH_TIMER:
+		faded_scenes.update(
+			crossing.scene for crossing in crossings
+			if not crossing.rising and crossing.threshold == AUDIBLE_GAIN and crossing.scene != current_scene and crossing.scene != next_scene and crossing.scene not in silenced_scenes
+		)
 
 	if not current_scene_info.scale_mode == scale_mode:
 		# Update the global storage and local variables
 		new_scale_mode = current_scene_info.scale_mode
-		storage.store('scale_mode', new_scale_mode)
+		store('scale_mode', new_scale_mode)
 		scale_mode = new_scale_mode
 
 	# Get the instruments we're working with
 	instruments = storage.fetch('instruments', {})
-	current_scene_instruments = instruments[current_scene]
-	next_scene_instruments = instruments[next_scene]
+	melody_instruments, percussion_instruments = get_role_groups(instruments, current_scene, next_scene)
+
+	# In the last few beats before a scene transition, build up to it instead of wandering (the planner
+	# falls back to the usual random walk if it runs out of time)
+	build_up_step = None
+	if last_beat_show_seconds is not None and show_seconds > last_beat_show_seconds:
+		build_up_step = get_build_up_planner().step(
+			theory=theory,
+			chord=chord,
+			chord_variation=chord_variation,
+			show_seconds=show_seconds,
+			seconds_to_transition=time_of_day_engine.time_to_next_transition(show_seconds),
+			beat_seconds=show_seconds - last_beat_show_seconds,
+		)
 
-	# If we should change keys...
-	if key_change_driver['pulse'] <= 0:
-		# Reset the value of the OP
-		key_change_driver.par.resetvalue = random.randint(20, 40)
-		key_change_driver.par.resetpulse.pulse()
+	# If we should change keys (which waits until after a build-up, so it doesn't undo it)...
+	if musical_clock.key.is_due() and build_up_step is None:
+		# Start counting down to the next one
+		musical_clock.key.reset()
 
 		# Grab a new key and scale mode, based on the mood and key change limitations
-		current_key_row = keys_table.findCell(key, caseSensitive=True).row
-		new_key = keys_table[current_key_row, 'Common Key Change Keys'].val.split(',')[random.randint(0, 3)]
+		new_key = theory.keys[key]['key_changes'][random.randint(0, 3)]
 		# Update the global storage and local variables
-		storage.store('key', new_key)
+		store('key', new_key)
 		key = new_key
 
 		new_scale_mode = current_scene_info.scale_mode
 		# Update the global storage and local variables
-		storage.store('scale_mode', new_scale_mode)
+		store('scale_mode', new_scale_mode)
 		scale_mode = new_scale_mode
 
 		# Grab the new notes of the I chord in the new key
-		scale_notes = scale_notes_table[scale_notes_table.findCell(scale_mode, caseSensitive=True).row, 'Notes'].val.split(',')
-		new_notes = [scale_notes[0], scale_notes[2], scale_notes[4]] # Always I, but intended to that way
+		scale_notes = theory.scale_notes[scale_mode]
+		new_notes = [scale_notes[0], scale_notes[2], scale_notes[4]] # Always I, but intended to that way (the instruments keep their common tones when voicing it, see lead_across_keys)
 		# Update the global storage and local variables
-		storage.store('chord_variation', 'major triad')
+		store('chord_variation', 'major triad')
 		chord_variation = 'major triad'
-		storage.store('chord', 'I')
+		store('chord', 'I')
 		chord = 'I'
 		
 		# Specify we changed keys
 		change_type = "key"
 
+	# Else, if we're building up to a transition, take the planned step
+	elif build_up_step is not None:
+		if build_up_step.move == 'chord':
+			store('chord', build_up_step.chord)
+			chord = build_up_step.chord
+
+		plain_variation = theory.chords[chord]['type'] + ' triad'
+		if build_up_step.move == 'chord' and build_up_step.chord_variation == plain_variation:
+			# Land on the chord's plain notes, like a chord change without a variant
+			new_notes = theory.chords[chord]['notes']
+			store('chord_variation', plain_variation)
+			chord_variation = plain_variation
+		else:
+			new_chord_variant_info = generate_chord_variant(
+				chord=chord,
+				chord_variation=chord_variation,
+				scale_mode=scale_mode,
+				new_variation=build_up_step.chord_variation,
+			)
+			new_notes = new_chord_variant_info[0]
+			chord_variation = new_chord_variant_info[1]
+
+		# Specify what we changed
+		change_type = "chord" if build_up_step.move == 'chord' else "chord variation"
+
 	# Else, check if we should change chords
-	elif change_chord_driver['pulse'] <= 0 and chord_resolution_type != 'tension':
-		# Reset the value
-		change_chord_driver.par.resetvalue = random.randint(0, 3)
-		change_chord_driver.par.resetpulse.pulse()
+	elif musical_clock.chord.is_due() and chord_resolution_type != 'tension':
+		# Start counting down to the next one
+		musical_clock.chord.reset()
 
 		# Grab a transition chord
-		possible_transitions = chord_table[chord_table.findCell(chord, caseSensitive=True).row, 'Common Transitions'].val.split(',')
-		new_chord_row = chord_table.findCell(random.choice(possible_transitions), caseSensitive=True).row
-		new_chord = chord_table[new_chord_row, 'Chord'].val
-		new_chord_notes = chord_table[new_chord_row, 'Notes Above Root'].val.split(',')
-		chord_type = chord_table[new_chord_row, 'Type'].val
+		new_chord = random.choice(theory.chords[chord]['transitions'])
+		new_chord_notes = theory.chords[new_chord]['notes']
+		chord_type = theory.chords[new_chord]['type']
 
 		# Update the global storage and local variables
-		storage.store('chord', new_chord)
+		store('chord', new_chord)
 		chord = new_chord
 		new_notes = new_chord_notes
 
@@ -844,14 +675,16 @@ def onOffToOn(channel, sampleIndex, val, prev):
 			new_notes = new_chord_variant_info[0]
 			chord_variation = new_chord_variant_info[1]
 		else:
-			storage.store('chord_variation', chord_type + ' triad')
+			store('chord_variation', chord_type + ' triad')
 			chord_variation = 'major triad'
 
 		# Specify we changed chord
 		change_type = "chord"
 		
 	# Else, shift to a possible variation
-	else:
+	elif musical_clock.variation.is_due():
+		musical_clock.variation.reset()
+
 		# Grab a transition chord variation
 		new_chord_variant_info = generate_chord_variant(
 			chord=chord,
@@ -864,51 +697,93 @@ def onOffToOn(channel, sampleIndex, val, prev):
 		# Specify we changed chord variation
 		change_type = "chord variation"
 
-	# Handle changing notes based on updated information for the current and next scene
-	change_notes_for_scene(
-		current_chord_notes=current_notes,
-		new_chord_notes=new_notes,
-		key=key,
-		instruments=current_scene_instruments,
-		scene=current_scene,
-	)
-	change_notes_for_scene(
-		current_chord_notes=current_notes,
-		new_chord_notes=new_notes,
-		key=key,
-		instruments=next_scene_instruments,
-		scene=next_scene
-	)
+	# Else, hold the chord for this beat
+	else:
+		new_notes = current_notes
+		change_type = "none"
+
+	# Work out the harmonic step once, then hand it to the current and next scene (and store the instruments once for both)
+	harmonic_plan.reset(current_notes, new_notes, theory.keys[key]['offset'], previous_key_offset)
+	change_notes_for_scene(harmonic_plan=harmonic_plan, instruments=instruments[current_scene])
+	if next_scene != current_scene:
+		change_notes_for_scene(harmonic_plan=harmonic_plan, instruments=instruments[next_scene])
+	store('instruments', instruments)
+
+	# Make sure the SFX are still playing
+	beat_budget.run('sfx', refire_sfx, instruments[current_scene])
+	if next_scene != current_scene:
+		beat_budget.run('sfx', refire_sfx, instruments[next_scene])
 	
-	# Possibly trigger a melody
-	melody_instruments = {key: value for key, value in current_scene_instruments.items() if value.instrument_role == 'melody'} | {key: value for key, value in next_scene_instruments.items() if value.instrument_role == 'melody'} # Prolly a better way of doing this
-	trigger_melody(
-		melody_instruments=melody_instruments,
-		chord=chord,
-		chord_variation=chord_variation,
-		key=key,
-		scale_mode=scale_mode,
-		scene=current_scene,
-	)
-
-	# Also possibly trigger the percussion
-	if change_type != "chord variation":
-		percussion_instruments = {key: value for key, value in current_scene_instruments.items() if value.instrument_role == 'percussion'} | {key: value for key, value in next_scene_instruments.items() if value.instrument_role == 'percussion'} # Prolly a better way of doing this
-		trigger_percussion(percussion_instruments=percussion_instruments)
-
-	# If the scene isn't running, kill all the instruments in it
-	# Kill any straggler instruments
-	kill_instruments(
-		instruments=instruments,
-		current_scene=current_scene,
-		next_scene=next_scene,
-	)
+	# Possibly trigger a melody, if it's time for a new one (or, if the beat's out of time, skip it, leaving the clips as they are)
+	if not musical_clock.melody.is_due():
+		active_melody = storage.fetch('active_melody', 'none')
+		melody_number = None if active_melody == 'none' else int(active_melody)
+	elif beat_budget.should_run('melody'):
+		musical_clock.melody.reset()
+		melody_number = trigger_melody(
+			melody_instruments=melody_instruments,
+			chord=chord,
+			chord_variation=chord_variation,
+			chord_notes=new_notes,
+			key=key,
+			scale_mode=scale_mode,
+			scene=current_scene_info,
+			is_transitioning_scenes=is_transitioning_scenes,
+		)
+		beat_budget.finished('melody')
+	else:
+		store('active_melody', 'none')
+		melody_number = None
+
+	# Also possibly trigger the percussion, on the bigger changes
+	percussion_triggered = False
+	if change_type in ("key", "chord") and musical_clock.percussion.is_due():
+		musical_clock.percussion.reset()
+		percussion_triggered = trigger_percussion(percussion_instruments=percussion_instruments)
+
+	# If the scene faded out, kill all the instruments in it (they can't be heard, so this can wait for a later frame)
+	if faded_scenes:
+		beat_budget.run('cleanup', kill_faded_scenes, faded_scenes)
+		store('silenced_scenes', silenced_scenes | faded_scenes)
 	
 	# Update the new variant + notes after the transition happens
-	storage.store('chord_notes', new_notes)
+	store('chord_notes', new_notes)
 
 	# Update the chord history table
 	chord_history.appendRow([scale_mode, key, chord, chord_variation], 0)
+	if chord_history.numRows > CHORD_HISTORY_MAX_ROWS + 1:
+		chord_history.deleteRow(chord_history.numRows - 1)
+
+	# Pack the beat's song state into one word for the exporter and the history (with the variation that was stored, which
+	# a chord change without a variant doesn't keep in chord_variation)
+	song_state = pack(key, scale_mode, chord, storage.fetch('chord_variation'), current_scene, melody_number)
+	store('song_state', song_state)
+
+	# Publish the finished beat for the exporter (and anything else reading between beats), rather than letting them read the instruments above
+	snapshot = get_state_snapshots().publish(song_state, instruments)
+
+	# Log the beat to the columnar history (which writes a segment out every so often), or later if the beat's out of time
+	beat_budget.run('history', get_history_writer().append, time.time(), song_state, change_type, percussion_triggered)
+
+	metrics = get_metrics()
+	metrics.beats.inc()
+	beat_seconds = time.perf_counter() - beat_start
+	metrics.beat_seconds.observe(beat_seconds)
+
+	# Queue the beat for the shadow driver, which replays it at the end of a frame (see shadow_engine)
+	if shadow_engine is not None:
+		shadow_engine.capture(LiveBeat(
+			seconds=absTime.seconds,
+			random_state=random_state,
+			clip_positions=dict(sfx_clip_positions),
+			show_start_seconds=storage.fetch('show_start_seconds', 0),
+			current_scene=current_scene,
+			song_state=song_state,
+			snapshot=snapshot,
+			live_seconds=beat_seconds,
+			stages_shed=beat_budget.stages_shed,
+			stage_decisions=tuple(beat_budget.decisions),
+		))
 
 	return
 
@@ -0,0 +1,173 @@
+import argparse
+import multiprocessing
+import sys
+import time
+from collections import Counter
+
+from beat_engine import AllNotesOff, BeatEngine, ClipStop, HarmonyChange, MelodyClip, NoteOff, NoteOn, PercussionHit, SfxFire
+from event_ring import DEFAULT_RING_NAME, EventRing, RingConsumer
+from simulated_td import DEFAULT_PULSE_SECONDS
+
+# Out-of-process music engine.
+#
+# Runs the generator in its own Python process, on its own clock, so TouchDesigner hitches
+# can't delay the music. It consumes the beat stream from beat_engine, and publishes each
+# event into a shared-memory event ring when it's due, as the messages the instrument OPs
+# take, along with every change to the song state and playing notes the OSC exporter
+# reads. In the project, engine_event_consumer drains the ring each frame and forwards the
+# events to the real OPs (with the Beat CHOP Execute DAT and the scheduler tick turned off).
+#
+# Usage:
+#   python music_engine.py [--ring futerra_events]    Run the engine until stopped
+#   python music_engine.py --check [--seconds 60]     Run it in a child process against a local consumer, and report the counters
+
+# region Constants
+
+CONSUMER_FRAME_RATE = 60 # How often the local consumer drains the ring
+
+# endregion
+
+class MusicEngine:
+	# Props
+	ring: EventRing
+	beat_engine: BeatEngine
+	published_state: int # The last song state word published, so only changes go out
+	published_notes: dict # The last playing notes published per instrument
+	published_clips: dict # The last notes written to each melody clip, so a refire doesn't rewrite them
+
+	# Methods
+	def __init__(self, ring: EventRing, seed: int = None, pulse_seconds: float = DEFAULT_PULSE_SECONDS, log_history: bool = True, hot_reload: bool = True):
+		self.ring = ring
+		self.published_state = None
+		self.published_notes = {}
+		self.published_clips = {}
+		self.beat_engine = BeatEngine(seed=seed, pulse_seconds=pulse_seconds, deadlines=True) # Live, so it keeps the wall-clock deadlines like the project
+
+		# Log the history to the project's history folder, like the driver does in TouchDesigner (rather than a temp folder)
+		if log_history:
+			self.beat_engine.show.storage.store('history_writer', None)
+
+		# Watch the reference tables for edits, like the driver does in TouchDesigner (rather than keeping them fixed)
+		if hot_reload:
+			self.beat_engine.show.storage.store('theory_reloader', None)
+
+	def publish_state(self, harmony, playing_notes):
+		"""Publishes whatever song state and playing notes changed since the last beat."""
+		# The OSC exporter only reads the song state word, so the whole state is one comparison and one event
+		if harmony.song_state != self.published_state:
+			self.published_state = harmony.song_state
+			self.ring.publish('', 'state', ('song_state', harmony.song_state))
+
+		for instrument_name, notes in playing_notes.items():
+			if self.published_notes.get(instrument_name) != notes:
+				self.published_notes[instrument_name] = notes
+				self.ring.publish(instrument_name, 'playing_notes', notes)
+
+	def publish_event(self, event):
+		"""Publishes an instrument event as the messages its OP takes."""
+		match event:
+			case NoteOn() | PercussionHit():
+				self.ring.publish(event.instrument_name, 'midi', ('note', event.pitch, event.velocity))
+			case NoteOff():
+				self.ring.publish(event.instrument_name, 'midi', ('note', event.pitch, 0))
+			case AllNotesOff():
+				self.ring.publish(event.instrument_name, 'midi', ('flush',))
+				self.ring.publish(event.instrument_name, 'clearchop')
+			case MelodyClip():
+				if self.published_clips.get(event.instrument_name) != event.notes:
+					self.published_clips[event.instrument_name] = event.notes
+					if event.notes:
+						self.ring.publish(event.instrument_name, 'set_notes', event.notes)
+					else:
+						self.ring.publish(event.instrument_name, 'remove_notes')
+				self.ring.publish(event.instrument_name, 'fireclip')
+			case SfxFire():
+				self.ring.publish(event.instrument_name, 'fireclip')
+			case ClipStop():
+				self.ring.publish(event.instrument_name, 'stopclip')
+
+	def run(self, seconds=None):
+		"""Runs the engine in real time, publishing every event of the beat stream when it's due.
+
+		Args:
+			seconds (float, optional): How long to run for. Defaults to forever.
+		"""
+		start = time.monotonic()
+
+		try:
+			for beat in self.beat_engine.beats():
+				if seconds is not None and beat.seconds >= seconds:
+					break
+
+				for event in beat.events:
+					time.sleep(max(0.0, event.seconds - (time.monotonic() - start)))
+					if isinstance(event, HarmonyChange):
+						self.publish_state(event, beat.playing_notes)
+					else:
+						self.publish_event(event)
+		finally:
+			# Write out what's left of the history, like a music reset does
+			history_writer = self.beat_engine.show.storage.fetch('history_writer')
+			if history_writer is not None:
+				history_writer.flush()
+
+def run_engine(ring_name, seconds, seed, pulse_seconds):
+	"""Runs an engine against an existing ring (the entry point of the child process in --check)."""
+	ring = EventRing.attach(ring_name)
+	try:
+		MusicEngine(ring, seed, pulse_seconds, log_history=False, hot_reload=False).run(seconds)
+	finally:
+		ring.close()
+
+def check(ring_name, seconds, seed, pulse_seconds):
+	"""Runs the engine in a child process and drains it locally like TouchDesigner would, then reports the counters.
+
+	Returns:
+		multiple:
+			- dict: The consumer's stats
+			- int: The exit code of the engine process
+	"""
+	ring = EventRing.create(ring_name)
+	consumer = RingConsumer(ring)
+	messages = Counter()
+
+	engine_process = multiprocessing.Process(target=run_engine, args=(ring_name, seconds, seed, pulse_seconds))
+	engine_process.start()
+	try:
+		while engine_process.is_alive():
+			consumer.drain(lambda instrument_name, message, args: messages.update((message,)))
+			time.sleep(1 / CONSUMER_FRAME_RATE)
+		consumer.drain(lambda instrument_name, message, args: messages.update((message,)))
+	finally:
+		engine_process.join()
+		stats = consumer.stats()
+		ring.close()
+
+	print(f'messages: {dict(messages)}')
+	return stats, engine_process.exitcode
+
+def main():
+	parser = argparse.ArgumentParser(description='Run the music engine out of process, publishing into a shared-memory event ring.')
+	parser.add_argument('--ring', default=DEFAULT_RING_NAME, help='the name of the shared-memory ring')
+	parser.add_argument('--check', action='store_true', help='run against a local consumer and report the counters')
+	parser.add_argument('--seconds', type=float, default=None, help='how long to run for (defaults to forever, or 60 with --check)')
+	parser.add_argument('--seed', type=int, default=None)
+	parser.add_argument('--pulse-seconds', type=float, default=DEFAULT_PULSE_SECONDS, help='time between beat pulses')
+	args = parser.parse_args()
+
+	if args.check:
+		stats, exit_code = check(args.ring, args.seconds or 60, args.seed, args.pulse_seconds)
+		print(f'ring: {stats}')
+		sys.exit(1 if exit_code or stats['dropped'] or stats['pending'] else 0)
+
+	ring = EventRing.create(args.ring)
+	print(f'publishing to {args.ring}, stop with Ctrl+C')
+	try:
+		MusicEngine(ring, args.seed, args.pulse_seconds).run(args.seconds)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		ring.close()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,98 @@
+import random
+from typing import Dict, Tuple
+
+# The musical clock: countdowns, in beats, for when each part of the song changes next.
+#
+# The key and chord changes used to be timed by countdown CHOPs (key_change_driver and
+# change_chord_driver), which the beat callback polled, then reset by writing a random
+# value to their parameters and pulsing them. Now the clock lives in storage next to the
+# song state, and the beat callback ticks it once at the start of every beat, so the timing
+# is plain Python: the same seed always gives the same changes, with or without
+# TouchDesigner, and nothing's written to any parameters.
+#
+# A countdown is due once it's counted down to 0. When the part it times changes, it's
+# reset to wait a random number of beats from its range, like the CHOPs were. A part that
+# can't change when it's due (like a chord change on a tension variation) stays due, and
+# changes on the first beat it can.
+#
+# The clock is just a few ints, so it can be saved and restored with to_dict/from_dict.
+
+# region Constants
+
+# (fewest, most) beats each part waits after it changes. A part with a single value doesn't use the random generator
+KEY_CHANGE_BEATS = (20, 40)
+CHORD_CHANGE_BEATS = (0, 3) # 0 and 1 both mean the next beat
+VARIATION_CHANGE_BEATS = (1, 1) # Every beat the key and chord don't change
+MELODY_BEATS = (1, 1) # Every beat (whether a melody plays is still a coin toss)
+PERCUSSION_BEATS = (1, 1) # Every beat with a key or chord change (whether it hits is still a coin toss)
+
+COUNTDOWN_BEATS: Dict[str, Tuple[int, int]] = {
+	'key': KEY_CHANGE_BEATS,
+	'chord': CHORD_CHANGE_BEATS,
+	'variation': VARIATION_CHANGE_BEATS,
+	'melody': MELODY_BEATS,
+	'percussion': PERCUSSION_BEATS,
+}
+
+# endregion
+
+class Countdown:
+	# Props
+	name: str
+	beats: Tuple[int, int] # (fewest, most) beats to wait after a reset
+	remaining: int # Beats until it's due (0 or below once it is)
+
+	# Methods
+	def __init__(self, name: str, beats: Tuple[int, int], remaining: int = 0):
+		self.name = name
+		self.beats = beats
+		self.remaining = remaining
+
+	def tick(self):
+		self.remaining -= 1
+
+	def is_due(self):
+		return self.remaining <= 0
+
+	def reset(self):
+		"""Starts counting down again, from a random number of beats in the countdown's range."""
+		fewest, most = self.beats
+		self.remaining = fewest if fewest == most else random.randint(fewest, most)
+
+class MusicalClock:
+	# Props
+	beat: int # Beats ticked since the clock was made
+	key: Countdown
+	chord: Countdown
+	variation: Countdown
+	melody: Countdown
+	percussion: Countdown
+
+	# Methods
+	def __init__(self, beat: int = 0, remaining: Dict[str, int] = None):
+		self.beat = beat
+		remaining = remaining or {}
+		for name, beats in COUNTDOWN_BEATS.items():
+			setattr(self, name, Countdown(name, beats, remaining.get(name, 0)))
+
+	def tick(self):
+		"""Moves the clock on a beat. Meant to be called once at the start of every beat."""
+		self.beat += 1
+		self.key.tick()
+		self.chord.tick()
+		self.variation.tick()
+		self.melody.tick()
+		self.percussion.tick()
+
+	def to_dict(self):
+		"""Gets the clock as plain data, like for saving it with the song state.
+
+		Returns:
+			dict: The beat, and the beats remaining on each countdown.
+		"""
+		return {'beat': self.beat, 'remaining': {name: getattr(self, name).remaining for name in COUNTDOWN_BEATS}}
+
+	@classmethod
+	def from_dict(cls, data):
+		"""Makes a clock from what to_dict() gave."""
+		return cls(data['beat'], data['remaining'])
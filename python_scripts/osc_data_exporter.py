@@ -1,3 +1,7 @@
+from melodies import MAIN_MELODY_NUMBERS, MELODIES
+from song_state import codes
+from state_snapshots import read_snapshot
+
 # me - this DAT
 # 
 # frame - the current frame
@@ -7,99 +11,72 @@
 
 # region OPs
 song_data = op('song_data')
-morning_instrument_data = op('morning_instrument_data')
-day_instrument_data = op('day_instrument_data')
-evening_instrument_data = op('evening_instrument_data')
-night_instrument_data = op('night_instrument_data')
 storage = op('storage_op')
 
+# Each scene's instrument channels go in its own Constant CHOP, <scene>_instrument_data, which is made next to this DAT
+# if a new scene doesn't have one yet (merge it into the OSC out with the others to send it)
+INSTRUMENT_DATA_SUFFIX = '_instrument_data'
+
 # endregion
 
 # region Helper Maps and Arrays
-key_map = {
-    'C': 0,
-    'C#': 1,
-    'D': 2,
-    'D#': 3,
-    'E': 4,
-    'F': 5,
-    'F#': 6,
-    'G': 7,
-    'G#': 8,
-    'A': 9,
-    'A#': 10,
-    'B': 11
-}
-
-scale_mode_map = {
-	'lydian': 0,
-	'ionian': 1,
-	'mixolydian': 2,
-	'dorian': 3
-}
-
-current_scene_map = {
-	'morning': 0,
-	'day': 1,
-	'evening': 2,
-	'night': 3
-}
-
-chord_map = {
-	'I': 0,
-	'ii': 1,
-	'iii': 2,
-	'IV': 3,
-	'V': 4,
-	'vi': 5,
-	'vii*': 6,
-	'VI': 78,
-	'VII': 9,
-	'II': 10,
-	'III': 11
-}
-
-chord_variation_map = {
-    'major triad': 0,
-    'minor triad': 1,
-    'diminished triad': 2,
-    'augmented triad': 3,
-    'sus2': 4,
-    'sus4': 5,
-    '6': 6,
-    'dominant 7': 7,
-    'major 7': 8,
-    'half-diminished 7': 9,
-    'diminished 7': 10,
-    'add9': 11
-}
-
-active_melody_map = {
-	'none': 0,
-	# Main melody
-	'3': 1,
-	'7': 1,
-	'11': 1,
-	'15': 1,
-	# Time-dependent melodies
-	'0': 2,
-	'1': 3,
-	'2': 4,
-	'4': 5,
-	'5': 6,
-	'6': 7,
-	'8': 8,
-	'9': 9,
-	'10': 10,
-	'12': 11,
-	'13': 12,
-	'14': 13
-}
+
+# What each active melody goes out as, by its song state code (the melody number + 1). No melody is 0, the main
+# melody is 1 whichever of its copies is playing, and the others count up from 2
+melody_export_codes = [0]
+next_melody_export_code = 2
+for melody_number in range(max(MELODIES) + 1):
+	if melody_number in MAIN_MELODY_NUMBERS:
+		melody_export_codes.append(1)
+	else:
+		melody_export_codes.append(next_melody_export_code)
+		next_melody_export_code += 1
 
 items_to_pull = ['key', 'scale_mode', 'chord', 'chord_variation', 'current_scene', 'active_melody']
 
 # endregion
 
+# The version of the last snapshot sent, as the channels only need rewriting when the driver publishes a new one
+exported_version = None
+
+# Scene name -> (CHOP, the instruments its channels were laid out for, the value parameter of each channel)
+scene_channels = {}
+
+# Scene name -> the scene snapshot last sent, so scenes that haven't changed are skipped
+exported_scenes = {}
+
+def get_scene_channels(scene):
+	"""Gets a scene's CHOP and the value parameters of its channels, laying the channels out when its instruments change.
+
+	Args:
+		scene (SceneSnapshot): The scene, from the driver's snapshot.
+
+	Returns:
+		multiple:
+			- OP: The scene's Constant CHOP
+			- list[str]: The value parameter of each channel, in instrument and voice order
+	"""
+	channels = scene_channels.get(scene.name)
+	if channels is not None and channels[1] is scene.instruments and channels[0].valid:
+		return channels[0], channels[2]
+
+	scene_op = op(scene.name + INSTRUMENT_DATA_SUFFIX)
+	if scene_op is None:
+		scene_op = me.parent().create(constantCHOP, scene.name + INSTRUMENT_DATA_SUFFIX)
+
+	# One channel per voice of every instrument
+	channel_names = [instrument_name + '_note' + str(note + 1) for instrument_name, num_voices in scene.instruments for note in range(num_voices)]
+	if scene_op.seq.const.numBlocks < len(channel_names):
+		scene_op.seq.const.numBlocks = len(channel_names)
+	value_names = []
+	for i, channel_name in enumerate(channel_names):
+		scene_op.par['const' + str(i) + 'name'] = channel_name
+		value_names.append('const' + str(i) + 'value')
+
+	scene_channels[scene.name] = (scene_op, scene.instruments, value_names)
+	exported_scenes.pop(scene.name, None)
+	return scene_op, value_names
+
 def onStart():
 	return
 
@@ -110,20 +87,31 @@ def onExit():
 	return
 
 def onFrameStart(frame):
-	# For each item, get information from the storage and set the appropriate OP for OSC export
-	for i, item in enumerate(items_to_pull):
-		storage_val = storage.fetch(item)
-		song_data.par['const' + str(i) + 'name'] = item
-		song_data.par['const' + str(i) + 'value'] = globals()[item + '_map'][storage_val]
-
-	# For each instrument, make a channel for its data
-	storage_instrument_data = storage.fetch('instruments', {})
-	for scene_name, scene_data in storage_instrument_data.items():
+	global exported_version
+
+	# Read everything from the driver's latest snapshot (see state_snapshots), never the instruments it's changing
+	snapshot = read_snapshot(storage)
+	if snapshot.version == exported_version:
+		return
+	exported_version = snapshot.version
+
+	# Send each of the song state's codes as it is (the melody grouped, see melody_export_codes)
+	key, scale_mode, chord, chord_variation, current_scene, active_melody = codes(snapshot.song_state)
+	for i, value in enumerate((key, scale_mode, chord, chord_variation, current_scene, melody_export_codes[active_melody])):
+		song_data.par['const' + str(i) + 'name'] = items_to_pull[i]
+		song_data.par['const' + str(i) + 'value'] = value
+
+	# For each instrument, fill in its channels with the notes it's holding (only for the scenes that changed)
+	for scene in snapshot.scenes:
+		scene_op, value_names = get_scene_channels(scene)
+		if exported_scenes.get(scene.name) is scene:
+			continue
+		exported_scenes[scene.name] = scene
+
 		i = 0
-		for instrument_name, instrument_props in scene_data.items():
-			for note in range(instrument_props.num_voices):
-				globals()[scene_name + '_instrument_data'].par['const' + str(i) + 'name'] = instrument_name + '_note' + str(note + 1)
-				globals()[scene_name + '_instrument_data'].par['const' + str(i) + 'value'] = instrument_props.playing_notes[note] if note < len(instrument_props.playing_notes) else 0
+		for (instrument_name, num_voices), playing_notes in zip(scene.instruments, scene.playing_notes):
+			for note in range(num_voices):
+				scene_op.par[value_names[i]] = playing_notes[note] if note < len(playing_notes) else 0
 				i += 1
 
 	return
@@ -0,0 +1,36 @@
+# me - this DAT
+#
+# dat - the changed DAT
+# rows - a list of row indices
+# cols - a list of column indices
+# cells - the list of cells that have changed content
+# prev - the list of previous string contents of the changed cells
+#
+# Make sure the corresponding toggle is enabled in the DAT Execute DAT.
+#
+# If rows or columns are deleted, sizeChange will be called instead of row/col/cellChange.
+#
+# Watches the reference table DATs (scale_notes, keys, chords and chord_variations) for
+# edits, and hands their text to the driver's theory reloader (see theory_reloader), which
+# writes it out to the TSV each one mirrors, then checks and swaps in the rebuilt theory like
+# it does for a TSV edit. Put the four DATs in this DAT Execute's DATs parameter.
+
+storage = op('storage_op')
+
+def onTableChange(dat):
+	theory_reloader = storage.fetch('theory_reloader', None)
+	if theory_reloader is not None:
+		theory_reloader.offer_table(dat.name + '.tsv', dat.text)
+	return
+
+def onRowChange(dat, rows):
+	return
+
+def onColChange(dat, cols):
+	return
+
+def onCellChange(dat, cells, prev):
+	return
+
+def onSizeChange(dat):
+	return
@@ -0,0 +1,248 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+import wave
+
+import numpy as np
+
+from beat_engine import BeatEngine, played_notes
+from simulated_td import DEFAULT_PULSE_SECONDS
+from theory import load_theory
+from time_of_day_engine import TimeOfDayEngine
+
+# Offline audio preview of the generated music, without Ableton.
+#
+# Consumes the beat stream from beat_engine (note ons and offs, melody clips, clip fires
+# and stops), turns it into a list of notes, then renders them with simple additive
+# synthesis, one voice design per instrument role (pads, bass, bells, melody, percussion,
+# sfx). Every instrument is scaled by its scene's gain from the time-of-day engine, like
+# the mixer does in the project.
+#
+# Rendering goes in fixed-size blocks of samples, and the show is split into segments of
+# whole blocks that are rendered in parallel by a pool of processes, then streamed into
+# the WAV in order. Nothing depends on what came before a block (the synthesis is computed
+# from absolute time), so the segments line up seamlessly.
+#
+# Usage: python render_preview.py [--seconds N] [--output preview.wav] [--sample-rate 22050] [--processes N] [--seed 0]
+
+# region Constants
+
+REFERENCE_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'reference_data')
+
+DEFAULT_SAMPLE_RATE = 22050
+BLOCK_SIZE = 4096 # Samples per block
+BLOCKS_PER_SEGMENT = 64 # Blocks per segment handed to a worker process (about 12 seconds at 22050 Hz)
+
+MASTER_GAIN = 0.6
+SFX_CLIP_SECONDS = 6.0 # SFX clips are samples we don't have, so each fire plays a noise swell this long
+SFX_PARTIALS = 24
+
+# Note columns
+START, END, PITCH, VELOCITY, ROLE, SCENE, SEED = range(7)
+
+# Voice design for each role: partials as (frequency ratio, amplitude, decay per second), then the envelope and level
+VOICES = {
+	'chords': {'partials': ((1.0, 1.0, 0.0), (1.003, 0.6, 0.0), (2.0, 0.3, 0.0), (3.0, 0.1, 0.0)), 'attack': 1.5, 'release': 2.5, 'gain': 0.05}, # Pads
+	'bass': {'partials': ((1.0, 1.0, 0.0), (2.0, 0.35, 0.0), (3.0, 0.1, 0.0)), 'attack': 0.05, 'release': 0.4, 'gain': 0.18},
+	'effects': {'partials': ((1.0, 1.0, 0.8), (2.76, 0.5, 1.6), (5.40, 0.25, 3.0), (8.93, 0.12, 5.0)), 'attack': 0.005, 'release': 1.5, 'gain': 0.05}, # Bells
+	'melody': {'partials': ((1.0, 1.0, 0.0), (3.0, 0.3, 0.0), (5.0, 0.12, 0.0)), 'attack': 0.03, 'release': 0.3, 'gain': 0.12},
+	'percussion': {'partials': ((1.0, 1.0, 3.0), (1.47, 0.8, 3.5), (2.09, 0.6, 4.0), (2.56, 0.5, 5.0), (3.14, 0.4, 6.0), (4.3, 0.3, 8.0)), 'attack': 0.002, 'release': 2.0, 'gain': 0.06},
+	'sfx': {'partials': (), 'attack': 1.5, 'release': 2.0, 'gain': 0.015}, # Partials are random per note (see sfx_partials)
+}
+ROLES = list(VOICES)
+
+# endregion
+
+# region Notes
+
+def build_notes(beats, roster, scenes, seconds_per_beat, end_seconds):
+	"""Turns the beat stream into note rows for rendering.
+
+	Args:
+		beats (iterable of Beats): The stream, from BeatEngine.beats().
+		roster (dict): The instrument roster, for the role and scene of every instrument.
+		scenes (list[str]): The scenes, in the order the scene column indexes.
+		seconds_per_beat (float): The tempo, for laying out clip notes.
+		end_seconds (float): When the render ends, which is when anything still held stops.
+
+	Returns:
+		np.ndarray: One row per note: start, end, pitch, velocity, role, scene and seed (see the note columns).
+	"""
+	instrument_info = {
+		instrument_name: (ROLES.index(instrument_props['instrument_role']), scenes.index(scene))
+		for scene, scene_instruments in roster.items()
+		for instrument_name, instrument_props in scene_instruments.items()
+		if instrument_props['instrument_role'] in VOICES
+	}
+
+	notes = [
+		[note.start, note.end, note.pitch, note.velocity, *instrument_info[note.instrument_name], note_index]
+		for note_index, note in enumerate(played_notes(beats, seconds_per_beat, end_seconds, SFX_CLIP_SECONDS))
+		if note.instrument_name in instrument_info
+	]
+	return np.array(notes, dtype=np.float64).reshape(-1, 7)
+
+# endregion
+
+# region Synthesis
+
+def note_frequency(pitch):
+	return 440.0 * 2.0 ** ((pitch - 69) / 12)
+
+def sfx_partials(seed):
+	"""Makes the partials of an sfx swell: a random cluster of quiet sines, fixed per note so every block agrees."""
+	rng = np.random.default_rng(int(seed))
+	ratios = rng.uniform(200.0, 3000.0, SFX_PARTIALS) # Absolute frequencies, as sfx notes have no pitch
+	return tuple(zip(ratios, rng.uniform(0.3, 1.0, SFX_PARTIALS), np.zeros(SFX_PARTIALS)))
+
+def render_note(note, sample_times):
+	"""Renders one note over a block.
+
+	Args:
+		note (np.ndarray): The note row.
+		sample_times (np.ndarray): The show time of every sample in the block.
+
+	Returns:
+		np.ndarray: The note's samples.
+	"""
+	voice = VOICES[ROLES[int(note[ROLE])]]
+	note_times = sample_times - note[START]
+	length = note[END] - note[START]
+
+	# Linear attack, then a linear release once the note ends
+	envelope = np.clip(note_times / voice['attack'], 0.0, 1.0) * np.clip(1.0 - (note_times - length) / voice['release'], 0.0, 1.0)
+	envelope *= note_times >= 0
+
+	if ROLES[int(note[ROLE])] == 'sfx':
+		fundamental, partials = 1.0, sfx_partials(note[SEED])
+		envelope *= 0.6 + 0.4 * np.sin(2 * np.pi * 0.2 * note_times) # Slow swell
+	else:
+		fundamental, partials = note_frequency(note[PITCH]), voice['partials']
+
+	samples = np.zeros(len(sample_times))
+	for ratio, amplitude, decay in partials:
+		partial = amplitude * np.sin(2 * np.pi * fundamental * ratio * note_times)
+		if decay:
+			partial *= np.exp(-decay * np.maximum(note_times, 0.0))
+		samples += partial
+
+	return samples * envelope * (note[VELOCITY] / 127) * voice['gain']
+
+def render_block(notes, release_ends, block_start, sample_rate, engine, scenes):
+	"""Renders one block of the preview.
+
+	Args:
+		notes (np.ndarray): Every note.
+		release_ends (np.ndarray): When each note has fully faded out.
+		block_start (int): The index of the block's first sample.
+		sample_rate (int): Samples per second.
+		engine (TimeOfDayEngine): For the scene gains.
+		scenes (list[str]): The scenes, in the order the scene column indexes.
+
+	Returns:
+		np.ndarray: The block's samples.
+	"""
+	sample_times = (block_start + np.arange(BLOCK_SIZE)) / sample_rate
+	block_start_seconds, block_end_seconds = sample_times[0], sample_times[-1]
+
+	# Scene gains move slowly, so ramp each across the block from its start to its end
+	start_gains = engine.gains(block_start_seconds)
+	end_gains = engine.gains(block_end_seconds)
+	ramp = np.linspace(0.0, 1.0, BLOCK_SIZE)
+
+	block = np.zeros(BLOCK_SIZE)
+	for note in notes[(notes[:, START] <= block_end_seconds) & (release_ends >= block_start_seconds)]:
+		scene = scenes[int(note[SCENE])]
+		if start_gains[scene] == 0 and end_gains[scene] == 0:
+			continue
+		block += render_note(note, sample_times) * (start_gains[scene] + (end_gains[scene] - start_gains[scene]) * ramp)
+
+	return np.tanh(block * MASTER_GAIN) # Soft clip, so blocks never need normalizing against each other
+
+# endregion
+
+# region Workers
+
+worker_state = {}
+
+def init_worker(notes, sample_rate, total_samples, scenes):
+	"""Hands each worker process the notes once, rather than with every segment."""
+	worker_state['notes'] = notes
+	worker_state['release_ends'] = notes[:, END] + np.array([VOICES[ROLES[int(role)]]['release'] for role in notes[:, ROLE]])
+	worker_state['sample_rate'] = sample_rate
+	worker_state['total_samples'] = total_samples
+	worker_state['scenes'] = scenes
+	worker_state['engine'] = TimeOfDayEngine()
+
+def render_segment(segment_index):
+	"""Renders a segment of blocks.
+
+	Args:
+		segment_index (int): Which segment to render.
+
+	Returns:
+		bytes: The segment as 16-bit PCM.
+	"""
+	segment_start = segment_index * BLOCKS_PER_SEGMENT * BLOCK_SIZE
+	segment_end = min(segment_start + BLOCKS_PER_SEGMENT * BLOCK_SIZE, worker_state['total_samples'])
+	blocks = [
+		render_block(worker_state['notes'], worker_state['release_ends'], block_start, worker_state['sample_rate'], worker_state['engine'], worker_state['scenes'])
+		for block_start in range(segment_start, segment_end, BLOCK_SIZE)
+	]
+	samples = np.concatenate(blocks)[:segment_end - segment_start]
+	return (samples * 32767).astype('<i2').tobytes()
+
+# endregion
+
+def render(output_path, seconds, sample_rate, processes, seed, pulse_seconds):
+	"""Renders a preview of the show to a WAV.
+
+	Returns:
+		multiple:
+			- int: How many notes were rendered
+			- float: How long collecting the events took, in seconds
+	"""
+	start = time.perf_counter()
+	theory = load_theory(REFERENCE_DATA_DIR)
+	scenes = list(theory.scenes)
+	engine = BeatEngine(seed=seed, pulse_seconds=pulse_seconds)
+	notes = build_notes(engine.beats(), theory.roster, scenes, engine.seconds_per_beat, seconds)
+	collect_seconds = time.perf_counter() - start
+
+	total_samples = int(seconds * sample_rate)
+	num_segments = -(-total_samples // (BLOCKS_PER_SEGMENT * BLOCK_SIZE))
+	with wave.open(output_path, 'wb') as wav_file, multiprocessing.Pool(processes, initializer=init_worker, initargs=(notes, sample_rate, total_samples, scenes)) as pool:
+		wav_file.setnchannels(1)
+		wav_file.setsampwidth(2)
+		wav_file.setframerate(sample_rate)
+
+		# Segments come back in order, so they can be written as soon as they're ready
+		for segment_index, segment in enumerate(pool.imap(render_segment, range(num_segments))):
+			wav_file.writeframes(segment)
+			print(f'\rrendered {segment_index + 1}/{num_segments} segments', end='', flush=True)
+	print()
+
+	return len(notes), collect_seconds
+
+def main():
+	parser = argparse.ArgumentParser(description='Render an offline audio preview of the generated music.')
+	parser.add_argument('--seconds', type=float, default=TimeOfDayEngine().cycle_seconds, help='show time to render (defaults to one day-night cycle)')
+	parser.add_argument('--output', default='preview.wav')
+	parser.add_argument('--sample-rate', type=int, default=DEFAULT_SAMPLE_RATE)
+	parser.add_argument('--processes', type=int, default=os.cpu_count(), help='worker processes to render segments with')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--pulse-seconds', type=float, default=DEFAULT_PULSE_SECONDS, help='show time between Beat CHOP pulses')
+	args = parser.parse_args()
+
+	start = time.perf_counter()
+	num_notes, collect_seconds = render(args.output, args.seconds, args.sample_rate, args.processes, args.seed, args.pulse_seconds)
+	total_seconds = time.perf_counter() - start
+	print(f'{num_notes} notes from {args.seconds:.0f} s of show time collected in {collect_seconds:.1f} s')
+	print(f'wrote {args.output} in {total_seconds:.1f} s ({args.seconds / total_seconds:.1f}x realtime)')
+	if num_notes == 0:
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
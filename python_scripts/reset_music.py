@@ -7,6 +7,9 @@
 # 
 # Make sure the corresponding toggle is enabled in the CHOP Execute DAT.
 
+from bulk_reset import reset_music
+from state_snapshots import publish_from_storage
+
 storage = op('storage_op')
 event_driver = op('event_driver')
 song_props = op('song_props')
@@ -22,30 +25,17 @@ def onOffToOn(channel, sampleIndex, val, prev):
 	# Also also reset Ableton
 	# song_props.par.Stop.pulse() TODO FIGURE OUT WHY NOT WORKING AS EXPECTED
 
-	# Clear the chord history
-	while chord_history.numRows > 1:
-		chord_history.deleteRow(chord_history.numRows - 1)
-
-	# Kill all the running instruments
-	instruments = storage.fetch('instruments', {})
-	for scene in instruments.values():
-		for instrument_name, instrument_props in scene.items():
-			# print(instrument_name)
-
-			# If a melody, reset its clip
-			if instrument_props.instrument_role == 'melody':
-				# Remove all existing notes
-				op(instrument_name).RemoveNotes(timeStart=0, pitchStart=0, timeEnd=16, pitchEnd=127)
-				op(instrument_name).par.Stopclip.pulse()
-
-			# If it's SFX, reset the clip without doing anything MIDI-wise
-			elif instrument_props.instrument_role == 'sfx':
-				op(instrument_name).par.Stopclip.pulse()
-			
-			# Else, it's MIDI, so reset it
-			else:
-				op(instrument_name).SendMIDI('flush')
-				op(instrument_name).par.Clearchop.pulse()
+	# Clear the schedule and chord history, and kill all the running instruments, keeping how long each part took
+	timings = reset_music(storage, chord_history, op)
+	storage.store('last_reset_timings', timings)
+
+	# Publish the silenced instruments, so the exporter stops sending their notes
+	publish_from_storage(storage)
+
+	# Start the shadow driver (if there's one running) again from the reset song
+	shadow_engine = storage.fetch('shadow_engine', None)
+	if shadow_engine is not None:
+		shadow_engine.resync()
 
 	return
 
@@ -1,3 +1,7 @@
+from roster import START_SCENE
+from song_state import pack_from_storage
+from state_snapshots import publish_from_storage
+
 # me - this DAT
 # 
 # channel - the Channel object which has changed
@@ -12,8 +16,20 @@ timer = op('Compound_Timer')
 d3_osc = op('d3_osc')
 
 def onOffToOn(channel, sampleIndex, val, prev):
-	# Reset to morning on the scene
-	storage.store('current_scene', 'night')
+	# Reset to the first scene of the show
+	storage.store('current_scene', START_SCENE)
+	storage.store('settled_scene', START_SCENE)
+	storage.store('song_state', pack_from_storage(storage))
+	publish_from_storage(storage)
+
+	# Start the shadow driver (if there's one running) again from the reset song
+	shadow_engine = storage.fetch('shadow_engine', None)
+	if shadow_engine is not None:
+		shadow_engine.resync()
+
+	# Restart the show clock that the time of day engine runs from
+	storage.store('show_start_seconds', absTime.seconds)
+	storage.store('last_beat_show_seconds', None)
 	timer.par.Initialize.pulse()
 	timer.par.Start.pulse()
 	op('Compound_Timer/loop_count').par.const0value = 0
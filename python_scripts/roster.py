@@ -0,0 +1,81 @@
+from typing import Dict
+
+# The instruments and scenes of the installation, as plain data.
+#
+# reset_op_storage builds the Instrument and Scene objects in storage from this, and the
+# theory artifact (see build_theory_artifact) compiles it in with the reference tables.
+#
+# Everything else works from these, so adding a scene is adding it here: its instruments,
+# then its entry in SCENES (and pointing the scene before it at it). The time of day engine
+# follows the successors round from START_SCENE, the driver picks melodies from the scene's
+# banks, and the OSC exporter makes channels for however many scenes there are.
+
+# Instruments are grouped by scene, with each instrument being its name and props
+# NOTE: For melody instruments, the base note is treated as the minumum note an instrument can play
+INSTRUMENT_ROSTER: Dict[str, Dict[str, dict]] = {
+	'morning': {
+		"english_horn": {"base_note": 54, "num_voices": 0, "instrument_role": "melody"}, # Melody doesn't follow the typical chain, so we set the notes to 0 for safety + set the base note as the min. possible note
+		"french_horn": {"base_note": 48, "num_voices": 4, "instrument_role": "chords"},
+		"geigan_organ": {"base_note": 60, "num_voices": 4, "instrument_role": "chords"},
+		"morning_bells": {"base_note": 72, "num_voices": 4, "instrument_role": "effects"},
+		"fifth_morning_pad": {"base_note": 48, "num_voices": 1, "instrument_role": "effects"},
+		"morning_sun_pad": {"base_note": 60, "num_voices": 1, "instrument_role": "effects"},
+		"sub_bass_morning": {"base_note": 36, "num_voices": 1, "instrument_role": "bass"},
+		"morning_birds": {"base_note": 0, "num_voices": 0, "instrument_role": "sfx"},
+		"lake_morning": {"base_note": 0, "num_voices": 0, "instrument_role": "sfx"},
+	},
+	'day': {
+		"flute": {"base_note": 69, "num_voices": 0, "instrument_role": "melody"},
+		"strings_hi_day": {"base_note": 72, "num_voices": 1, "instrument_role": "chords"},
+		"church_organ": {"base_note": 60, "num_voices": 4, "instrument_role": "chords"},
+		"chimes": {"base_note": 60, "num_voices": 4, "instrument_role": "effects"},
+		"strings_lo": {"base_note": 24, "num_voices": 1, "instrument_role": "bass"},
+		"harp": {"base_note": 48, "num_voices": 4, "instrument_role": "effects"},
+		"suspended_cymbal": {"base_note": 48, "num_voices": 1, "instrument_role": "percussion"},
+		"day_birds": {"base_note": 0, "num_voices": 0, "instrument_role": "sfx"},
+		"wind_day": {"base_note": 0, "num_voices": 0, "instrument_role": "sfx"},
+		"lake_day": {"base_note": 0, "num_voices": 0, "instrument_role": "sfx"},
+	},
+	'evening': {
+		"brass_ensemble_hi": {"base_note": 36, "num_voices": 0, "instrument_role": "melody"},
+		"strings_hi_evening": {"base_note": 72, "num_voices": 1, "instrument_role": "chords"},
+		"slow_space_pad": {"base_note": 48, "num_voices": 4, "instrument_role": "chords"},
+		"106_organ": {"base_note": 60, "num_voices": 4, "instrument_role": "effects"},
+		"gong": {"base_note": 36, "num_voices": 1, "instrument_role": "percussion"},
+		"sub_bass_evening": {"base_note": 24, "num_voices": 1, "instrument_role": "bass"},
+		"brass_ensemble_lo": {"base_note": 24, "num_voices": 1, "instrument_role": "bass"},
+		"wind_evening": {"base_note": 0, "num_voices": 0, "instrument_role": "sfx"},
+		"lake_evening": {"base_note": 0, "num_voices": 0, "instrument_role": "sfx"},
+	},
+	'night': {
+		"gaelic_voices": {"base_note": 56, "num_voices": 0, "instrument_role": "melody"},
+		"glockenspiel": {"base_note": 72, "num_voices": 1, "instrument_role": "chords"},
+		"reflectere_piano": {"base_note": 48, "num_voices": 4, "instrument_role": "chords"},
+		"dreamer_pad": {"base_note": 48, "num_voices": 4, "instrument_role": "chords"},
+		"that_moment_pad": {"base_note": 48, "num_voices": 4, "instrument_role": "chords"},
+		"warm_space_pad": {"base_note": 48, "num_voices": 4, "instrument_role": "chords"},
+		"meditation_pad": {"base_note": 60, "num_voices": 1, "instrument_role": "effects"},
+		"zen_bowl": {"base_note": 72, "num_voices": 4, "instrument_role": "effects"},
+		"sub_bass_night": {"base_note": 24, "num_voices": 1, "instrument_role": "bass"},
+		"cricket_chirps": {"base_note": 0, "num_voices": 0, "instrument_role": "sfx"},
+		"owl_hoots": {"base_note": 0, "num_voices": 0, "instrument_role": "sfx"},
+		"lake_night": {"base_note": 0, "num_voices": 0, "instrument_role": "sfx"},
+	},
+}
+
+# Reference for scenes
+# The melody bank is what the scene picks its melodies from. While it's still transitioning in, it only picks from the
+# transition bank, the melodies it shares with the scene before it (melodies 3, 7, 11 and 15 are the main melody, so
+# every bank has it). Hold and crossfade are how long the scene plays on its own, then fades into the next one
+SCENES: Dict[str, dict] = {
+	'morning': {"next_scene_name": "day", "scale_mode": "lydian", "melody_bank": [12, 13, 14, 15, 0, 1, 2, 3], "transition_melody_bank": [12, 13, 14, 15], "hold_seconds": 120, "crossfade_seconds": 30},
+	'day': {"next_scene_name": "evening", "scale_mode": "ionian", "melody_bank": [0, 1, 2, 3, 4, 5, 6, 7], "transition_melody_bank": [0, 1, 2, 3], "hold_seconds": 120, "crossfade_seconds": 30},
+	'evening': {"next_scene_name": "night", "scale_mode": "mixolydian", "melody_bank": [4, 5, 6, 7, 8, 9, 10, 11], "transition_melody_bank": [4, 5, 6, 7], "hold_seconds": 120, "crossfade_seconds": 30},
+	'night': {"next_scene_name": "morning", "scale_mode": "dorian", "melody_bank": [8, 9, 10, 11, 12, 13, 14, 15], "transition_melody_bank": [8, 9, 10, 11], "hold_seconds": 120, "crossfade_seconds": 30}, #aeolian
+}
+
+START_SCENE = 'night' # Where the show starts (and restarts, see reset_scene)
+
+# The hold and crossfade times above are placeholders, so the driver doesn't silence a scene on the time of day engine's
+# fades (which could be shorter than the Compound_Timer's). Set this once they're copied from the timer's segments
+TIMINGS_MATCH_TIMER = False
@@ -0,0 +1,415 @@
+import copy
+import random
+import time
+from collections import Counter, deque
+from typing import Deque, NamedTuple
+
+from beat_budget import BeatBudget
+from build_up_planner import BuildUpPlanner
+from counter_melody import CounterMelodyGenerator
+from driver_metrics import DriverMetrics
+from simulated_td import REFERENCE_DATA_DIR, SimulatedClipCHOP, SimulatedTD
+from song_state import codes
+from state_snapshots import EMPTY_SNAPSHOT, StateSnapshot, publish_from_storage, read_snapshot
+from theory_reloader import TheoryReloader
+
+# Shadow mode: a second driver, replaying the live beats to compare against them.
+#
+# To try an algorithm change on a running show without it being heard, the changed driver
+# script runs as a shadow next to the live one. Every live beat hands the shadow what it
+# needs to replay it: the time of the beat and the Compound_Timer's current scene (so the
+# scene volumes the time of day engine works out are the same), the state of the random generator when the beat started (so
+# the shadow makes the same draws), the SFX clip positions it read from Ableton (which
+# decide whether it draws for an SFX refire, and which the shadow's own clips, never having
+# been fired, wouldn't match), and which of its optional stages it ran or shed (so the shadow
+# runs and sheds the same ones, see beat_budget). The shadow replays the beat against its own simulated
+# OP layer, whose instruments only record what they're sent (the in-memory sink), and then
+# its decisions and how long it took are recorded side by side with the live beat's: the
+# song state word (key, scale mode, chord, variation, scene and melody) field by field, and
+# the notes every instrument is holding, from the state snapshots.
+#
+# The shadow never runs in the beat callback. The beat only saves the random state and
+# queues the beat (a few microseconds, before the beat's budget starts), and the frame tick
+# replays it at the end of a frame, after that frame's live beat:
+#   - at most one shadow beat a frame, and only while the shadow's within its share of the
+#     show's time (SHADOW_SHARE, saved up like a token bucket),
+#   - with the live random state put back afterwards, so the live song is the same whether
+#     the shadow's running or not,
+#   - and with anything the shadow raises caught and counted, rather than reaching the tick.
+# If the shadow falls more than MAX_PENDING_BEATS behind, or the live show's reset, its queue
+# is dropped and it starts again from a copy of the live state.
+#
+# The shadow's build-up planner and counter-melody generator have no deadlines, so in the
+# project a live beat whose search ran out of time can still differ from the shadow's.
+#
+# Only the driver script is swapped for the shadow: the modules it imports are shared with
+# the live driver, so a change to one of those should go in a new module the shadow's
+# script imports instead.
+
+# region Constants
+
+SHADOW_SHARE = 0.1 # Of the show's time the shadow can spend replaying beats
+MAX_SAVED_SECONDS = 0.01 # Most the shadow can save up while it's idle, so it can't run long after a quiet spell
+MAX_PENDING_BEATS = 16 # Beats the shadow can fall behind before it starts again from the live state
+MAX_RECORDS = 1024 # The newest compared beats kept, side by side
+MAX_MESSAGES = 1024 # The newest messages the shadow's instruments were sent
+FRAME_TICKS_PER_BEAT = 16 # Frame ticks run between shadow beats, to dispatch what the shadow scheduled
+
+# Storage that makes up the song, copied from the live driver when the shadow starts (the rest, like the scheduler,
+# the beat budget and the caches, the shadow has its own of)
+SYNCED_KEYS = (
+	'key', 'scale_mode', 'chord', 'chord_variation', 'chord_notes', 'active_melody', 'current_scene', 'song_state',
+	'scenes', 'instruments', 'musical_clock', 'show_start_seconds', 'last_beat_show_seconds', 'silenced_scenes',
+	'settled_scene',
+)
+
+SONG_STATE_FIELDS = ('key', 'scale_mode', 'chord', 'chord_variation', 'scene', 'melody') # In the order codes() gives them
+
+# endregion
+
+# region Classes
+
+class LiveBeat(NamedTuple):
+	"""What the live driver hands the shadow for a beat."""
+	seconds: float # absTime of the beat
+	random_state: tuple # Of the random generator when the beat started
+	clip_positions: dict # Instrument name -> the SFX clip position the beat read
+	show_start_seconds: float
+	current_scene: str # What the Compound_Timer said when the beat started
+	song_state: int
+	snapshot: StateSnapshot # What the live beat published
+	live_seconds: float # How long the live beat took
+	stages_shed: int # Stages the live beat shed
+	stage_decisions: tuple # (stage name, whether it ran now) for every turn a stage had in the live beat, for the shadow to repeat
+
+class ShadowBeat(NamedTuple):
+	"""A beat as the live and shadow drivers played it."""
+	beat: int # Beats the shadow's compared
+	seconds: float
+	live_song_state: int
+	shadow_song_state: int
+	differing_fields: tuple # Names of the song state fields that differ
+	differing_instruments: int # Instruments holding different notes
+	live_seconds: float
+	shadow_seconds: float
+	live_shed: bool
+
+class ShadowTD(SimulatedTD):
+	"""The shadow's OP layer, whose clip CHOPs read what the live beat being replayed read."""
+	# Props
+	clip_positions: dict # Instrument name -> clip position, of the live beat being replayed
+
+	# Methods
+	def __init__(self, sink=None):
+		super().__init__(sink=sink)
+		self.clip_positions = {}
+
+	def op(self, name):
+		if name.endswith('/out1') and name not in self.ops:
+			self.ops[name] = ReplayedClipCHOP(self, name, self.op(name[:-len('/out1')]))
+		return super().op(name)
+
+class ReplayedClipCHOP(SimulatedClipCHOP):
+	"""A clip CHOP that gives the live clip position, falling back to the shadow's own clip if the live beat didn't read it."""
+	def __getitem__(self, channel_name):
+		clip_position = self.td.clip_positions.get(self.instrument.name)
+		return super().__getitem__(channel_name) if clip_position is None else clip_position
+
+class ReplayedBeatBudget(BeatBudget):
+	"""A beat budget that runs or sheds each stage like the live beat being replayed did, rather than going by the shadow's own time."""
+	# Props
+	live_decisions: Deque[tuple] # (stage name, whether it ran now) still to repeat, from the live beat
+
+	# Methods
+	def __init__(self, metrics):
+		super().__init__(metrics, frame_budget_seconds=float('inf')) # Deferred stages all run on the next frame, like they had to for the live beat to run the stage again
+		self.live_decisions = deque()
+
+	def has_time_for(self, stage):
+		# A stage the live beat didn't have a turn for (like one only the shadow's script has) always runs
+		if self.live_decisions and self.live_decisions[0][0] == stage.name:
+			return self.live_decisions.popleft()[1]
+		return True
+
+class NullHistoryWriter:
+	"""Stands in for the shadow's history writer, so the shadow doesn't write history segments."""
+	def append(self, timestamp, packed_state, change_type, percussion):
+		return
+
+	def flush(self):
+		return
+
+class ShadowEngine:
+	# Props
+	driver_script: str
+	td: ShadowTD # The shadow's OP layer
+	driver: object # The shadow driver script's globals
+	scheduler_tick: object # The shadow's frame tick script's globals
+	share: float
+	pending: Deque[LiveBeat] # Live beats still to replay, oldest first
+	needs_sync: bool # Whether the shadow has to start again from the live state before it can replay anything
+	saved_seconds: float # Time the shadow can still spend, from its share
+	last_frame_seconds: float # Show time of the last frame, or None
+	last_beat_seconds: float # absTime of the last beat the shadow replayed, or None
+	records: Deque[ShadowBeat]
+	messages: Deque[tuple] # (seconds, instrument_name, message, args) the shadow's instruments were sent, newest last
+	message_counts: Counter # By (instrument_name, message)
+	beats_compared: int
+	beats_differing: int
+	beats_shed_live: int # Compared beats the live driver shed stages in (which the shadow shed too)
+	field_differences: Counter # By song state field
+	instrument_differences: int
+	live_seconds_total: float
+	live_seconds_max: float
+	shadow_seconds_total: float
+	shadow_seconds_max: float
+	skipped_beats: int # Live beats dropped when the shadow fell behind or was starting again
+	syncs: int
+	errors: int # Shadow beats that raised
+	last_error: str
+
+	# Methods
+	def __init__(self, driver_script: str = 'music_driver.py', share: float = SHADOW_SHARE):
+		self.driver_script = driver_script
+		self.share = share
+		self.pending = deque()
+		self.needs_sync = True
+		self.saved_seconds = 0.0
+		self.last_frame_seconds = None
+		self.last_beat_seconds = None
+		self.records = deque(maxlen=MAX_RECORDS)
+		self.messages = deque(maxlen=MAX_MESSAGES)
+		self.message_counts = Counter()
+		self.beats_compared = 0
+		self.beats_differing = 0
+		self.beats_shed_live = 0
+		self.field_differences = Counter()
+		self.instrument_differences = 0
+		self.live_seconds_total = 0.0
+		self.live_seconds_max = 0.0
+		self.shadow_seconds_total = 0.0
+		self.shadow_seconds_max = 0.0
+		self.skipped_beats = 0
+		self.syncs = 0
+		self.errors = 0
+		self.last_error = None
+
+		# Set the shadow up like the simulated show does, but with nothing that leaves the process: no metrics server,
+		# no history segments, and a theory reloader that's never started
+		self.td = ShadowTD(sink=self.on_message)
+		self.td.load_script('reset_op_storage.py').onOffToOn(None, 0, 1, 0)
+		metrics = DriverMetrics()
+		self.storage.store('driver_metrics', metrics)
+		self.storage.store('history_writer', NullHistoryWriter())
+		self.storage.store('theory_reloader', TheoryReloader(REFERENCE_DATA_DIR, None))
+		self.storage.store('beat_budget', ReplayedBeatBudget(metrics))
+		self.storage.store('build_up_planner', BuildUpPlanner(budget_seconds=float('inf'))) # No deadlines, so the shadow's plans don't depend on how busy the frame was
+		self.storage.store('counter_melody_generator', CounterMelodyGenerator(budget_seconds=float('inf')))
+		self.driver = self.td.load_script(driver_script)
+		self.scheduler_tick = self.td.load_script('event_scheduler_tick.py')
+
+	@property
+	def storage(self):
+		return self.td.op('storage_op')
+
+	def on_message(self, seconds, instrument_name, message, args):
+		self.messages.append((seconds, instrument_name, message, args))
+		self.message_counts[instrument_name, message] += 1
+
+	def capture(self, live_beat):
+		"""Queues a live beat for the shadow to replay. Meant to be called by the live driver at the end of every beat.
+
+		Args:
+			live_beat (LiveBeat): The beat.
+		"""
+		if self.needs_sync:
+			self.skipped_beats += 1
+			return
+		if len(self.pending) >= MAX_PENDING_BEATS:
+			# Too far behind to catch up, so start again from wherever the live driver is once the queue's clear
+			self.skipped_beats += len(self.pending) + 1
+			self.pending.clear()
+			self.needs_sync = True
+			return
+		self.pending.append(live_beat)
+
+	def resync(self):
+		"""Drops the queued beats, and starts the shadow again from the live state on the next frame (like after a reset)."""
+		self.skipped_beats += len(self.pending)
+		self.pending.clear()
+		self.needs_sync = True
+
+	def run_pending(self, seconds, live_storage):
+		"""Replays the oldest queued live beat, if the shadow has the time for it. Meant to be called at the end of every frame.
+
+		Args:
+			seconds (float): The show time of the frame (absTime), which the shadow's share is saved up from.
+			live_storage (OP): The live driver's storage, to start the shadow from.
+
+		Returns:
+			ShadowBeat: The compared beat, or None if nothing was replayed.
+		"""
+		# Save up the shadow's share of the time since the last frame
+		if self.last_frame_seconds is not None:
+			self.saved_seconds = min(MAX_SAVED_SECONDS, self.saved_seconds + max(0.0, seconds - self.last_frame_seconds) * self.share)
+		self.last_frame_seconds = seconds
+		if self.saved_seconds < 0:
+			return None
+
+		start = time.perf_counter()
+		record = None
+		if self.needs_sync:
+			self.sync(live_storage)
+		elif self.pending:
+			record = self.replay(self.pending.popleft())
+		self.saved_seconds -= time.perf_counter() - start
+		return record
+
+	def sync(self, live_storage):
+		"""Starts the shadow from a copy of the live driver's song."""
+		for key in SYNCED_KEYS:
+			value = live_storage.fetch(key, None)
+			if value is not None:
+				self.storage.store(key, copy.deepcopy(value))
+
+		# Carry on with any build-up the live driver's part way through (its search graph gets built on the shadow's first beat)
+		live_planner = live_storage.fetch('build_up_planner', None)
+		if live_planner is not None:
+			shadow_planner = self.driver.get_build_up_planner()
+			shadow_planner.plan = list(live_planner.plan)
+			shadow_planner.transition_seconds = live_planner.transition_seconds
+
+		self.storage.fetch('event_scheduler').clear()
+		self.storage.store('melody_clips', {})
+		publish_from_storage(self.storage)
+		self.last_beat_seconds = None
+		self.needs_sync = False
+		self.syncs += 1
+
+	def replay(self, live_beat):
+		"""Replays a live beat on the shadow driver and compares the two.
+
+		Returns:
+			ShadowBeat: The compared beat, or None if the shadow raised.
+		"""
+		# Send the shadow's instruments what it scheduled since its last beat
+		self.tick_frames(live_beat.seconds)
+
+		# Play the beat from the same random state as the live beat did, then put the live state back
+		live_random_state = random.getstate()
+		random.setstate(live_beat.random_state)
+		self.td.absTime.seconds = live_beat.seconds
+		self.td.clip_positions = live_beat.clip_positions
+		self.storage.store('show_start_seconds', live_beat.show_start_seconds)
+		self.storage.store('current_scene', live_beat.current_scene)
+		self.storage.fetch('beat_budget').live_decisions = deque(live_beat.stage_decisions)
+		beat_start = time.perf_counter()
+		try:
+			self.driver.onOffToOn(None, 0, 1, 0)
+		except Exception as error:
+			# Whatever the shadow did is in its own storage, so it's started again rather than carrying on from it
+			self.errors += 1
+			self.last_error = repr(error)
+			self.resync()
+			return None
+		finally:
+			shadow_seconds = time.perf_counter() - beat_start
+			random.setstate(live_random_state)
+		self.last_beat_seconds = live_beat.seconds
+
+		shadow_song_state = self.storage.fetch('song_state')
+		differing_fields = tuple(
+			field for field, live_code, shadow_code in zip(SONG_STATE_FIELDS, codes(live_beat.song_state), codes(shadow_song_state))
+			if live_code != shadow_code
+		)
+		differing_instruments = count_differing_instruments(live_beat.snapshot, read_snapshot(self.storage))
+		record = ShadowBeat(
+			beat=self.beats_compared,
+			seconds=live_beat.seconds,
+			live_song_state=live_beat.song_state,
+			shadow_song_state=shadow_song_state,
+			differing_fields=differing_fields,
+			differing_instruments=differing_instruments,
+			live_seconds=live_beat.live_seconds,
+			shadow_seconds=shadow_seconds,
+			live_shed=live_beat.stages_shed > 0,
+		)
+		self.records.append(record)
+
+		self.beats_compared += 1
+		if differing_fields or differing_instruments:
+			self.beats_differing += 1
+		if record.live_shed:
+			self.beats_shed_live += 1
+		self.field_differences.update(differing_fields)
+		self.instrument_differences += differing_instruments
+		self.live_seconds_total += live_beat.live_seconds
+		self.live_seconds_max = max(self.live_seconds_max, live_beat.live_seconds)
+		self.shadow_seconds_total += shadow_seconds
+		self.shadow_seconds_max = max(self.shadow_seconds_max, shadow_seconds)
+		return record
+
+	def tick_frames(self, until_seconds):
+		"""Runs the shadow's frame tick across the time since its last beat, so its scheduled events reach the sink in order."""
+		if self.last_beat_seconds is None:
+			return
+		gap_seconds = until_seconds - self.last_beat_seconds
+		for i in range(1, FRAME_TICKS_PER_BEAT + 1):
+			self.td.absTime.seconds = self.last_beat_seconds + gap_seconds * i / FRAME_TICKS_PER_BEAT
+			self.scheduler_tick.onFrameStart(0)
+
+	def summary(self):
+		"""Sums up the compared beats so far.
+
+		Returns:
+			dict: The counts of compared, differing and shed beats (with which song state fields differed), the mean and worst
+				latency of the live and shadow beats, and what the shadow skipped, restarted for, raised and sent.
+		"""
+		compared = max(1, self.beats_compared)
+		return {
+			'beats compared': self.beats_compared,
+			'beats differing': self.beats_differing,
+			'beats shed live': self.beats_shed_live,
+			'field differences': dict(self.field_differences),
+			'instrument differences': self.instrument_differences,
+			'live beat ms (mean, max)': (self.live_seconds_total / compared * 1000, self.live_seconds_max * 1000),
+			'shadow beat ms (mean, max)': (self.shadow_seconds_total / compared * 1000, self.shadow_seconds_max * 1000),
+			'pending': len(self.pending),
+			'skipped beats': self.skipped_beats,
+			'syncs': self.syncs,
+			'errors': self.errors,
+			'last error': self.last_error,
+			'messages': sum(self.message_counts.values()),
+		}
+
+# endregion
+
+# region Helper Functions
+
+def count_differing_instruments(live_snapshot, shadow_snapshot):
+	"""Counts the instruments holding different notes in two state snapshots.
+
+	Args:
+		live_snapshot (StateSnapshot): What the live driver published.
+		shadow_snapshot (StateSnapshot): What the shadow driver published.
+
+	Returns:
+		int: How many instruments differ (an instrument only one of them has counts as differing).
+	"""
+	if live_snapshot is EMPTY_SNAPSHOT or shadow_snapshot is EMPTY_SNAPSHOT:
+		return 0
+
+	shadow_scenes = {scene.name: scene for scene in shadow_snapshot.scenes}
+	differing = 0
+	for live_scene in live_snapshot.scenes:
+		shadow_scene = shadow_scenes.get(live_scene.name)
+		if shadow_scene is None:
+			differing += len(live_scene.instruments)
+			continue
+		shadow_notes = {name: notes for (name, _), notes in zip(shadow_scene.instruments, shadow_scene.playing_notes)}
+		for (name, _), notes in zip(live_scene.instruments, live_scene.playing_notes):
+			if shadow_notes.get(name) != notes:
+				differing += 1
+	return differing
+
+# endregion
@@ -0,0 +1,311 @@
+import os
+import random
+import sys
+import tempfile
+from collections import Counter
+from types import SimpleNamespace
+
+from beat_budget import BeatBudget
+from build_up_planner import BuildUpPlanner
+from counter_melody import CounterMelodyGenerator
+from driver_metrics import DriverMetrics
+from history_store import HistoryWriter
+from theory_reloader import TheoryReloader
+from time_of_day_engine import TimeOfDayEngine
+
+# A simulated TouchDesigner OP layer, for running the driver scripts headless.
+#
+# The DAT scripts are executed as-is, with op(), absTime and project swapped for
+# simulated versions: storage and table DATs keep their data in memory, the countdown
+# CHOPs restart when they're reset, and instrument OPs record the MIDI and clip messages
+# they're sent (counting them, and passing them to an optional sink). The driver's own
+# timing comes from the musical clock in storage, which it ticks itself.
+#
+# SimulatedShow wires it all up like the project does: reset_op_storage initializes
+# storage, the Compound_Timer moves the current scene on, every pulse runs the driver's
+# beat callback, and the frame tick dispatches the scheduled events.
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+TOUCHDESIGNER_DIR = os.path.join(SCRIPTS_DIR, '..', 'touchdesigner')
+REFERENCE_DATA_DIR = os.path.join(SCRIPTS_DIR, '..', 'reference_data')
+
+DEFAULT_PULSE_SECONDS = 8.0 # 8 beats at 60 BPM
+CHORD_HISTORY_HEADER = ['scale_mode', 'key', 'chord', 'chord_variation']
+
+# region Simulated OPs
+
+class SimulatedPulse:
+	"""A pulse parameter, which tells its OP when it's pulsed."""
+	def __init__(self, owner, name):
+		self.owner = owner
+		self.name = name
+
+	def pulse(self):
+		self.owner.on_pulse(self.name)
+
+class SimulatedPar:
+	"""Parameters of a simulated OP. Values can be set freely, and anything that's never been set is a pulse."""
+	def __init__(self, owner):
+		object.__setattr__(self, '_owner', owner)
+
+	def __getattr__(self, name):
+		pulse = SimulatedPulse(self._owner, name)
+		object.__setattr__(self, name, pulse)
+		return pulse
+
+class SimulatedOP:
+	def __init__(self, td, name):
+		self.td = td
+		self.name = name
+		self.valid = True
+		self.par = SimulatedPar(self)
+
+	def on_pulse(self, par_name):
+		self.td.count(self.name, 'pulse_' + par_name)
+
+	def sendOSC(self, address, values):
+		self.td.count(self.name, 'osc ' + address)
+
+class SimulatedStorage(SimulatedOP):
+	def __init__(self, td, name):
+		super().__init__(td, name)
+		self.values = {}
+
+	def fetch(self, key, default=None):
+		return self.values.get(key, default)
+
+	def store(self, key, value):
+		self.values[key] = value
+		self.td.count(self.name, 'store')
+
+class SimulatedTable(SimulatedOP):
+	def __init__(self, td, name, header):
+		super().__init__(td, name)
+		self.rows = [list(header)]
+
+	@property
+	def numRows(self):
+		return len(self.rows)
+
+	@property
+	def numCols(self):
+		return len(self.rows[0]) if self.rows else 0
+
+	def appendRow(self, row, index=None):
+		# Like a table DAT, the row goes after the given index (so 0 means right below the header)
+		self.rows.insert(len(self.rows) if index is None else index + 1, [str(cell) for cell in row])
+
+	def deleteRow(self, index):
+		del self.rows[index]
+
+	def setSize(self, num_rows, num_cols):
+		del self.rows[num_rows:]
+
+class SimulatedCountdownCHOP(SimulatedOP):
+	"""A countdown driver CHOP (like the event driver), which restarts from resetvalue when resetpulse is pulsed."""
+	def __init__(self, td, name):
+		super().__init__(td, name)
+		self.par.resetvalue = 0
+		self.value = 0
+
+	def __getitem__(self, channel_name):
+		return self.value
+
+	def on_pulse(self, par_name):
+		super().on_pulse(par_name)
+		if par_name == 'resetpulse':
+			self.value = self.par.resetvalue
+
+class SimulatedInstrument(SimulatedOP):
+	"""A TDAbleton instrument OP, which records what it's sent."""
+	def __init__(self, td, name):
+		super().__init__(td, name)
+		self.clip_playing = False
+
+	def SendMIDI(self, *args):
+		self.td.emit(self.name, 'midi', args)
+
+	def RemoveNotes(self, **kwargs):
+		self.td.emit(self.name, 'remove_notes', ())
+
+	def SetNotes(self, notes):
+		self.td.emit(self.name, 'set_notes', tuple(notes))
+
+	def on_pulse(self, par_name):
+		if par_name == 'Fireclip':
+			self.clip_playing = True
+		elif par_name == 'Stopclip':
+			self.clip_playing = False
+		self.td.emit(self.name, par_name.lower(), ())
+
+class SimulatedClipCHOP(SimulatedOP):
+	"""The output CHOP of an instrument, which only knows whether its clip is playing."""
+	def __init__(self, td, name, instrument):
+		super().__init__(td, name)
+		self.instrument = instrument
+
+	def __getitem__(self, channel_name):
+		return 1.0 if self.instrument.clip_playing else 0.0
+
+class SimulatedCompoundTimer(SimulatedOP):
+	"""The Compound_Timer, with its callbacks storing the current scene as it goes through its segments.
+
+	It runs on its own clock from when it's started (by reset_scene), like the real one, with the roster's segments.
+	"""
+	def __init__(self, td, name):
+		super().__init__(td, name)
+		self.engine = TimeOfDayEngine()
+		self.start_seconds = 0.0
+		self.scene_changes = 0
+
+	def on_pulse(self, par_name):
+		super().on_pulse(par_name)
+		if par_name == 'Start':
+			self.start_seconds = self.td.absTime.seconds
+
+	def update(self):
+		"""Moves the current scene on, if the timer's reached another segment by now."""
+		storage = self.td.op('storage_op')
+		scene = self.engine.current_scene(self.td.absTime.seconds - self.start_seconds)
+		if scene != storage.fetch('current_scene'):
+			storage.store('current_scene', scene)
+			self.scene_changes += 1
+
+# endregion
+
+class SimulatedTD:
+	# Props
+	ops: dict
+	absTime: SimpleNamespace
+	project: SimpleNamespace
+	counts: Counter # Messages by (OP name, message)
+	sink: object # Called with (seconds, instrument_name, message, args) for every instrument message, if set
+
+	# Methods
+	def __init__(self, sink=None):
+		self.ops = {}
+		self.absTime = SimpleNamespace(seconds=0.0)
+		self.project = SimpleNamespace(folder=TOUCHDESIGNER_DIR)
+		self.counts = Counter()
+		self.sink = sink
+
+		if SCRIPTS_DIR not in sys.path:
+			sys.path.insert(0, SCRIPTS_DIR)
+
+	def count(self, op_name, message):
+		self.counts[op_name, message] += 1
+
+	def emit(self, instrument_name, message, args):
+		self.count(instrument_name, message)
+		if self.sink is not None:
+			self.sink(self.absTime.seconds, instrument_name, message, args)
+
+	def op(self, name):
+		"""Gets a simulated OP by name, making it the first time it's asked for."""
+		found = self.ops.get(name)
+		if found is not None:
+			return found
+
+		if name == 'storage_op':
+			found = SimulatedStorage(self, name)
+		elif name == 'chord_history':
+			found = SimulatedTable(self, name, CHORD_HISTORY_HEADER)
+		elif name.endswith('_driver'):
+			found = SimulatedCountdownCHOP(self, name)
+		elif name == 'Compound_Timer':
+			found = SimulatedCompoundTimer(self, name)
+		elif name.endswith('/out1'):
+			found = SimulatedClipCHOP(self, name, self.op(name[:-len('/out1')]))
+		else:
+			found = SimulatedInstrument(self, name)
+		self.ops[name] = found
+		return found
+
+	def load_script(self, file_name):
+		"""Runs a DAT script against the simulated OPs.
+
+		Args:
+			file_name (str): The script's file name in python_scripts, like 'music_driver.py'.
+
+		Returns:
+			SimpleNamespace: The script's globals, so its callbacks can be called.
+		"""
+		path = os.path.join(SCRIPTS_DIR, file_name)
+		with open(path, encoding='utf-8') as script_file:
+			source = script_file.read()
+
+		namespace = {
+			'__name__': 'simulated_' + os.path.splitext(file_name)[0],
+			'__file__': path,
+			'op': self.op,
+			'absTime': self.absTime,
+			'project': self.project,
+		}
+		exec(compile(source, path, 'exec'), namespace)
+		return SimpleNamespace(**namespace)
+
+class SimulatedShow:
+	# Props
+	td: SimulatedTD
+	driver: SimpleNamespace
+	scheduler_tick: SimpleNamespace
+	pulse_seconds: float
+	ticks_per_pulse: int # Frame ticks run per pulse (more ticks time the events more finely)
+	beats: int
+	history_dir: tempfile.TemporaryDirectory # Where the driver's columnar history goes, so runs don't write into the repo
+
+	# Methods
+	def __init__(self, seed=0, pulse_seconds=DEFAULT_PULSE_SECONDS, sink=None, driver_script='music_driver.py', ticks_per_pulse=16, deadlines=False):
+		"""Sets up a show, like the project does on startup.
+
+		Args:
+			deadlines (bool, optional): Whether the beat budget, the build-up planner and the counter-melody generator keep
+				their wall-clock deadlines, like in the project. Without them, a seed always plays the same show, however
+				busy the machine is. Defaults to False.
+		"""
+		random.seed(seed)
+		self.td = SimulatedTD(sink=sink)
+		self.pulse_seconds = pulse_seconds
+		self.ticks_per_pulse = ticks_per_pulse
+		self.beats = 0
+		self.history_dir = tempfile.TemporaryDirectory(prefix='simulated_history_')
+
+		# Initialize storage the same way the project does on startup
+		self.td.load_script('reset_op_storage.py').onOffToOn(None, 0, 1, 0)
+		self.td.load_script('reset_scene.py').onOffToOn(None, 0, 1, 0)
+		self.storage.store('history_writer', HistoryWriter(self.history_dir.name))
+		self.storage.store('theory_reloader', TheoryReloader(REFERENCE_DATA_DIR, None)) # Never started, so the tables don't change under a run
+		self.storage.store('driver_metrics', DriverMetrics()) # Counts, but isn't served, so shows don't fight over the port
+		if not deadlines:
+			self.storage.store('beat_budget', BeatBudget(self.storage.fetch('driver_metrics'), budget_seconds=float('inf')))
+			self.storage.store('build_up_planner', BuildUpPlanner(budget_seconds=float('inf')))
+			self.storage.store('counter_melody_generator', CounterMelodyGenerator(budget_seconds=float('inf')))
+		self.driver = self.td.load_script(driver_script)
+		self.scheduler_tick = self.td.load_script('event_scheduler_tick.py')
+
+	@property
+	def storage(self):
+		return self.td.op('storage_op')
+
+	@property
+	def timer(self):
+		return self.td.op('Compound_Timer')
+
+	def beat(self):
+		"""Runs one Beat CHOP pulse: the driver's beat callback, then the frame ticks until the next pulse."""
+		pulse_start = self.td.absTime.seconds
+		self.pulse()
+		self.tick_frames(pulse_start)
+
+	def pulse(self):
+		"""Runs just the driver's beat callback, at the current time (for callers that run the frame tick on their own clock)."""
+		self.timer.update()
+		self.driver.onOffToOn(None, 0, 1, 0)
+		self.beats += 1
+
+	def tick_frames(self, pulse_start):
+		"""Runs the frame tick across a pulse. Only a few frames are run, which is plenty to dispatch everything in order."""
+		for i in range(1, self.ticks_per_pulse + 1):
+			self.td.absTime.seconds = pulse_start + self.pulse_seconds * i / self.ticks_per_pulse
+			self.scheduler_tick.onFrameStart(0)
+			self.scheduler_tick.onFrameEnd(0)
@@ -0,0 +1,228 @@
+import argparse
+import gc
+import os
+import statistics
+import sys
+import time
+import traceback
+import tracemalloc
+from collections import Counter
+
+from counter_melody import MAX_CACHED_LINES
+from simulated_td import DEFAULT_PULSE_SECONDS, SimulatedShow
+
+# Long-run soak harness for the driver.
+#
+# Runs the driver against the simulated OP layer for weeks of show time at an accelerated
+# clock, sampling traced memory (tracemalloc), live object counts, the size of the state
+# the driver keeps (chord history, schedule, storage) and per-beat latency as it goes.
+# At the end it reports anything that keeps growing or slowing down, with the allocation
+# sites responsible, and exits non-zero if it found any.
+#
+# The capped caches (like the counter-lines) grow until they're full, which isn't a leak, so
+# measuring only starts once they are. A run too short for them to fill (under a day or so)
+# only checks for beat errors.
+#
+# Usage: python soak_harness.py [--days 14] [--pulse-seconds 8] [--samples 60] [--seed 0]
+
+WARMUP_FRACTION = 0.1 # Skip at least the start of the run, while the schedule fills up (and until the capped caches are full)
+MIN_MEMORY_GROWTH_BYTES = 64 * 1024
+MIN_OBJECT_GROWTH = 500
+MIN_STATE_GROWTH = 16
+LATENCY_DRIFT_RATIO = 1.25
+MIN_LATENCY_DRIFT_MS = 0.02
+
+class Sample:
+	# Props
+	beat: int
+	show_days: float
+	traced_bytes: int
+	objects: int
+	state_sizes: dict # The size of every container the driver keeps state in
+	latency_p50_ms: float
+	latency_p99_ms: float
+
+	# Methods
+	def __init__(self, beat: int, show_days: float, traced_bytes: int, objects: int, state_sizes: dict, latency_p50_ms: float, latency_p99_ms: float):
+		self.beat = beat
+		self.show_days = show_days
+		self.traced_bytes = traced_bytes
+		self.objects = objects
+		self.state_sizes = state_sizes
+		self.latency_p50_ms = latency_p50_ms
+		self.latency_p99_ms = latency_p99_ms
+
+def measure_state(show):
+	"""Measures the size of everything the driver keeps between beats."""
+	storage = show.storage
+	scheduler = storage.fetch('event_scheduler')
+	return {
+		'chord_history rows': show.td.op('chord_history').numRows,
+		'scheduled events': len(scheduler.queue) if scheduler is not None else 0,
+		'storage keys': len(storage.values),
+		'melody clips': len(storage.fetch('melody_clips', {})),
+		'instruments': sum(len(scene_instruments) for scene_instruments in storage.fetch('instruments', {}).values()),
+		'playing notes': sum(len(instrument.playing_notes) for scene_instruments in storage.fetch('instruments', {}).values() for instrument in scene_instruments.values()),
+		'simulated ops': len(show.td.ops),
+	}
+
+def measure_capped_caches(show):
+	"""Measures how full the caches the driver caps are.
+
+	Returns:
+		dict[str, tuple[int, int]]: The (size, cap) of every capped cache.
+	"""
+	counter_melody_generator = show.storage.fetch('counter_melody_generator')
+	return {
+		'chord_history rows': (show.td.op('chord_history').numRows - 1, show.driver.CHORD_HISTORY_MAX_ROWS),
+		'counter-melody lines': (len(counter_melody_generator.lines) if counter_melody_generator is not None else 0, MAX_CACHED_LINES),
+	}
+
+def is_growing(values, min_growth):
+	"""Checks a series for steady growth: everything in its second half is above everything in its first half, by enough to matter."""
+	if len(values) < 4:
+		return False
+	half = len(values) // 2
+	return min(values[half:]) > max(values[:half]) and values[-1] - values[0] >= min_growth
+
+def growth_per_day(samples, values):
+	"""Fits a line through a series, returning its slope per day of show time."""
+	days = [sample.show_days for sample in samples]
+	mean_days, mean_values = statistics.mean(days), statistics.mean(values)
+	spread = sum((day - mean_days) ** 2 for day in days)
+	if spread == 0:
+		return 0.0
+	return sum((day - mean_days) * (value - mean_values) for day, value in zip(days, values)) / spread
+
+def run(days, pulse_seconds, num_samples, seed):
+	show = SimulatedShow(seed=seed, pulse_seconds=pulse_seconds)
+	total_beats = int(days * 86400 / pulse_seconds)
+	sample_every = max(1, total_beats // num_samples)
+	warmup_beats = int(total_beats * WARMUP_FRACTION)
+
+	tracemalloc.start()
+	baseline_snapshot = None
+	baseline_types = None
+	samples = []
+	beat_errors = Counter()
+	error_examples = {}
+	latencies_ms = []
+
+	for beat in range(1, total_beats + 1):
+		start = time.perf_counter()
+		try:
+			show.beat()
+		except Exception as error:
+			# TouchDesigner logs callback errors and carries on with the next beat, so do the same
+			site = traceback.extract_tb(error.__traceback__)[-1]
+			key = f'{type(error).__name__} at {os.path.basename(site.filename)}:{site.lineno}'
+			beat_errors[key] += 1
+			error_examples.setdefault(key, str(error))
+			show.tick_frames(show.td.absTime.seconds)
+		latencies_ms.append((time.perf_counter() - start) * 1000)
+
+		if beat % sample_every != 0 or beat < warmup_beats:
+			continue
+
+		# Measure from once the capped caches are full, so filling them isn't taken for growth
+		if baseline_snapshot is None:
+			if any(size < cap for size, cap in measure_capped_caches(show).values()):
+				continue
+			gc.collect()
+			baseline_snapshot = tracemalloc.take_snapshot()
+			baseline_types = Counter(type(obj).__name__ for obj in gc.get_objects())
+			latencies_ms = []
+		else:
+			gc.collect()
+			latencies_ms.sort()
+			samples.append(Sample(
+				beat=beat,
+				show_days=beat * pulse_seconds / 86400,
+				traced_bytes=tracemalloc.get_traced_memory()[0],
+				objects=len(gc.get_objects()),
+				state_sizes=measure_state(show),
+				latency_p50_ms=latencies_ms[len(latencies_ms) // 2],
+				latency_p99_ms=latencies_ms[int(len(latencies_ms) * 0.99)],
+			))
+			latencies_ms = []
+
+	final_snapshot = tracemalloc.take_snapshot()
+	final_types = Counter(type(obj).__name__ for obj in gc.get_objects())
+	tracemalloc.stop()
+
+	return samples, beat_errors, error_examples, baseline_snapshot, final_snapshot, baseline_types, final_types, measure_capped_caches(show)
+
+def report(samples, beat_errors, error_examples, baseline_snapshot, final_snapshot, baseline_types, final_types, capped_caches):
+	"""Prints the samples and anything suspicious in them.
+
+	Returns:
+		list[str]: The problems found.
+	"""
+	print(f'{"beat":>9} {"days":>6} {"traced KB":>10} {"objects":>9} {"p50 ms":>8} {"p99 ms":>8}')
+	for sample in samples:
+		print(f'{sample.beat:>9} {sample.show_days:>6.2f} {sample.traced_bytes / 1024:>10.1f} {sample.objects:>9} {sample.latency_p50_ms:>8.3f} {sample.latency_p99_ms:>8.3f}')
+
+	problems = []
+
+	traced = [sample.traced_bytes for sample in samples]
+	if is_growing(traced, MIN_MEMORY_GROWTH_BYTES):
+		problems.append(f'traced memory grows by {growth_per_day(samples, traced) / 1024:.1f} KB/day')
+
+	objects = [sample.objects for sample in samples]
+	if is_growing(objects, MIN_OBJECT_GROWTH):
+		growing_types = ', '.join(f'{type_name} +{count}' for type_name, count in (final_types - baseline_types).most_common(5))
+		problems.append(f'live objects grow by {growth_per_day(samples, objects):.0f}/day ({growing_types})')
+
+	for state_name in samples[0].state_sizes if samples else ():
+		sizes = [sample.state_sizes[state_name] for sample in samples]
+		if is_growing(sizes, MIN_STATE_GROWTH):
+			problems.append(f'{state_name} grows by {growth_per_day(samples, sizes):.0f}/day (now {sizes[-1]})')
+
+	# Compare the start and end of the run, so slow drifts stand out from noise
+	third = max(1, len(samples) // 3)
+	early = statistics.median(sample.latency_p50_ms for sample in samples[:third]) if samples else 0
+	late = statistics.median(sample.latency_p50_ms for sample in samples[-third:]) if samples else 0
+	if late > early * LATENCY_DRIFT_RATIO and late - early > MIN_LATENCY_DRIFT_MS:
+		problems.append(f'median beat latency drifts from {early:.3f} ms to {late:.3f} ms')
+
+	for error_site, count in beat_errors.most_common():
+		problems.append(f'{count} beats failed with {error_site}: {error_examples[error_site]}')
+
+	print()
+	print(f'state at the end: {samples[-1].state_sizes if samples else {}}')
+	if baseline_snapshot is None:
+		caches = ', '.join(f'{name} {size}/{cap}' for name, (size, cap) in capped_caches.items())
+		print(f'the capped caches never filled ({caches}), so growth and drift weren\'t checked (run for more days)')
+	if problems:
+		print()
+		print('problems found:')
+		for problem in problems:
+			print('  - ' + problem)
+
+		if baseline_snapshot is not None:
+			print()
+			print('top allocation sites growing since the warmup:')
+			ignored = (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__))
+			for stat in final_snapshot.filter_traces(ignored).compare_to(baseline_snapshot.filter_traces(ignored), 'lineno')[:10]:
+				if stat.size_diff > 0:
+					print(f'  {stat}')
+	elif baseline_snapshot is not None:
+		print('no growth or latency drift found')
+
+	return problems
+
+def main():
+	parser = argparse.ArgumentParser(description='Soak test the music driver against the simulated OP layer.')
+	parser.add_argument('--days', type=float, default=14, help='show time to run for, in days')
+	parser.add_argument('--pulse-seconds', type=float, default=DEFAULT_PULSE_SECONDS, help='show time between Beat CHOP pulses')
+	parser.add_argument('--samples', type=int, default=60, help='how many times to sample over the run')
+	parser.add_argument('--seed', type=int, default=0)
+	args = parser.parse_args()
+
+	start = time.perf_counter()
+	problems = report(*run(args.days, args.pulse_seconds, args.samples, args.seed))
+	print(f'\nran {args.days} days of show time in {time.perf_counter() - start:.1f} s')
+	sys.exit(1 if problems else 0)
+
+if __name__ == '__main__':
+	main()
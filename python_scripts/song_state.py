@@ -0,0 +1,192 @@
+from typing import Dict, List
+
+import roster
+
+# The song state as one packed integer.
+#
+# The key, scale mode, chord, chord variation, scene and active melody are each a small code
+# into an interned vocabulary, bit-packed into one int:
+#
+#   bits  0-3   key              bits 13-17  chord variation
+#   bits  4-7   scale mode       bits 18-20  scene
+#   bits  8-12  chord            bits 21-25  active melody (its number + 1, 0 for none)
+#
+# The scene field is sized from the roster when this is imported, so it's 3 bits for up to 8
+# scenes and grows (moving the melody up) for more, rather than a new scene throwing mid-show.
+#
+# The driver packs the word once a beat and stores it as 'song_state'. The OSC exporter sends
+# its codes as they are, and the history logs them, so everything reading the state agrees on
+# the numbers, and comparing or hashing a whole state is one int operation.
+#
+# The vocabularies start with the numbers the exporter has always sent (the other TouchDesigner
+# project reads them), and anything else in the tables gets the next free code, in table order,
+# when a theory is registered. The same tables always give the same codes, in any process.
+
+# region Classes
+
+class Vocabulary:
+	# Props
+	field: str
+	bits: int
+	names: List[str] # By code ('' for codes nothing uses)
+	codes: Dict[str, int]
+
+	# Methods
+	def __init__(self, field: str, bits: int, codes: Dict[str, int]):
+		self.field = field
+		self.bits = bits
+		self.codes = {}
+		self.names = []
+		for name, code in codes.items():
+			self.assign(name, code)
+
+	def assign(self, name, code):
+		if code >= 1 << self.bits:
+			raise ValueError(f'The song state only has room for {1 << self.bits} {self.field} values, "{name}" would be {code}')
+		self.names += [''] * (code + 1 - len(self.names))
+		self.names[code] = name
+		self.codes[name] = code
+
+	def code(self, name):
+		"""Gets the code of a name, interning it with the next free code if it's new."""
+		code = self.codes.get(name)
+		if code is None:
+			code = len(self.names)
+			self.assign(name, code)
+		return code
+
+	def name(self, code):
+		return self.names[code]
+
+# endregion
+
+# region Vocabularies
+
+KEYS = Vocabulary('key', 4, {key: code for code, key in enumerate(['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B'])})
+SCALE_MODES = Vocabulary('scale_mode', 4, {'lydian': 0, 'ionian': 1, 'mixolydian': 2, 'dorian': 3})
+CHORDS = Vocabulary('chord', 5, {'I': 0, 'ii': 1, 'iii': 2, 'IV': 3, 'V': 4, 'vi': 5, 'vii*': 6, 'VI': 7, 'VII': 9, 'II': 10, 'III': 11}) # 8 was skipped when VI was mistyped as 78
+CHORD_VARIATIONS = Vocabulary('chord_variation', 5, {variation: code for code, variation in enumerate([
+	'major triad', 'minor triad', 'diminished triad', 'augmented triad', 'sus2', 'sus4', '6',
+	'dominant 7', 'major 7', 'half-diminished 7', 'diminished 7', 'add9',
+])})
+SCENE_CODES = {'morning': 0, 'day': 1, 'evening': 2, 'night': 3}
+SCENES = Vocabulary('current_scene', max(3, (len(SCENE_CODES.keys() | roster.SCENES.keys()) - 1).bit_length()), SCENE_CODES) # Room for every scene in the roster
+
+MELODY_BITS = 5
+NO_MELODY = 'none'
+
+# endregion
+
+# region Layout
+
+KEY_SHIFT = 0
+SCALE_MODE_SHIFT = KEY_SHIFT + KEYS.bits
+CHORD_SHIFT = SCALE_MODE_SHIFT + SCALE_MODES.bits
+CHORD_VARIATION_SHIFT = CHORD_SHIFT + CHORDS.bits
+SCENE_SHIFT = CHORD_VARIATION_SHIFT + CHORD_VARIATIONS.bits
+MELODY_SHIFT = SCENE_SHIFT + SCENES.bits
+
+# endregion
+
+def theory_names(theory):
+	"""Pairs each vocabulary with the names a theory has for it, in table order."""
+	return ((KEYS, theory.keys), (SCALE_MODES, theory.scale_notes), (CHORDS, theory.chords), (CHORD_VARIATIONS, theory.chord_variation_names), (SCENES, theory.scenes))
+
+def register_theory(theory):
+	"""Interns every name in a theory's tables, in table order, so new rows get stable codes.
+
+	Args:
+		theory (Theory): The theory the driver's about to use.
+
+	Raises:
+		ValueError: If a table has more rows than its field has room for.
+	"""
+	for vocabulary, names in theory_names(theory):
+		for name in names:
+			vocabulary.code(name)
+
+def overflowing_fields(theory):
+	"""Gets the fields a theory has too many names for, without interning anything.
+
+	Returns:
+		list[str]: Descriptions of the fields that wouldn't fit, empty if they all do.
+	"""
+	overflowing = []
+	for vocabulary, names in theory_names(theory):
+		num_codes = len(vocabulary.names) + sum(1 for name in names if name not in vocabulary.codes)
+		if num_codes > 1 << vocabulary.bits:
+			overflowing.append(f'{vocabulary.field} needs {num_codes} codes, but the song state only has room for {1 << vocabulary.bits}')
+	return overflowing
+
+def pack(key, scale_mode, chord, chord_variation, current_scene, active_melody):
+	"""Packs the song state into one int.
+
+	Args:
+		key (str): The key, like 'F#'.
+		scale_mode (str): The scale mode, like 'dorian'.
+		chord (str): The chord, like 'vii*'.
+		chord_variation (str): The chord variation, like 'half-diminished 7'.
+		current_scene (str): The current scene.
+		active_melody (str): The melody playing (its number, like storage has it, or as an int), or 'none' (or None).
+
+	Returns:
+		int: The song state word.
+	"""
+	melody_code = 0 if active_melody is None or active_melody == NO_MELODY else int(active_melody) + 1
+	if melody_code >= 1 << MELODY_BITS:
+		raise ValueError(f'The song state only has room for melodies up to {(1 << MELODY_BITS) - 2}, not {active_melody}')
+	return (
+		KEYS.code(key) << KEY_SHIFT
+		| SCALE_MODES.code(scale_mode) << SCALE_MODE_SHIFT
+		| CHORDS.code(chord) << CHORD_SHIFT
+		| CHORD_VARIATIONS.code(chord_variation) << CHORD_VARIATION_SHIFT
+		| SCENES.code(current_scene) << SCENE_SHIFT
+		| melody_code << MELODY_SHIFT
+	)
+
+def pack_from_storage(storage):
+	"""Packs the song state from the separate values in storage, like after a reset writes them."""
+	return pack(storage.fetch('key'), storage.fetch('scale_mode'), storage.fetch('chord'), storage.fetch('chord_variation'), storage.fetch('current_scene'), storage.fetch('active_melody'))
+
+def codes(song_state):
+	"""Gets the codes packed into a song state word.
+
+	Returns:
+		multiple:
+			- int: Key code
+			- int: Scale mode code
+			- int: Chord code
+			- int: Chord variation code
+			- int: Scene code
+			- int: Active melody code (its number + 1, 0 for none)
+	"""
+	return (
+		song_state >> KEY_SHIFT & (1 << KEYS.bits) - 1,
+		song_state >> SCALE_MODE_SHIFT & (1 << SCALE_MODES.bits) - 1,
+		song_state >> CHORD_SHIFT & (1 << CHORDS.bits) - 1,
+		song_state >> CHORD_VARIATION_SHIFT & (1 << CHORD_VARIATIONS.bits) - 1,
+		song_state >> SCENE_SHIFT & (1 << SCENES.bits) - 1,
+		song_state >> MELODY_SHIFT & (1 << MELODY_BITS) - 1,
+	)
+
+def unpack(song_state):
+	"""Unpacks a song state word back into names, the way storage has them.
+
+	Returns:
+		multiple:
+			- str: Key
+			- str: Scale mode
+			- str: Chord
+			- str: Chord variation
+			- str: Scene
+			- str: Active melody number, or 'none'
+	"""
+	key_code, scale_mode_code, chord_code, chord_variation_code, scene_code, melody_code = codes(song_state)
+	return (
+		KEYS.name(key_code),
+		SCALE_MODES.name(scale_mode_code),
+		CHORDS.name(chord_code),
+		CHORD_VARIATIONS.name(chord_variation_code),
+		SCENES.name(scene_code),
+		NO_MELODY if melody_code == 0 else str(melody_code - 1),
+	)
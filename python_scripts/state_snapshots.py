@@ -0,0 +1,130 @@
+from typing import Dict, List, NamedTuple, Tuple
+
+# Immutable snapshots of the driver's state, for anything reading it between beats.
+#
+# The driver changes its Instrument objects in place every beat, so the OSC exporter (which
+# runs every frame), UI panels or a background thread reading storage.fetch('instruments')
+# can see a beat half applied. Instead, the driver publishes a snapshot at the end of each
+# beat: the song state word and every instrument's playing notes, all in tuples, so nothing
+# can change them once they're out.
+#
+# Publishing is swapping one reference (StateSnapshots.current), which is atomic, so readers
+# don't need a lock: take current once and read everything from it, and it stays consistent
+# however long the read takes, while the next snapshot is built alongside it. Nothing is
+# copied that didn't change: the notes are the tuples the voicing already made, a scene whose
+# instruments are all holding the same notes is reused whole from the last snapshot, and the
+# names and voice counts are shared by every snapshot until the roster changes.
+
+# region Classes
+
+class SceneSnapshot(NamedTuple):
+	name: str
+	instruments: Tuple[Tuple[str, int], ...] # (name, number of voices) of each instrument, shared by every snapshot until the roster changes
+	playing_notes: Tuple[Tuple[str, ...], ...] # What each instrument is holding, in the same order
+
+class StateSnapshot(NamedTuple):
+	version: int # Goes up by one with every snapshot that differs from the last
+	song_state: int # The packed song state, see song_state
+	scenes: Tuple[SceneSnapshot, ...] # In storage order
+
+EMPTY_SNAPSHOT = StateSnapshot(0, 0, ())
+
+class StateSnapshots:
+	# Props
+	current: StateSnapshot # The latest snapshot (the only thing readers touch)
+	scene_snapshots: Dict[str, SceneSnapshot] # The last snapshot made of each scene, for the next one to reuse
+	scenes_buffer: List[SceneSnapshot] # Where the next snapshot's scenes are gathered
+
+	# Methods
+	def __init__(self):
+		self.current = EMPTY_SNAPSHOT
+		self.scene_snapshots = {}
+		self.scenes_buffer = []
+
+	def publish(self, song_state, instruments):
+		"""Publishes a snapshot of the state, if it's changed since the last one. Only call this from the thread that changes the instruments.
+
+		Args:
+			song_state (int): The packed song state.
+			instruments (dict[str, dict[str, Instrument]]): Every instrument, grouped by scene.
+
+		Returns:
+			StateSnapshot: The current snapshot.
+		"""
+		previous = self.current
+		changed = song_state != previous.song_state or len(instruments) != len(previous.scenes)
+		scenes = self.scenes_buffer
+		scenes.clear()
+		for scene_name, scene_instruments in instruments.items():
+			scene_snapshot = self.scene_snapshots.get(scene_name)
+			if scene_snapshot is None or not is_scene_unchanged(scene_snapshot, scene_instruments):
+				scene_snapshot = snapshot_scene(scene_name, scene_snapshot, scene_instruments)
+				self.scene_snapshots[scene_name] = scene_snapshot
+			if not changed and previous.scenes[len(scenes)] is not scene_snapshot:
+				changed = True
+			scenes.append(scene_snapshot)
+
+		if changed:
+			self.current = StateSnapshot(previous.version + 1, song_state, tuple(scenes))
+		scenes.clear()
+		return self.current
+
+# endregion
+
+# region Helper Functions
+
+def is_scene_unchanged(scene_snapshot, scene_instruments):
+	"""Checks if a scene's instruments are still exactly the ones in its last snapshot, holding the same notes."""
+	if len(scene_snapshot.instruments) != len(scene_instruments):
+		return False
+	index = 0
+	for instrument_name, instrument_props in scene_instruments.items():
+		if scene_snapshot.playing_notes[index] is not instrument_props.playing_notes or scene_snapshot.instruments[index] != (instrument_name, instrument_props.num_voices):
+			return False
+		index += 1
+	return True
+
+def snapshot_scene(scene_name, scene_snapshot, scene_instruments):
+	"""Makes a scene's snapshot, reusing the instrument list of its last one if the instruments are the same.
+
+	Args:
+		scene_name (str): The name of the scene.
+		scene_snapshot (SceneSnapshot): The scene's last snapshot, or None.
+		scene_instruments (dict[str, Instrument]): The scene's instruments.
+
+	Returns:
+		SceneSnapshot: The new snapshot.
+	"""
+	playing_notes = []
+	for instrument_props in scene_instruments.values():
+		notes = instrument_props.playing_notes
+		if type(notes) is not tuple:
+			# The voicing hands out tuples, but a reset leaves lists, so swap them for a tuple (which the next publish can
+			# then tell hasn't changed without comparing the notes)
+			notes = tuple(notes)
+			instrument_props.playing_notes = notes
+		playing_notes.append(notes)
+
+	instrument_layout = None if scene_snapshot is None else scene_snapshot.instruments
+	if instrument_layout is None or len(instrument_layout) != len(scene_instruments) or any(layout != (instrument_name, instrument_props.num_voices) for layout, (instrument_name, instrument_props) in zip(instrument_layout, scene_instruments.items())):
+		instrument_layout = tuple((instrument_name, instrument_props.num_voices) for instrument_name, instrument_props in scene_instruments.items())
+	return SceneSnapshot(scene_name, instrument_layout, tuple(playing_notes))
+
+def publish_from_storage(storage):
+	"""Publishes a snapshot of what's in storage, like after a reset writes it (making the snapshots if they're not there yet).
+
+	Returns:
+		StateSnapshot: The current snapshot.
+	"""
+	snapshots = storage.fetch('state_snapshots', None)
+	if snapshots is None:
+		snapshots = StateSnapshots()
+		storage.store('state_snapshots', snapshots)
+	return snapshots.publish(storage.fetch('song_state', 0), storage.fetch('instruments', {}))
+
+def read_snapshot(storage):
+	"""Gets the latest snapshot, for readers (an empty one if nothing's been published yet)."""
+	snapshots = storage.fetch('state_snapshots', None)
+	return EMPTY_SNAPSHOT if snapshots is None else snapshots.current
+
+# endregion
@@ -0,0 +1,235 @@
+import csv
+import hashlib
+import marshal
+import mmap
+import os
+import struct
+from typing import List, Dict
+
+from melodies import MELODIES
+from roster import INSTRUMENT_ROSTER, SCENES
+
+# Compiled music theory for the driver.
+#
+# The reference tables (reference_data/*.tsv), the melody bank and the instrument roster
+# get compiled into plain dicts and lists once, so the beat never parses a table. The
+# compiled data can be saved as a single binary artifact (see build_theory_artifact),
+# which loads in one read on a cold start:
+#
+#   header: magic, artifact version, marshal version, SHA-256 of the sources, payload size
+#   payload: the compiled data, marshalled
+#
+# If the artifact is missing, stale (its hash doesn't match the sources) or unreadable,
+# the tables are compiled straight from the TSVs instead.
+
+# region Constants
+
+ARTIFACT_MAGIC = b'FTMT'
+ARTIFACT_VERSION = 2
+ARTIFACT_HEADER = struct.Struct('<4sHH32sQ')
+ARTIFACT_FILE_NAME = 'theory.bin'
+
+TABLE_FILE_NAMES = ('scale_notes.tsv', 'keys.tsv', 'chords.tsv', 'chord_variations.tsv')
+
+# endregion
+
+# region Classes
+
+class Theory:
+	# Props
+	scale_notes: Dict[str, List[str]] # Scale mode -> notes above the root
+	keys: Dict[str, dict] # Key -> offset, MIDI note and key change keys
+	chords: Dict[str, dict] # Chord -> type, notes above the root, base note and transitions
+	chord_variations: Dict[str, dict] # Chord variation -> type, notes above the root, transitions and tension / resolution
+	chord_variation_names: List[str] # In table order, for picking random variations
+	melodies: Dict[int, dict]
+	roster: Dict[str, Dict[str, dict]]
+	scenes: Dict[str, dict]
+	source_hash: bytes
+	loaded_from: str # 'artifact' or 'tsv'
+
+	# Methods
+	def __init__(self, compiled: dict, source_hash: bytes, loaded_from: str):
+		self.scale_notes = compiled['scale_notes']
+		self.keys = compiled['keys']
+		self.chords = compiled['chords']
+		self.chord_variations = compiled['chord_variations']
+		self.chord_variation_names = compiled['chord_variation_names']
+		self.melodies = compiled['melodies']
+		self.roster = compiled['roster']
+		self.scenes = compiled['scenes']
+		self.source_hash = source_hash
+		self.loaded_from = loaded_from
+
+# endregion
+
+# region Compiling
+
+def split_list(value):
+	"""Splits a comma-separated table cell into a list, dropping stray whitespace.
+
+	Args:
+		value (str): The cell, like '0,4,7'.
+
+	Returns:
+		list[str]: The items in the cell.
+	"""
+	return [item.strip() for item in value.split(',') if item.strip()]
+
+def read_table(reference_dir, file_name):
+	"""Reads a reference table into a list of rows.
+
+	Args:
+		reference_dir (str): The folder holding the reference TSVs.
+		file_name (str): The name of the TSV.
+
+	Returns:
+		list[dict]: The rows of the table, keyed by column header.
+	"""
+	with open(os.path.join(reference_dir, file_name), newline='', encoding='utf-8') as tsv_file:
+		return list(csv.DictReader(tsv_file, delimiter='\t'))
+
+def compile_tables(tables):
+	"""Compiles the reference tables, melodies and roster into plain data.
+
+	Args:
+		tables (dict[str, list[dict]]): The rows of every reference table, keyed by TSV file name.
+
+	Returns:
+		dict: The compiled data, as built-in types only (so it can be marshalled).
+	"""
+	scale_notes = {row['Name']: split_list(row['Notes']) for row in tables['scale_notes.tsv']}
+
+	keys = {}
+	for row in tables['keys.tsv']:
+		keys[row['Note']] = {
+			'midi': int(row['MIDI']),
+			'offset': int(row['Offset']),
+			'key_changes': split_list(row['Common Key Change Keys']),
+		}
+
+	chords = {}
+	for row in tables['chords.tsv']:
+		notes = split_list(row['Notes Above Root'])
+		chords[row['Chord']] = {
+			'type': row['Type'],
+			'notes': notes,
+			'base_note': min(int(note) for note in notes),
+			'transitions': split_list(row['Common Transitions']),
+		}
+
+	chord_variations = {}
+	for row in tables['chord_variations.tsv']:
+		chord_variations[row['Chord Variation']] = {
+			'type': row['Type'],
+			'notes': split_list(row['Notes Above Root']),
+			'transitions': split_list(row['Possible Transition Variations']),
+			'resolution': row['Tension / Resolution'],
+		}
+
+	# Drop transitions to chords and variations that aren't in the tables (i.e., 'minor 7'), which the beat can't land on
+	for chord_props in chords.values():
+		chord_props['transitions'] = [transition for transition in chord_props['transitions'] if transition in chords]
+	for variation_props in chord_variations.values():
+		variation_props['transitions'] = [transition for transition in variation_props['transitions'] if transition in chord_variations]
+
+	return {
+		'scale_notes': scale_notes,
+		'keys': keys,
+		'chords': chords,
+		'chord_variations': chord_variations,
+		'chord_variation_names': list(chord_variations),
+		'melodies': MELODIES,
+		'roster': INSTRUMENT_ROSTER,
+		'scenes': SCENES,
+	}
+
+def hash_sources(reference_dir):
+	"""Hashes everything the compiled data is built from, without parsing any of it.
+
+	Args:
+		reference_dir (str): The folder holding the reference TSVs.
+
+	Returns:
+		bytes: The SHA-256 digest of the sources.
+	"""
+	source_hash = hashlib.sha256()
+	for file_name in TABLE_FILE_NAMES:
+		with open(os.path.join(reference_dir, file_name), 'rb') as tsv_file:
+			source_hash.update(file_name.encode())
+			source_hash.update(tsv_file.read())
+	source_hash.update(repr(MELODIES).encode())
+	source_hash.update(repr(INSTRUMENT_ROSTER).encode())
+	source_hash.update(repr(SCENES).encode())
+	return source_hash.digest()
+
+# endregion
+
+# region Artifact
+
+def write_artifact(artifact_path, compiled, source_hash):
+	"""Writes compiled data to a binary artifact.
+
+	Args:
+		artifact_path (str): Where to write the artifact.
+		compiled (dict): The compiled data, from compile_tables.
+		source_hash (bytes): The hash of the sources the data was compiled from.
+
+	Returns:
+		int: The size of the artifact, in bytes.
+	"""
+	payload = marshal.dumps(compiled)
+	header = ARTIFACT_HEADER.pack(ARTIFACT_MAGIC, ARTIFACT_VERSION, marshal.version, source_hash, len(payload))
+
+	# Write to a temp file and swap it in, so the driver never sees a half-written artifact
+	temp_path = artifact_path + '.tmp'
+	with open(temp_path, 'wb') as artifact_file:
+		artifact_file.write(header)
+		artifact_file.write(payload)
+	os.replace(temp_path, artifact_path)
+
+	return len(header) + len(payload)
+
+def read_artifact(artifact_path):
+	"""Reads a binary artifact in one go by memory-mapping it.
+
+	Args:
+		artifact_path (str): The path of the artifact.
+
+	Returns:
+		multiple:
+			- bytes: The hash of the sources the artifact was compiled from, or None if it can't be used
+			- dict: The compiled data, or None if it can't be used
+	"""
+	try:
+		with open(artifact_path, 'rb') as artifact_file, mmap.mmap(artifact_file.fileno(), 0, access=mmap.ACCESS_READ) as artifact:
+			magic, version, marshal_version, source_hash, payload_size = ARTIFACT_HEADER.unpack_from(artifact)
+			if magic != ARTIFACT_MAGIC or version != ARTIFACT_VERSION or marshal_version != marshal.version:
+				return None, None
+			if ARTIFACT_HEADER.size + payload_size > len(artifact):
+				return None, None
+			return source_hash, marshal.loads(artifact[ARTIFACT_HEADER.size:ARTIFACT_HEADER.size + payload_size])
+	except (OSError, ValueError, EOFError, TypeError, struct.error):
+		return None, None
+
+def load_theory(reference_dir, artifact_path=None):
+	"""Loads the compiled theory, from the artifact if it's up to date or else from the TSVs.
+
+	Args:
+		reference_dir (str): The folder holding the reference TSVs.
+		artifact_path (str, optional): The path of the artifact. Defaults to theory.bin in reference_dir.
+
+	Returns:
+		Theory: The compiled theory.
+	"""
+	artifact_path = artifact_path or os.path.join(reference_dir, ARTIFACT_FILE_NAME)
+	source_hash = hash_sources(reference_dir)
+
+	artifact_hash, compiled = read_artifact(artifact_path)
+	if compiled is not None and artifact_hash == source_hash:
+		return Theory(compiled, source_hash, 'artifact')
+
+	tables = {file_name: read_table(reference_dir, file_name) for file_name in TABLE_FILE_NAMES}
+	return Theory(compile_tables(tables), source_hash, 'tsv')
+
+# endregion
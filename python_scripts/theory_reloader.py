@@ -0,0 +1,174 @@
+import os
+import threading
+import time
+
+from theory import ARTIFACT_FILE_NAME, TABLE_FILE_NAMES, Theory, compile_tables, hash_sources, read_table, write_artifact
+from verify_state_space import verify_theory
+
+# Hot reload of the reference tables.
+#
+# A background thread hashes the reference TSVs every poll_seconds. When the hash changes,
+# it reads and compiles the tables into a fresh Theory, then runs the state-space verifier
+# over it (see verify_state_space). Only a theory with no errors is kept. It waits as the
+# pending theory until the driver takes it at the start of its next beat, so a beat never
+# sees half of one theory and half of another. The theory artifact is rewritten as well,
+# so the next cold start loads it straight away.
+#
+# The table DATs in the project are edited too. reference_table_watch hands an edited DAT's
+# text over on the main thread (see offer_table), and the thread writes it out to the TSV it
+# mirrors before it hashes them, so a DAT edit goes through the same checks as a TSV edit, and
+# is still there on the next cold start.
+#
+# An edit that doesn't parse or doesn't verify is rejected (and printed, with the errors),
+# and the live theory stays as it was until the tables are fixed.
+
+# region Constants
+
+POLL_SECONDS = 1.0
+
+# endregion
+
+class TheoryReloader:
+	# Props
+	reference_dir: str
+	poll_seconds: float
+	live_hash: bytes # Hash of the sources of the newest good theory (live or pending)
+	rejected_hash: bytes # Hash of the last sources rejected, so a bad edit is only checked once
+	pending: Theory # A good theory waiting for the next beat, or None
+	reloads: int
+	rejections: int
+	last_errors: list # The errors of the last rejected edit, as strings
+	offered_tables: dict # TSV file name -> the text of its edited DAT, still to be written out
+	lock: threading.Lock
+	stopped: threading.Event
+	thread: threading.Thread
+
+	# Methods
+	def __init__(self, reference_dir: str, live_hash: bytes, poll_seconds: float = POLL_SECONDS):
+		self.reference_dir = reference_dir
+		self.poll_seconds = poll_seconds
+		self.live_hash = live_hash
+		self.rejected_hash = None
+		self.pending = None
+		self.reloads = 0
+		self.rejections = 0
+		self.last_errors = []
+		self.offered_tables = {}
+		self.lock = threading.Lock()
+		self.stopped = threading.Event()
+		self.thread = None
+
+	def start(self):
+		"""Starts watching the tables in a background thread."""
+		self.thread = threading.Thread(target=self.run, name='theory_reloader', daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		self.stopped.set()
+		if self.thread is not None:
+			self.thread.join()
+
+	def run(self):
+		while not self.stopped.wait(self.poll_seconds):
+			self.poll()
+
+	def offer_table(self, file_name, text):
+		"""Hands over the text of an edited table DAT, for the thread to write out to its TSV. Called on the main thread.
+
+		Args:
+			file_name (str): The TSV the DAT mirrors, like 'chords.tsv'.
+			text (str): The DAT's text (tab-separated rows).
+		"""
+		if file_name not in TABLE_FILE_NAMES:
+			return
+		text = text.replace('\r\n', '\n')
+		if not text.endswith('\n'):
+			text += '\n'
+		with self.lock:
+			self.offered_tables[file_name] = text
+
+	def write_offered_tables(self):
+		"""Writes the edited DATs' text out to their TSVs, if it's not what they already hold."""
+		with self.lock:
+			offered_tables = self.offered_tables
+			self.offered_tables = {}
+
+		for file_name, text in offered_tables.items():
+			path = os.path.join(self.reference_dir, file_name)
+			try:
+				with open(path, newline='', encoding='utf-8') as tsv_file:
+					if tsv_file.read() == text:
+						continue
+			except OSError:
+				pass
+
+			# Replaced in one go, so the hashing never reads half a file
+			with open(path + '.tmp', 'w', newline='', encoding='utf-8') as tsv_file:
+				tsv_file.write(text)
+			os.replace(path + '.tmp', path)
+
+	def poll(self):
+		"""Rebuilds and checks the theory if the tables (or their DATs) changed since the last look.
+
+		Returns:
+			bool: Whether a new theory is now pending.
+		"""
+		try:
+			self.write_offered_tables()
+			source_hash = hash_sources(self.reference_dir)
+		except OSError:
+			return False # Mid-save, most likely, so look again next poll
+
+		if source_hash in (self.live_hash, self.rejected_hash):
+			return False
+
+		start = time.perf_counter()
+		try:
+			tables = {file_name: read_table(self.reference_dir, file_name) for file_name in TABLE_FILE_NAMES}
+			compiled = compile_tables(tables)
+			theory = Theory(compiled, source_hash, 'tsv')
+			findings, _ = verify_theory(tables, theory)
+			errors = [f'[{finding.check}] {finding.message}' for finding in findings if finding.severity == 'error']
+		except (OSError, KeyError, ValueError, TypeError, AttributeError) as error:
+			errors = [f'[parse] {type(error).__name__}: {error}']
+
+		if errors:
+			self.rejected_hash = source_hash
+			self.rejections += 1
+			self.last_errors = errors
+			print(f'theory_reloader: rejected the edited reference tables, the live theory stays as it was ({len(errors)} errors)')
+			for error in errors:
+				print(f'  {error}')
+			return False
+
+		with self.lock:
+			self.pending = theory
+			self.live_hash = source_hash
+		self.reloads += 1
+		self.last_errors = []
+		print(f'theory_reloader: rebuilt the reference tables in {(time.perf_counter() - start) * 1000:.0f} ms, swapping in on the next beat')
+
+		try:
+			write_artifact(os.path.join(self.reference_dir, ARTIFACT_FILE_NAME), compiled, source_hash)
+		except OSError:
+			pass # The artifact is only a cold start speedup
+		return True
+
+	def take(self, is_usable):
+		"""Takes the pending theory, if there is one and it suits the song's current state. Called between beats.
+
+		Args:
+			is_usable (function): Called with the pending theory; returns False to leave it pending (like when the current chord was removed).
+
+		Returns:
+			Theory: The new theory to swap in, or None.
+		"""
+		if self.pending is None:
+			return None
+
+		with self.lock:
+			theory = self.pending
+			if theory is None or not is_usable(theory):
+				return None
+			self.pending = None
+		return theory
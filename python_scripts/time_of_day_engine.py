@@ -0,0 +1,264 @@
+import bisect
+import math
+from typing import List, Dict, Tuple
+
+from roster import SCENES, START_SCENE
+
+# Analytic time-of-day engine.
+#
+# The day-night cycle is declared as a list of segments: each scene holds at full
+# volume, then equal-power crossfades into the next segment's scene. From that, scene
+# gains, the current scene, the time to the next transition and every gain threshold
+# crossing can be computed from the show time alone, without reading CHOPs.
+#
+# The schedule comes from the scenes in the roster, following each one's successor round
+# from the start scene.
+#
+# The Compound_Timer still decides when the scenes change, as it drives the visuals and
+# the sky over OSC too. The roster's timings should match its segments, but they're only
+# placeholders for now, so the driver keeps the engine in step with the timer's current
+# scene (see follow) rather than letting the two drift apart, and reacts to the engine's
+# crossings (see crossings_between) rather than polling the gains. Until the roster says
+# its timings are the timer's (TIMINGS_MATCH_TIMER), it doesn't silence a scene on them.
+
+# region Constants
+
+AUDIBLE_GAIN = 0.35 # Below this, a fading scene is considered silent and can be killed
+FULL_GAIN = 0.65 # Above this, an incoming scene is considered done transitioning
+
+GAIN_LUT_SIZE = 1024
+FOLLOW_MARGIN_SECONDS = 0.001 # How far inside a scene's time as the current scene follow() puts the show, so rounding can't put it outside
+
+# endregion
+
+# region Classes
+
+class ScheduleSegment:
+	# Props
+	scene: str
+	hold_seconds: float # How long the scene plays on its own
+	crossfade_seconds: float # How long it then takes to crossfade into the next segment's scene
+
+	# Methods
+	def __init__(self, scene: str, hold_seconds: float, crossfade_seconds: float):
+		self.scene = scene
+		self.hold_seconds = hold_seconds
+		self.crossfade_seconds = crossfade_seconds
+
+class GainCrossing:
+	# Props
+	show_seconds: float # When the crossing happens, in seconds since the show started
+	scene: str
+	threshold: float
+	rising: bool # True if the scene is fading in past the threshold, False if it's fading out
+
+	# Methods
+	def __init__(self, show_seconds: float, scene: str, threshold: float, rising: bool):
+		self.show_seconds = show_seconds
+		self.scene = scene
+		self.threshold = threshold
+		self.rising = rising
+
+# endregion
+
+def schedule_from_scenes(scenes, start_scene):
+	"""Lays the scenes out as a schedule, from the start scene round its successors until it gets back to the start.
+
+	Args:
+		scenes (dict[str, dict]): The scenes, like roster.SCENES.
+		start_scene (str): The scene the show starts on.
+
+	Returns:
+		list[ScheduleSegment]: A segment per scene in the cycle.
+	"""
+	schedule = []
+	scene = start_scene
+	while not schedule or scene != start_scene:
+		if len(schedule) >= len(scenes):
+			raise ValueError(f'the scenes after {start_scene} never lead back to it')
+		scene_props = scenes[scene]
+		schedule.append(ScheduleSegment(scene=scene, hold_seconds=scene_props['hold_seconds'], crossfade_seconds=scene_props['crossfade_seconds']))
+		scene = scene_props['next_scene_name']
+	return schedule
+
+# The show starts at night (see reset_scene), then goes through the day
+DEFAULT_SCHEDULE: List[ScheduleSegment] = schedule_from_scenes(SCENES, START_SCENE)
+
+class TimeOfDayEngine:
+	# Props
+	schedule: List[ScheduleSegment]
+	scenes: List[str]
+	cycle_seconds: float
+	segment_starts: List[float] # When each segment starts, in seconds into the cycle
+	crossings: List[GainCrossing] # Every threshold crossing in one cycle, sorted by time
+	crossing_times: List[float]
+	gain_lut: List[float] # sin(x * pi / 2) over [0, 1], so fade-ins read it forwards and fade-outs backwards
+
+	# Methods
+	def __init__(self, schedule: List[ScheduleSegment] = DEFAULT_SCHEDULE, thresholds: Tuple[float, ...] = (AUDIBLE_GAIN, FULL_GAIN)):
+		self.schedule = schedule
+		self.scenes = list(dict.fromkeys(segment.scene for segment in schedule))
+
+		# Lay the segments out over one cycle
+		self.segment_starts = []
+		cycle_seconds = 0
+		for segment in schedule:
+			self.segment_starts.append(cycle_seconds)
+			cycle_seconds += segment.hold_seconds + segment.crossfade_seconds
+		self.cycle_seconds = cycle_seconds
+
+		# Equal-power fades are a quarter sine, so one table covers both directions
+		self.gain_lut = [math.sin(i / (GAIN_LUT_SIZE - 1) * math.pi / 2) for i in range(GAIN_LUT_SIZE)]
+
+		# Work out when every crossfade crosses every threshold, by inverting the fade curves
+		crossings = []
+		for i, segment in enumerate(schedule):
+			fade_start = self.segment_starts[i] + segment.hold_seconds
+			next_scene = schedule[(i + 1) % len(schedule)].scene
+			for threshold in thresholds:
+				fade_in_position = math.asin(threshold) * 2 / math.pi
+				fade_out_position = math.acos(threshold) * 2 / math.pi
+				crossings.append(GainCrossing(fade_start + fade_in_position * segment.crossfade_seconds, next_scene, threshold, True))
+				crossings.append(GainCrossing(fade_start + fade_out_position * segment.crossfade_seconds, segment.scene, threshold, False))
+		crossings.sort(key=lambda crossing: crossing.show_seconds)
+		self.crossings = crossings
+		self.crossing_times = [crossing.show_seconds for crossing in crossings]
+
+	def locate(self, show_seconds):
+		"""Finds where in the schedule a point of the show is.
+
+		Args:
+			show_seconds (float): The time since the show started, in seconds.
+
+		Returns:
+			multiple:
+				- int: The index of the segment playing
+				- float: How far into the segment's crossfade we are, from 0 to 1 (0 while holding)
+		"""
+		cycle_seconds = show_seconds % self.cycle_seconds
+		i = bisect.bisect_right(self.segment_starts, cycle_seconds) - 1
+		segment = self.schedule[i]
+		fade_seconds = cycle_seconds - self.segment_starts[i] - segment.hold_seconds
+		if fade_seconds <= 0:
+			return i, 0.0
+		return i, fade_seconds / segment.crossfade_seconds
+
+	def gains(self, show_seconds):
+		"""Gets the gain of every scene at a point of the show.
+
+		Args:
+			show_seconds (float): The time since the show started, in seconds.
+
+		Returns:
+			dict[str, float]: The gain of each scene, from 0 to 1.
+		"""
+		i, fade_position = self.locate(show_seconds)
+		scene_gains = dict.fromkeys(self.scenes, 0.0)
+		if fade_position <= 0:
+			scene_gains[self.schedule[i].scene] = 1.0
+			return scene_gains
+
+		lut_index = int(fade_position * (GAIN_LUT_SIZE - 1) + 0.5)
+		next_scene = self.schedule[(i + 1) % len(self.schedule)].scene
+		scene_gains[self.schedule[i].scene] = self.gain_lut[GAIN_LUT_SIZE - 1 - lut_index]
+		scene_gains[next_scene] = scene_gains.get(next_scene, 0.0) + self.gain_lut[lut_index]
+		return scene_gains
+
+	def gain(self, scene, show_seconds):
+		"""Gets the gain of a single scene at a point of the show.
+
+		Args:
+			scene (str): The scene (day, evening, etc.)
+			show_seconds (float): The time since the show started, in seconds.
+
+		Returns:
+			float: The gain of the scene, from 0 to 1.
+		"""
+		return self.gains(show_seconds).get(scene, 0.0)
+
+	def current_scene(self, show_seconds):
+		"""Gets the current scene. Like the Compound_Timer, a scene becomes current when it starts fading in.
+
+		Args:
+			show_seconds (float): The time since the show started, in seconds.
+
+		Returns:
+			str: The current scene.
+		"""
+		i, fade_position = self.locate(show_seconds)
+		if fade_position > 0:
+			return self.schedule[(i + 1) % len(self.schedule)].scene
+		return self.schedule[i].scene
+
+	def follow(self, scene, show_seconds):
+		"""Moves a point of the show to the nearest one where a scene is current, to keep in step with the Compound_Timer.
+
+		If the timer moved on to the scene early, the show skips ahead to just after the scene starts fading in. If the
+		timer's late moving on from it, the show waits at the end of the scene's hold until it does.
+
+		Args:
+			scene (str): The timer's current scene.
+			show_seconds (float): The time since the show started, in seconds.
+
+		Returns:
+			float: The time to use instead, which is show_seconds if the scene's already current (or isn't scheduled).
+		"""
+		if scene not in self.scenes or self.current_scene(show_seconds) == scene:
+			return show_seconds
+
+		nearest = None
+		cycle_start = show_seconds - show_seconds % self.cycle_seconds
+		for i, segment in enumerate(self.schedule):
+			if segment.scene != scene:
+				continue
+			# The scene's current from when the segment before it starts crossfading, to the end of its hold
+			current_from = self.segment_starts[i] - self.schedule[i - 1].crossfade_seconds + FOLLOW_MARGIN_SECONDS
+			current_until = self.segment_starts[i] + segment.hold_seconds - FOLLOW_MARGIN_SECONDS
+			for cycle_seconds in (cycle_start - self.cycle_seconds, cycle_start, cycle_start + self.cycle_seconds):
+				followed = min(max(show_seconds, cycle_seconds + current_from), cycle_seconds + current_until)
+				if nearest is None or abs(followed - show_seconds) < abs(nearest - show_seconds):
+					nearest = followed
+		return nearest
+
+	def time_to_next_transition(self, show_seconds):
+		"""Gets the time until the next crossfade starts. During a crossfade, that's the one after it.
+
+		Args:
+			show_seconds (float): The time since the show started, in seconds.
+
+		Returns:
+			float: The time until the next crossfade starts, in seconds.
+		"""
+		i, fade_position = self.locate(show_seconds)
+		cycle_seconds = show_seconds % self.cycle_seconds
+		if fade_position > 0:
+			i = (i + 1) % len(self.schedule)
+		fade_start = self.segment_starts[i] + self.schedule[i].hold_seconds
+		if fade_start <= cycle_seconds:
+			fade_start += self.cycle_seconds
+		return fade_start - cycle_seconds
+
+	def crossings_between(self, start_seconds, end_seconds):
+		"""Gets the threshold crossings in a window of the show, i.e., since the previous beat.
+
+		Args:
+			start_seconds (float): The start of the window (exclusive), in seconds since the show started.
+			end_seconds (float): The end of the window (inclusive), in seconds since the show started.
+
+		Returns:
+			list[GainCrossing]: The crossings in the window, in order, timed in seconds since the show started.
+		"""
+		crossings = []
+		if end_seconds <= start_seconds:
+			return crossings
+
+		cycle = int(start_seconds // self.cycle_seconds)
+		while cycle * self.cycle_seconds <= end_seconds:
+			cycle_start = cycle * self.cycle_seconds
+			first = bisect.bisect_right(self.crossing_times, start_seconds - cycle_start)
+			last = bisect.bisect_right(self.crossing_times, end_seconds - cycle_start)
+			for crossing in self.crossings[first:last]:
+				crossings.append(GainCrossing(cycle_start + crossing.show_seconds, crossing.scene, crossing.threshold, crossing.rising))
+			cycle += 1
+
+		return crossings
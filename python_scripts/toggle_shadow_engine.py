@@ -0,0 +1,40 @@
+from shadow_engine import ShadowEngine
+
+# me - this DAT
+#
+# channel - the Channel object which has changed
+# sampleIndex - the index of the changed sample
+# val - the numeric value of the changed sample
+# prev - the previous sample value
+#
+# Make sure the corresponding toggle is enabled in the CHOP Execute DAT.
+#
+# Turns shadow mode on and off (see shadow_engine). While it's on, the driver script below
+# replays every live beat without being heard, and turning it off prints how it compared.
+# Point SHADOW_DRIVER_SCRIPT at a copy of music_driver.py with the change to try out.
+
+SHADOW_DRIVER_SCRIPT = 'music_driver.py' # The live driver itself, which should never differ
+
+storage = op('storage_op')
+
+def onOffToOn(channel, sampleIndex, val, prev):
+	storage.store('shadow_engine', ShadowEngine(SHADOW_DRIVER_SCRIPT))
+	return
+
+def whileOn(channel, sampleIndex, val, prev):
+	return
+
+def onOnToOff(channel, sampleIndex, val, prev):
+	shadow_engine = storage.fetch('shadow_engine', None)
+	storage.store('shadow_engine', None)
+	if shadow_engine is not None:
+		for name, value in shadow_engine.summary().items():
+			print(f'shadow {name}: {value}')
+	return
+
+def whileOff(channel, sampleIndex, val, prev):
+	return
+
+def onValueChange(channel, sampleIndex, val, prev):
+	return
+
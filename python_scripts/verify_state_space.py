@@ -0,0 +1,726 @@
+import argparse
+import os
+import sys
+import time
+from collections import deque
+
+import numpy as np
+
+from build_up_planner import BuildUpPlanner
+from counter_melody import FURTHEST_SEMITONES
+from roster import START_SCENE
+from song_state import overflowing_fields
+from theory import TABLE_FILE_NAMES, Theory, compile_tables, hash_sources, read_table, split_list
+from voicing import HELD_RANGE_BELOW, VOICED_ROLES, adjust_to_chord_in_scale_mode, bass_note, should_override_scale_mode_notes, voice_lead
+
+# Exhaustive check of every note the driver can generate.
+#
+# Walks the whole reachable state space from the state reset_op_storage starts in, using
+# the same transitions as the beat: key changes (from the key change lists, landing on I in
+# the scene's mode), chord changes (from the chord transitions, with or without a random
+# variation, and only out of resolved variations), variation changes (from the variation
+# transitions) and scene changes (which swap the scale mode). Every harmonic state is a
+# (scale mode, chord, variation, chord notes) tuple.
+#
+# The notes themselves are then worked out as arrays, with every instrument, reachable key
+# and chord change broadcast against each other, and checked for:
+#   - notes outside MIDI (0-127), or outside each instrument's nominal range, including where
+#     held notes can be placed across a key change and how far over the melody a counter-line
+#     can go
+#   - notes that miss the scale mode (or chord) that adjust_to_chord_in_scale_mode fits them to
+#   - references to rows that aren't in the tables, which the driver would crash or skip on
+#   - table rows that are never reached, and states the harmony can't get back to I from
+#   - build-up planner moves the walk never makes (so its paths are covered by the above)
+#
+# Errors are things that break the show; warnings are things worth a look. Exits non-zero on
+# any error (or any warning, with --strict).
+#
+# Usage: python verify_state_space.py [reference_data folder] [--strict]
+
+# region Constants
+
+REFERENCE_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'reference_data')
+
+MIDI_MIN = 0
+MIDI_MAX = 127
+
+# The roster only gives a base note, so an instrument's range is taken to be around it
+SUSTAINED_RANGE_BELOW = 12
+SUSTAINED_RANGE_ABOVE = 24
+MELODY_RANGE_ABOVE = 24 # Melodies start at the base note (which is their minimum)
+
+KEY_CHANGE_CHOICES = 4 # The driver picks random.randint(0, 3) out of each key change list
+CHORD_EXEMPT_INDEX = 4 # adjust_to_chord_in_scale_mode leaves the 5th note of a chord alone
+
+START_KEY = 'C'
+START_STATE = ('ionian', 'I', 'major triad', ('0', '4', '7')) # What reset_op_storage stores
+
+MAX_EXAMPLES = 3
+
+# endregion
+
+# region Classes
+
+class Finding:
+	# Props
+	severity: str # 'error' or 'warning'
+	check: str
+	message: str
+
+	# Methods
+	def __init__(self, severity: str, check: str, message: str):
+		self.severity = severity
+		self.check = check
+		self.message = message
+
+class StateSpace:
+	# Props
+	states: list # (scale mode, chord, variation, chord notes) tuples, index 0 being the start
+	edge_from: np.ndarray
+	edge_to: np.ndarray
+	edge_kind: np.ndarray # One of EDGE_KINDS
+	note_changes: set # (current notes, new notes) of every chord change
+	fitted_chords: dict # Description -> (notes, pitch classes they were fitted to) of every chord adjust_to_chord_in_scale_mode fits
+	melody_contexts: set # (scale mode, chord, variation) a melody can be played over
+	keys: list # Reachable keys
+	key_changes: list # (from key, to key) of every reachable key change
+
+	# Methods
+	def __init__(self, states: list, edges: list, note_changes: set, fitted_chords: dict, melody_contexts: set, keys: list, key_changes: list):
+		self.states = states
+		edge_array = np.array(edges, dtype=np.int32).reshape(-1, 3)
+		self.edge_from = edge_array[:, 0]
+		self.edge_to = edge_array[:, 1]
+		self.edge_kind = edge_array[:, 2]
+		self.note_changes = note_changes
+		self.fitted_chords = fitted_chords
+		self.melody_contexts = melody_contexts
+		self.keys = keys
+		self.key_changes = key_changes
+
+EDGE_KINDS = ('scene', 'key', 'chord', 'variation')
+HARMONIC_EDGE_KINDS = (EDGE_KINDS.index('chord'), EDGE_KINDS.index('variation'))
+
+# endregion
+
+# region Helper Functions
+
+def pitch_class_mask(notes, offset=0):
+	"""Makes a 12-long mask of the pitch classes of some notes.
+
+	Args:
+		notes (list[str]): Notes above a root (0).
+		offset (int, optional): Added to every note first. Defaults to 0.
+
+	Returns:
+		np.ndarray: True for every pitch class in the notes.
+	"""
+	mask = np.zeros(12, dtype=bool)
+	mask[[(int(note) + int(offset)) % 12 for note in notes]] = True
+	return mask
+
+def pad_notes(note_lists, fill=0):
+	"""Packs lists of notes of different lengths into one array.
+
+	Returns:
+		multiple:
+			- np.ndarray: The notes, padded out with fill
+			- np.ndarray: True where there's a real note
+	"""
+	width = max((len(notes) for notes in note_lists), default=0)
+	notes_array = np.full((len(note_lists), width), fill, dtype=np.int32)
+	valid = np.zeros((len(note_lists), width), dtype=bool)
+	for row, notes in enumerate(note_lists):
+		notes_array[row, :len(notes)] = [int(note) for note in notes]
+		valid[row, :len(notes)] = True
+	return notes_array, valid
+
+def describe_notes(notes):
+	return ','.join(str(note) for note in notes)
+
+# endregion
+
+# region Checks
+
+def check_references(tables, theory):
+	"""Checks that everything the tables, melodies and roster refer to is actually defined.
+
+	Args:
+		tables (dict[str, list[dict]]): The raw rows of every reference table.
+		theory (Theory): The compiled theory.
+
+	Returns:
+		list[Finding]: What's missing.
+	"""
+	findings = []
+
+	# Transitions to undefined rows get dropped when compiling, so the beat can't land on them
+	for row in tables['chords.tsv']:
+		for transition in split_list(row['Common Transitions']):
+			if transition not in theory.chords:
+				findings.append(Finding('warning', 'references', f'chord {row["Chord"]} transitions to undefined chord "{transition}" (dropped when compiling)'))
+	for row in tables['chord_variations.tsv']:
+		for transition in split_list(row['Possible Transition Variations']):
+			if transition not in theory.chord_variations:
+				findings.append(Finding('warning', 'references', f'variation {row["Chord Variation"]} transitions to undefined variation "{transition}" (dropped when compiling)'))
+
+	# random.choice() on an empty list would throw on the beat
+	for chord, chord_props in theory.chords.items():
+		if not chord_props['transitions']:
+			findings.append(Finding('error', 'references', f'chord {chord} has no transitions to defined chords'))
+		if chord_props['type'] + ' triad' not in theory.chord_variations:
+			findings.append(Finding('error', 'references', f'chord {chord} lands on undefined variation "{chord_props["type"]} triad" when changing chords without a variant'))
+	for variation, variation_props in theory.chord_variations.items():
+		if not variation_props['transitions']:
+			findings.append(Finding('error', 'references', f'variation {variation} has no transitions to defined variations'))
+
+	for key, key_props in theory.keys.items():
+		if len(key_props['key_changes']) < KEY_CHANGE_CHOICES:
+			findings.append(Finding('error', 'references', f'key {key} has {len(key_props["key_changes"])} key changes, but the driver picks from the first {KEY_CHANGE_CHOICES}'))
+		for key_change in key_props['key_changes']:
+			if key_change not in theory.keys:
+				findings.append(Finding('error', 'references', f'key {key} changes to undefined key "{key_change}"'))
+
+	for mode, mode_notes in theory.scale_notes.items():
+		if len(mode_notes) < 5:
+			findings.append(Finding('error', 'references', f'scale mode {mode} has {len(mode_notes)} notes, too few to build the I chord of a key change'))
+
+	for scene, scene_props in theory.scenes.items():
+		if scene_props['scale_mode'] not in theory.scale_notes:
+			findings.append(Finding('error', 'references', f'scene {scene} uses undefined scale mode "{scene_props["scale_mode"]}"'))
+		if scene_props['next_scene_name'] not in theory.scenes:
+			findings.append(Finding('error', 'references', f'scene {scene} is followed by undefined scene "{scene_props["next_scene_name"]}"'))
+		if scene not in theory.roster:
+			findings.append(Finding('error', 'references', f'scene {scene} has no instruments in the roster'))
+		for bank in ('melody_bank', 'transition_melody_bank'):
+			if not scene_props[bank]:
+				findings.append(Finding('error', 'references', f'scene {scene} has an empty {bank.replace("_", " ")}'))
+
+	# The time of day follows the successors round from the start scene, so anything off that loop never plays
+	if START_SCENE not in theory.scenes:
+		findings.append(Finding('error', 'references', f'the show starts on undefined scene "{START_SCENE}"'))
+	else:
+		scene = START_SCENE
+		played_scenes = set()
+		while scene in theory.scenes and scene not in played_scenes:
+			played_scenes.add(scene)
+			scene = theory.scenes[scene]['next_scene_name']
+		if scene != START_SCENE:
+			findings.append(Finding('error', 'references', f'the scenes after {START_SCENE} never lead back to it'))
+		for scene in theory.scenes:
+			if scene not in played_scenes:
+				findings.append(Finding('warning', 'references', f'scene {scene} is never reached from {START_SCENE}, so it never plays'))
+
+	melody_numbers = sorted({melody_number for scene_props in theory.scenes.values() for bank in ('melody_bank', 'transition_melody_bank') for melody_number in scene_props[bank]})
+	for melody_number in melody_numbers:
+		melody = theory.melodies.get(melody_number)
+		if melody is None:
+			findings.append(Finding('error', 'references', f'melody {melody_number} is in a scene\'s bank, but missing from the melodies'))
+			continue
+		for note_index, _, _, _ in melody['rhythm']:
+			if not 0 <= note_index < len(melody['notes']):
+				findings.append(Finding('error', 'references', f'melody {melody_number} ({melody["name"]}) plays note {note_index}, but only has {len(melody["notes"])}'))
+
+	# Packing the song state would throw on the beat
+	for description in overflowing_fields(theory):
+		findings.append(Finding('error', 'references', description))
+
+	return findings
+
+def explore(theory):
+	"""Walks every state the harmony can reach from the start state.
+
+	Args:
+		theory (Theory): The compiled theory.
+
+	Returns:
+		StateSpace: The reachable states, and the transitions between them.
+	"""
+	scene_modes = sorted({scene_props['scale_mode'] for scene_props in theory.scenes.values() if scene_props['scale_mode'] in theory.scale_notes})
+	scale_masks = {mode: pitch_class_mask(mode_notes) for mode, mode_notes in theory.scale_notes.items()}
+
+	states = [START_STATE]
+	state_indexes = {START_STATE: 0}
+	edges = []
+	note_changes = set()
+	fitted_chords = {}
+	melody_contexts = set()
+
+	def add_edge(from_index, state, kind):
+		to_index = state_indexes.get(state)
+		if to_index is None:
+			to_index = len(states)
+			state_indexes[state] = to_index
+			states.append(state)
+			queue.append(to_index)
+		edges.append((from_index, to_index, EDGE_KINDS.index(kind)))
+		if kind != 'scene':
+			note_changes.add((states[from_index][3], state[3]))
+
+	queue = deque([0])
+	while queue:
+		state_index = queue.popleft()
+		mode, chord, variation, notes = states[state_index]
+		melody_contexts.add((mode, chord, variation))
+		scale_notes = theory.scale_notes[mode]
+		variation_notes = theory.chord_variations[variation]['notes']
+
+		# A scene change swaps the scale mode, and leaves the rest alone
+		for scene_mode in scene_modes:
+			if scene_mode != mode:
+				add_edge(state_index, (scene_mode, chord, variation, notes), 'scene')
+
+		# A key change always lands on I in the scene's mode
+		for scene_mode in scene_modes:
+			mode_notes = theory.scale_notes[scene_mode]
+			if len(mode_notes) >= 5:
+				add_edge(state_index, (scene_mode, 'I', 'major triad', (mode_notes[0], mode_notes[2], mode_notes[4])), 'key')
+
+		# A chord change only happens out of a resolved variation, either onto the chord's plain notes or a random variant
+		if theory.chord_variations[variation]['resolution'] != 'tension':
+			for new_chord in theory.chords[chord]['transitions']:
+				new_chord_props = theory.chords[new_chord]
+				plain_variation = new_chord_props['type'] + ' triad'
+				melody_contexts.add((mode, new_chord, 'major triad')) # The beat's melody goes over 'major triad', whatever gets stored
+				if plain_variation in theory.chord_variations:
+					add_edge(state_index, (mode, new_chord, plain_variation, tuple(new_chord_props['notes'])), 'chord')
+				for new_variation, new_variation_props in theory.chord_variations.items():
+					override = should_override_scale_mode_notes(new_variation_props['type'], new_chord_props['type'])
+					new_notes = adjust_to_chord_in_scale_mode(
+						notes=new_variation_props['notes'],
+						scale_mode_notes=scale_notes,
+						chord_base_note=new_chord_props['base_note'],
+						chord_notes=variation_notes, # The driver fits the variant to the variation it's leaving
+						mode="chord",
+						override_scale_mode_notes=override,
+					)
+					fitted_to = pitch_class_mask(variation_notes, new_chord_props['base_note']) if override else scale_masks[mode]
+					fitted_chords.setdefault(f'{new_chord} {new_variation} (from {chord} {variation}) in {mode}', (new_notes, fitted_to))
+					add_edge(state_index, (mode, new_chord, new_variation, tuple(new_notes)), 'chord')
+
+		# A variation change follows the variation transitions
+		chord_props = theory.chords[chord]
+		for new_variation in theory.chord_variations[variation]['transitions']:
+			new_variation_props = theory.chord_variations[new_variation]
+			override = should_override_scale_mode_notes(new_variation_props['type'], chord_props['type'])
+			new_notes = adjust_to_chord_in_scale_mode(
+				notes=new_variation_props['notes'],
+				scale_mode_notes=scale_notes,
+				chord_base_note=chord_props['base_note'],
+				chord_notes=variation_notes,
+				mode="chord",
+				override_scale_mode_notes=override,
+			)
+			fitted_to = pitch_class_mask(variation_notes, chord_props['base_note']) if override else scale_masks[mode]
+			fitted_chords.setdefault(f'{chord} {new_variation} (from {variation}) in {mode}', (new_notes, fitted_to))
+			add_edge(state_index, (mode, chord, new_variation, tuple(new_notes)), 'variation')
+
+	# Keys move independently of the harmony, so walk them on their own
+	keys = [START_KEY]
+	key_changes = []
+	key_queue = deque(keys)
+	while key_queue:
+		key = key_queue.popleft()
+		for key_change in theory.keys[key]['key_changes'][:KEY_CHANGE_CHOICES]:
+			if key_change not in theory.keys:
+				continue
+			if (key, key_change) not in key_changes:
+				key_changes.append((key, key_change))
+			if key_change not in keys:
+				keys.append(key_change)
+				key_queue.append(key_change)
+
+	return StateSpace(states, edges, note_changes, fitted_chords, melody_contexts, keys, key_changes)
+
+def check_graph(theory, space):
+	"""Checks for table rows that are never reached, and states the harmony gets stuck in.
+
+	Args:
+		theory (Theory): The compiled theory.
+		space (StateSpace): The reachable states.
+
+	Returns:
+		list[Finding]: What's unreachable or stuck.
+	"""
+	findings = []
+
+	for row_kind, names, position in (('key', theory.keys, None), ('chord', theory.chords, 1), ('variation', theory.chord_variations, 2)):
+		reached = set(space.keys) if position is None else {state[position] for state in space.states}
+		for name in names:
+			if name not in reached:
+				findings.append(Finding('warning', 'reachability', f'{row_kind} {name} is never reached'))
+
+	# Dead ends: states the chord and variation changes can't move on from
+	harmonic = np.isin(space.edge_kind, HARMONIC_EDGE_KINDS) & (space.edge_from != space.edge_to)
+	has_exit = np.zeros(len(space.states), dtype=bool)
+	has_exit[space.edge_from[harmonic]] = True
+	for state_index in np.flatnonzero(~has_exit)[:MAX_EXAMPLES].tolist():
+		mode, chord, variation, notes = space.states[state_index]
+		findings.append(Finding('error', 'reachability', f'dead end at {chord} {variation} in {mode} (notes {describe_notes(notes)})'))
+
+	# Traps: states the harmony can never get back to I from (without a key change to rescue it)
+	home = np.array([state[1] == 'I' for state in space.states], dtype=bool)
+	can_get_home = home.copy()
+	harmonic_from, harmonic_to = space.edge_from[harmonic], space.edge_to[harmonic]
+	while True:
+		reaches = np.zeros(len(space.states), dtype=bool)
+		reaches[harmonic_from[can_get_home[harmonic_to]]] = True
+		updated = can_get_home | reaches
+		if (updated == can_get_home).all():
+			break
+		can_get_home = updated
+	trapped = np.flatnonzero(~can_get_home)
+	if len(trapped):
+		examples = ', '.join(f'{space.states[i][1]} {space.states[i][2]} in {space.states[i][0]}' for i in trapped[:MAX_EXAMPLES].tolist())
+		findings.append(Finding('warning', 'reachability', f'{len(trapped)} states never get back to I without a key change (like {examples})'))
+
+	return findings
+
+def check_build_up_moves(theory, space):
+	"""Checks that the build-up planner only makes moves the walk already took, so the notes checked cover its paths too.
+
+	Args:
+		theory (Theory): The compiled theory.
+		space (StateSpace): The reachable states.
+
+	Returns:
+		list[Finding]: The planner's moves out of reachable states that the walk never made.
+	"""
+	planner = BuildUpPlanner()
+	planner.build_graph(theory)
+
+	# Every (from state, kind, to chord, to variation) the walk made
+	walked = {
+		(from_index, EDGE_KINDS[kind], space.states[to_index][1], space.states[to_index][2])
+		for from_index, to_index, kind in zip(space.edge_from.tolist(), space.edge_to.tolist(), space.edge_kind.tolist())
+	}
+
+	missing = []
+	for state_index, (_, chord, variation, _) in enumerate(space.states):
+		for successor_id, move in planner.successors[planner.state_ids[(chord, variation)]]:
+			new_chord, new_variation = planner.states[successor_id]
+			if (state_index, move, new_chord, new_variation) not in walked:
+				missing.append((space.states[state_index], move, new_chord, new_variation))
+
+	if not missing:
+		return []
+	examples = '; '.join(f'{chord} {variation} in {mode} -> {new_chord} {new_variation} ({move})' for (mode, chord, variation, _), move, new_chord, new_variation in missing[:MAX_EXAMPLES])
+	return [Finding('error', 'build-up', f'the build-up planner can make {len(missing)} moves the walk never makes, so their notes go unchecked ({examples})')]
+
+def check_sustained_notes(theory, space):
+	"""Checks the notes of every bass, chords and effects instrument, over every reachable chord change and key.
+
+	Args:
+		theory (Theory): The compiled theory.
+		space (StateSpace): The reachable states.
+
+	Returns:
+		list[Finding]: The notes that are out of range or out of the scale.
+	"""
+	findings = []
+	changes = sorted(space.note_changes)
+	key_offsets = np.array([theory.keys[key]['offset'] for key in space.keys], dtype=np.int32)
+
+	# Out of scale: adjust_to_chord_in_scale_mode only steps a note down once, which doesn't always land it in the scale mode (or chord)
+	descriptions = list(space.fitted_chords)
+	fitted_notes, fitted_valid = pad_notes([space.fitted_chords[description][0] for description in descriptions])
+	fitted_to = np.array([space.fitted_chords[description][1] for description in descriptions], dtype=bool).reshape(-1, 12)
+	fitted_valid[:, CHORD_EXEMPT_INDEX:CHORD_EXEMPT_INDEX + 1] = False
+	misses = fitted_valid & ~np.take_along_axis(fitted_to, fitted_notes % 12, axis=1)
+	missed = np.flatnonzero(misses.any(axis=1))
+	if len(missed):
+		examples = '; '.join(f'{descriptions[index]} plays {describe_notes(space.fitted_chords[descriptions[index]][0])}' for index in missed[:MAX_EXAMPLES].tolist())
+		findings.append(Finding('warning', 'scale', f'{len(missed)} of {len(descriptions)} fitted chords still miss their scale mode or chord after adjusting ({examples})'))
+
+	# Voicings only depend on the chord change and the voice count, so work each out once
+	voicings = {}
+	for scene_instruments in theory.roster.values():
+		for instrument_props in scene_instruments.values():
+			if instrument_props['instrument_role'] not in VOICED_ROLES:
+				continue
+			voicing_key = (instrument_props['instrument_role'] == 'bass', instrument_props['num_voices'])
+			if voicing_key not in voicings:
+				voicings[voicing_key] = pad_notes([
+					bass_note(list(new)) if voicing_key[0] else voice_lead(list(current), list(new), voicing_key[1])
+					for current, new in changes
+				])
+
+	# Then broadcast every instrument against every key and voicing: (key, chord change, voice)
+	for scene, scene_instruments in theory.roster.items():
+		for instrument_name, instrument_props in scene_instruments.items():
+			role = instrument_props['instrument_role']
+			base_note = int(instrument_props['base_note'])
+			if role == 'percussion':
+				if not MIDI_MIN <= base_note <= MIDI_MAX:
+					findings.append(Finding('error', 'range', f'{instrument_name} ({scene}) hits note {base_note}, outside MIDI'))
+				continue
+			if role not in VOICED_ROLES:
+				continue
+
+			voicing, voicing_valid = voicings[(role == 'bass', instrument_props['num_voices'])]
+			midi_notes = base_note + key_offsets[:, None, None] + voicing[None, :, :]
+			in_use = np.broadcast_to(voicing_valid[None, :, :], midi_notes.shape)
+			findings += range_findings(instrument_name, scene, midi_notes, in_use, base_note - SUSTAINED_RANGE_BELOW, base_note + SUSTAINED_RANGE_ABOVE, space.keys, lambda index: describe_notes(changes[index][0]) + ' -> ' + describe_notes(changes[index][1]))
+
+	return findings
+
+def check_key_change_notes(theory, space):
+	"""Checks where every playing bass, chords and effects instrument can move its held notes to, over every reachable key change.
+
+	Args:
+		theory (Theory): The compiled theory.
+		space (StateSpace): The reachable states.
+
+	Returns:
+		list[Finding]: The placements that are out of range.
+	"""
+	findings = []
+	if not space.key_changes:
+		return findings
+	key_changes = space.key_changes
+	from_offsets = np.array([theory.keys[key]['offset'] for key, _ in key_changes], dtype=np.int32)
+	to_offsets = np.array([theory.keys[key]['offset'] for _, key in key_changes], dtype=np.int32)
+
+	# A key change lands on I in the scene's mode, which the bass only plays the root of
+	scene_modes = sorted({scene_props['scale_mode'] for scene_props in theory.scenes.values() if len(theory.scale_notes.get(scene_props['scale_mode'], ())) >= 5})
+	entry_chords = [[theory.scale_notes[mode][0], theory.scale_notes[mode][2], theory.scale_notes[mode][4]] for mode in scene_modes]
+	entry_notes = {
+		is_bass: np.array([[int(note) for note in (bass_note(chord_notes) if is_bass else chord_notes)] for chord_notes in entry_chords], dtype=np.int32)
+		for is_bass in (True, False)
+	}
+
+	# lead_across_keys places each held note within the octaves the standard voicing uses in either key, down to
+	# HELD_RANGE_BELOW (see HarmonicPlan.modulated_instrument_notes), on a pitch class of the new chord, so the lowest and
+	# highest such note of each (key change, scale mode) bound where it can go
+	for scene, scene_instruments in theory.roster.items():
+		for instrument_name, instrument_props in scene_instruments.items():
+			role = instrument_props['instrument_role']
+			if role not in VOICED_ROLES:
+				continue
+			is_bass = role == 'bass'
+			base_note = int(instrument_props['base_note'])
+			low = np.maximum(base_note + np.minimum(from_offsets, to_offsets) - (0 if is_bass else 12), base_note - HELD_RANGE_BELOW)[:, None, None]
+			high = (base_note + np.maximum(from_offsets, to_offsets) + 11)[:, None, None]
+			pitch_classes = (base_note + to_offsets[:, None, None] + entry_notes[is_bass][None, :, :]) % 12
+			placed = np.concatenate((low + (pitch_classes - low) % 12, high - (high - pitch_classes) % 12), axis=2) # (key change, scale mode, note)
+			findings += range_findings(
+				f'{instrument_name} across key changes', scene,
+				placed, None,
+				base_note - SUSTAINED_RANGE_BELOW, base_note + SUSTAINED_RANGE_ABOVE,
+				[f'the change from {from_key} to {to_key}' for from_key, to_key in key_changes],
+				lambda index: f'I in {scene_modes[index]}',
+			)
+
+	return findings
+
+def check_melody_notes(theory, space):
+	"""Checks the notes of every melody instrument (and the counter-lines under them), over every melody, chord, variation, scale mode and key it can be played in.
+
+	Args:
+		theory (Theory): The compiled theory.
+		space (StateSpace): The reachable states.
+
+	Returns:
+		list[Finding]: The notes that are out of range or out of the scale.
+	"""
+	findings = []
+	contexts = sorted(space.melody_contexts)
+	key_offsets = np.array([theory.keys[key]['offset'] for key in space.keys], dtype=np.int32)
+	melody_instruments = [
+		(instrument_name, scene, int(instrument_props['base_note']))
+		for scene, scene_instruments in theory.roster.items()
+		for instrument_name, instrument_props in scene_instruments.items()
+		if instrument_props['instrument_role'] == 'melody'
+	]
+	base_notes = np.array([base_note for _, _, base_note in melody_instruments], dtype=np.int32)
+
+	# Melodies that share the same data (like the main theme) only need checking once
+	melodies = {}
+	for melody_number, melody in sorted(theory.melodies.items()):
+		melodies.setdefault(id(melody), (melody_number, melody))
+
+	missed_scale = {}
+	counter_ranges = {} # Melody number -> (highest counter note from the base note, where it is, how many lines go past MIDI)
+	for melody_number, melody in melodies.values():
+		if any(not 0 <= note_index < len(melody['notes']) for note_index, _, _, _ in melody['rhythm']):
+			continue # Already reported
+
+		# Fit the melody to every context (keys only shift the result, so leave them for the arrays)
+		adjusted = []
+		rules = []
+		for mode, chord, variation in contexts:
+			chord_props = theory.chords[chord]
+			variation_props = theory.chord_variations[variation]
+			override = should_override_scale_mode_notes(variation_props['type'], chord_props['type'])
+			adjusted.append(adjust_to_chord_in_scale_mode(
+				notes=melody['notes'],
+				scale_mode_notes=theory.scale_notes[mode],
+				chord_base_note=chord_props['base_note'],
+				chord_notes=variation_props['notes'],
+				mode="melody",
+				override_scale_mode_notes=override,
+				ignore_notes=melody['ignore_notes'],
+			))
+			rules.append(pitch_class_mask(variation_props['notes'], chord_props['base_note']) if override else pitch_class_mask(theory.scale_notes[mode]))
+		adjusted = np.array(adjusted, dtype=np.int32) # (context, note)
+
+		# Out of scale: same rule as the chords, but notes in ignore_notes are left alone on purpose
+		pitch_classes = adjusted % 12
+		misses = ~np.take_along_axis(np.array(rules), pitch_classes, axis=1) & ~np.isin(pitch_classes, melody['ignore_notes'])
+		for context_index in np.flatnonzero(misses.any(axis=1)).tolist():
+			missed_scale.setdefault((melody_number, contexts[context_index][1], contexts[context_index][2]), contexts[context_index][0])
+
+		# Then (instrument, context, key, note): shift up until the lowest note reaches the base note, like the driver
+		note_indexes = np.array([note_index for note_index, _, _, _ in melody['rhythm']], dtype=np.int32)
+		octave_shifts = np.array([octave_shift for _, _, _, octave_shift in melody['rhythm']], dtype=np.int32)
+		unshifted = adjusted[None, :, None, :] + key_offsets[None, None, :, None]
+		lowest = unshifted.min(axis=3)
+		octaves_up = np.maximum(0, -((lowest - base_notes[:, None, None]) // 12))
+		played = unshifted[..., note_indexes] + 12 * octaves_up[..., None] + octave_shifts
+
+		for instrument_index, (instrument_name, scene, base_note) in enumerate(melody_instruments):
+			findings += range_findings(
+				f'{instrument_name} melody {melody_number}', scene,
+				played[instrument_index].transpose(1, 0, 2), None,
+				None, None, space.keys,
+				lambda index: f'{contexts[index][1]} {contexts[index][2]} in {contexts[index][0]}',
+			)
+
+		# The range is the same shape for every melody instrument, so report it once per melody
+		relative = played - base_notes[:, None, None, None]
+		outside_range = (relative < 0) | (relative > MELODY_RANGE_ABOVE)
+		if outside_range.any():
+			instrument_index, context_index, key_index, _ = (int(index) for index in np.argwhere(outside_range)[0])
+			mode, chord, variation = contexts[context_index]
+			findings.append(Finding('warning', 'range', (
+				f'melody {melody_number} ({melody["name"]}) leaves the range of {int(outside_range.any(axis=(1, 2, 3)).sum())} melody instruments, '
+				f'going {int(relative.min()):+d} to {int(relative.max()):+d} from their base note (like {melody_instruments[instrument_index][0]} in {space.keys[key_index]} on {chord} {variation} in {mode})'
+			)))
+
+		# A counter-line never goes under the base note, and each of its notes is within a 10th of the melody's (over it,
+		# when the melody's too low for a line to fit under it or none does), so that bounds it whatever the harmony
+		counter_high = relative.max(axis=3) + FURTHEST_SEMITONES
+		furthest = np.unravel_index(int(np.argmax(counter_high)), counter_high.shape)
+		counter_ranges[melody_number] = (int(counter_high.max()), furthest, int((counter_high + base_notes[:, None, None] > MIDI_MAX).sum()))
+
+	# Counter-lines past MIDI are dropped by the generator, so they're only worth a warning, like leaving the range
+	past_midi = [melody_number for melody_number, (_, _, num_past_midi) in counter_ranges.items() if num_past_midi]
+	if past_midi:
+		findings.append(Finding('warning', 'range', f'the counter-lines of {len(past_midi)} melodies can go past MIDI in some keys, where the melody plays without one (like melody {past_midi[0]})'))
+	outside_range = [melody_number for melody_number, (highest, _, _) in counter_ranges.items() if highest > MELODY_RANGE_ABOVE]
+	if outside_range:
+		melody_number = max(outside_range, key=lambda number: counter_ranges[number][0])
+		instrument_index, context_index, key_index = (int(index) for index in counter_ranges[melody_number][1])
+		mode, chord, variation = contexts[context_index]
+		findings.append(Finding('warning', 'range', (
+			f'the counter-lines of {len(outside_range)} melodies can leave the range of their melody instruments, reaching up to '
+			f'{counter_ranges[melody_number][0]:+d} from the base note over the melody (like melody {melody_number} on {melody_instruments[instrument_index][0]} in {space.keys[key_index]} on {chord} {variation} in {mode})'
+		)))
+
+	if missed_scale:
+		examples = '; '.join(f'melody {melody_number} over {chord} {variation} in {mode}' for (melody_number, chord, variation), mode in list(missed_scale.items())[:MAX_EXAMPLES])
+		findings.append(Finding('warning', 'scale', f'{len(missed_scale)} melody fits still miss their scale mode or chord after adjusting ({examples})'))
+
+	return findings
+
+def range_findings(instrument_name, scene, midi_notes, in_use, range_low, range_high, keys, describe_change):
+	"""Finds the notes of an instrument outside MIDI or outside its range.
+
+	Args:
+		instrument_name (str): What to call the instrument in the findings.
+		scene (str): The instrument's scene.
+		midi_notes (np.ndarray): Every note it can play, as (key, change, note).
+		in_use (np.ndarray): Which of those notes are real, or None if they all are.
+		range_low (int): The lowest note of its range, or None to only check MIDI.
+		range_high (int): The highest note of its range, or None to only check MIDI.
+		keys (list[str]): The keys of the first axis.
+		describe_change (function): Describes an index of the second axis.
+
+	Returns:
+		list[Finding]: One error if anything's outside MIDI, and one warning if anything's outside the range.
+	"""
+	findings = []
+	in_use = np.ones(midi_notes.shape, dtype=bool) if in_use is None else in_use
+	limits_to_check = [('error', MIDI_MIN, MIDI_MAX, 'MIDI')]
+	if range_low is not None:
+		limits_to_check.append(('warning', range_low, range_high, f'its range {range_low}-{range_high}'))
+	for severity, low, high, limits in limits_to_check:
+		outside = in_use & ((midi_notes < low) | (midi_notes > high))
+		if not outside.any():
+			continue
+		lowest = int(midi_notes[in_use].min())
+		highest = int(midi_notes[in_use].max())
+		key_index, change_index, _ = (int(index) for index in np.argwhere(outside)[0])
+		findings.append(Finding(severity, 'range', (
+			f'{instrument_name} ({scene}) plays {int(outside.sum())} notes outside {limits}, reaching {lowest}-{highest} '
+			f'(like in {keys[key_index]} on {describe_change(change_index)})'
+		)))
+		if severity == 'error':
+			break # Anything outside MIDI is outside the range too
+	return findings
+
+# endregion
+
+def verify(reference_dir):
+	"""Runs every check against a folder of reference tables (with the melodies and roster in the code).
+
+	Args:
+		reference_dir (str): The folder holding the reference TSVs.
+
+	Returns:
+		multiple:
+			- list[Finding]: Everything found
+			- StateSpace: The reachable states
+	"""
+	tables = {file_name: read_table(reference_dir, file_name) for file_name in TABLE_FILE_NAMES}
+	theory = Theory(compile_tables(tables), hash_sources(reference_dir), 'tsv')
+	return verify_theory(tables, theory)
+
+def verify_theory(tables, theory):
+	"""Runs every check against reference tables that are already read and compiled.
+
+	Args:
+		tables (dict[str, list[dict]]): The rows of every reference table, keyed by TSV file name.
+		theory (Theory): The theory compiled from them.
+
+	Returns:
+		multiple:
+			- list[Finding]: Everything found
+			- StateSpace: The reachable states
+	"""
+	findings = check_references(tables, theory)
+	if any(finding.severity == 'error' for finding in findings):
+		return findings, None # The walk would trip over the same missing rows
+
+	space = explore(theory)
+	findings += check_graph(theory, space)
+	findings += check_build_up_moves(theory, space)
+	findings += check_sustained_notes(theory, space)
+	findings += check_key_change_notes(theory, space)
+	findings += check_melody_notes(theory, space)
+	return findings, space
+
+def main():
+	parser = argparse.ArgumentParser(description='Check every note the driver can generate from the reference tables, melodies and roster.')
+	parser.add_argument('reference_dir', nargs='?', default=REFERENCE_DATA_DIR, help='the folder holding the reference TSVs')
+	parser.add_argument('--strict', action='store_true', help='fail on warnings too')
+	args = parser.parse_args()
+
+	start = time.perf_counter()
+	findings, space = verify(args.reference_dir)
+	elapsed_ms = (time.perf_counter() - start) * 1000
+
+	for severity in ('error', 'warning'):
+		for finding in findings:
+			if finding.severity == severity:
+				print(f'{severity} [{finding.check}] {finding.message}')
+
+	errors = sum(finding.severity == 'error' for finding in findings)
+	warnings = len(findings) - errors
+	if space is not None:
+		print(f'\n{len(space.states)} states, {len(space.edge_from)} transitions, {len(space.note_changes)} chord changes, {len(space.melody_contexts)} melody contexts and {len(space.keys)} keys checked')
+	print(f'{errors} errors, {warnings} warnings in {elapsed_ms:.0f} ms')
+	sys.exit(1 if errors or (args.strict and warnings) else 0)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,350 @@
+import itertools
+from typing import List, Dict, Tuple
+
+# Batched voicing for the sustained (bass, chords, effects) instruments of a scene.
+#
+# Instead of voice-leading every instrument on its own, instruments are grouped by
+# (base_note, num_voices); each group's voicing and absolute MIDI notes are only
+# worked out once per beat (in a HarmonicPlan shared by every audible scene), and
+# each instrument then just diffs its playing notes. The driver keeps one plan and
+# resets it every beat, and the MIDI notes are looked up as strings rather than built,
+# so a beat allocates as little as it can.
+#
+# Voicings are worked out relative to the key, so on a key change every note would move
+# with the key. Instead, instruments that are playing move to the placement of the new
+# chord that keeps the most of their notes where they are (see lead_across_keys).
+#
+# The chord and melody adjustment to a scale mode lives here too. This module has no
+# TouchDesigner dependencies, so it can be imported by the driver DAT, the offline
+# benchmark and the state-space verifier alike.
+
+# region Constants
+
+VOICED_ROLES = ('bass', 'chords', 'effects')
+BORROWED_CHORD_TYPES = ['II', 'III', 'VI', 'VII']
+MIDI_NOTE_STRINGS = tuple(str(note) for note in range(128)) # MIDI notes as strings, like in playing_notes
+HELD_RANGE_BELOW = 12 # Across a key change, held notes never go further than this under the base note
+
+# endregion
+
+# region Helper Functions
+
+def find_closest_note(note, target_notes):
+	"""Finds the closest note in a list of target notes.
+
+	Args:
+		note (int): The current note, in a position above the root (0) of a chord.
+		target_notes (list[int]): A list of target notes, in positions above the root (0) of a chord.
+
+	Returns:
+		ints:
+			- int: The new closest note
+			- int: The original note
+	"""
+	# Find the closest note in target_notes to the given note, considering both current and previous octaves
+	# The current octave goes first, so ties go to it (without building a list of candidates)
+	closest_note = original = closest_distance = None
+	for octave_shift in (0, -12):
+		for target_note in target_notes:
+			distance = abs(target_note + octave_shift - note)
+			if closest_distance is None or distance < closest_distance:
+				closest_note, original, closest_distance = target_note + octave_shift, target_note, distance
+	return closest_note, original
+
+def normalize_notes(notes):
+	"""Normalizes notes to a single octave.
+
+	Args:
+		notes (list[str]): A list of string notes, each a position above a root (0).
+
+	Returns:
+		list[int]: A list of notes normalized to one octave.
+	"""
+	return [int(note) % 12 for note in notes]
+
+def voice_lead(current_chord_notes, new_chord_notes, num_voices):
+	"""Voice-leads the first num_voices notes of the current chord onto the new chord.
+
+	Args:
+		current_chord_notes (list[str]): The old (previous) notes that were played in a chord, in positions above a root (0).
+		new_chord_notes (list[str]): The new notes that were played in a chord, in positions above a root (0).
+		num_voices (int): The number of voices of the instrument.
+
+	Returns:
+		list[int]: The new chord's notes, in positions above a root (0).
+	"""
+	new_chord = []
+	current_notes = normalize_notes(current_chord_notes[:num_voices])
+	target_notes = normalize_notes(new_chord_notes[:num_voices])
+	for note in current_notes:
+		# While we have notes to voice-lead on:
+		if target_notes:
+			closest_note, original = find_closest_note(note, target_notes)
+			new_chord.append(note - (note % 12) + closest_note)
+			target_notes.remove(original)  # Remove the original target note to prevent reuse
+		else:
+			break  # No more target notes to match
+	new_chord.extend(target_notes)  # Add remaining target notes if any
+
+	return new_chord
+
+def midi_note_string(note):
+	"""Gets a MIDI note as a string, without making a new string for notes in MIDI range."""
+	return MIDI_NOTE_STRINGS[note] if 0 <= note < 128 else str(note)
+
+def place_note(note, pitch_class, low, high):
+	"""Gets the note of a pitch class nearest to another note, within a range.
+
+	Args:
+		note (int): The MIDI note to stay near.
+		pitch_class (int): The pitch class (0-11) of the note to place.
+		low (int): The lowest MIDI note allowed.
+		high (int): The highest MIDI note allowed.
+
+	Returns:
+		int: The placed MIDI note.
+	"""
+	above = note + (pitch_class - note) % 12
+	below = above - 12
+	for candidate in ((above, below) if above - note <= note - below else (below, above)):
+		if low <= candidate <= high:
+			return candidate
+	return low + (pitch_class - low) % 12
+
+def lead_across_keys(held_notes, standard_notes, low, high):
+	"""Places a new chord against the notes an instrument is holding, moving as few voices (and as little) as possible.
+
+	Every way of pairing the held notes with the new chord's notes is tried (there are only a few voices), each
+	held note going to the nearest note of its partner's pitch class within the range. Voices the new chord
+	doesn't have are released, and voices it adds go where the standard voicing puts them.
+
+	Args:
+		held_notes (list[int]): The MIDI notes being held, in voice order.
+		standard_notes (list[int]): The MIDI notes of the new chord's standard voicing.
+		low (int): The lowest MIDI note allowed.
+		high (int): The highest MIDI note allowed.
+
+	Returns:
+		list[int]: The new MIDI notes, with the held voices first (in their order).
+	"""
+	if len(held_notes) <= len(standard_notes):
+		pairings = ((range(len(held_notes)), target_order) for target_order in itertools.permutations(range(len(standard_notes)), len(held_notes)))
+	else:
+		pairings = ((held_order, range(len(standard_notes))) for held_order in itertools.permutations(range(len(held_notes)), len(standard_notes)))
+
+	best_cost = best_pairs = None
+	for held_order, target_order in pairings:
+		pairs = [(held_index, target_index, place_note(held_notes[held_index], standard_notes[target_index] % 12, low, high)) for held_index, target_index in zip(held_order, target_order)]
+		cost = (sum(note != held_notes[held_index] for held_index, _, note in pairs), sum(abs(note - held_notes[held_index]) for held_index, _, note in pairs))
+		if best_cost is None or cost < best_cost:
+			best_cost, best_pairs = cost, pairs
+
+	paired_targets = {target_index for _, target_index, _ in best_pairs}
+	return [note for _, _, note in sorted(best_pairs)] + [note for target_index, note in enumerate(standard_notes) if target_index not in paired_targets]
+
+def bass_note(new_chord_notes):
+	"""Gets the root of a chord, which is all a bass instrument plays.
+
+	Args:
+		new_chord_notes (list[str]): The new notes that were played in a chord, in positions above a root (0).
+
+	Returns:
+		list[int]: The root note, normalized to one octave.
+	"""
+	return normalize_notes([min(int(note) for note in new_chord_notes)])
+
+# endregion
+
+# region Scale Mode Adjustment
+
+def should_override_scale_mode_notes(variation_type, chord_type):
+	"""Checks whether a chord variation gets fitted to its chord's notes, rather than to the scale mode.
+
+	Args:
+		variation_type (str): The type of the chord variation (major, diminished, etc.)
+		chord_type (str): The type of the chord.
+
+	Returns:
+		bool: True if the notes should be adjusted to the chord instead of the scale mode.
+	"""
+	return variation_type != 'major' and variation_type != 'suspended' and variation_type != 'dominant' and chord_type not in BORROWED_CHORD_TYPES
+
+def adjust_to_chord_in_scale_mode(notes, scale_mode_notes, chord_base_note, chord_notes, mode, ignore_notes=[], override_scale_mode_notes=False):
+	"""Changes a given set of notes to a specific chord (i.e., IV) in a given scale mode (i.e., dorian).
+
+	Args:
+		notes (list[str]): An array of string numbers, indicating their position above the root of the chord (0).
+		scale_mode_notes (list[str]): An array of string numbers, which indicate all notes in a scale mode based on their position above the root (0).
+		chord_base_note (str): The base note of the chord, represented by a position above the root (0).
+		chord_notes (list[str]): An array of string numbers, which indicate all notes in a chord variation based on their position above the root (0).
+		mode (str): "chord" mode (which ignores specific chord notes) or "melody" mode (which ignores notes specified in ignore_notes)
+		ignore_notes (list[int], optional): A list of note positions that we should not adjust to a given mode. Defaults to [].
+		override_scale_mode_notes (bool, optional): Should we override the scale mode notes? Defaults to False.
+
+	Returns:
+		str[]: A string array of notes, adjusted to the above parameters.
+	"""
+
+	# Convert the input lists from strings to integers (only the one we check against, depending on the override)
+	chord_base_note = int(chord_base_note)
+	if override_scale_mode_notes:
+		fitting_notes = [(int(note) + chord_base_note) % 12 for note in chord_notes]  # Modulo 12 for chromatic scale
+	else:
+		fitting_notes = [int(note) % 12 for note in scale_mode_notes]
+
+	# Check each note and adjust it to the proper key / scale mode / chord, straight into the output list
+	new_notes = []
+	for i, note in enumerate(notes):
+		note = int(note) + chord_base_note
+		if ((mode == "chord" and i != 4) or (mode == "melody" and note % 12 not in ignore_notes)):
+			# Adjust all items NOT in the scale mode OR chord, depending on the override
+			if note % 12 not in fitting_notes:
+				note = note - 1  # Adjust down chromatically until it fits
+
+		# Convert the result back to strings
+		new_notes.append(str(note))
+	return new_notes
+
+def adjust_melody_to_proper_octave(notes, base_note, scale_mode_notes, chord_base_note, chord_notes, override_scale_mode_notes, key_offset, ignore_notes=[]):
+	"""Adjusts a melody to a proper scale mode and octave.
+
+	Args:
+		notes (list[str]): An array of string numbers, indicating their position above the root of the chord (0).
+		base_note (str): The "base" (lowest) note for a given melody instrument.
+		scale_mode_notes (list[str]): An array of string numbers, which indicate all notes in a scale mode based on their position above the root (0).
+		chord_base_note (str): The base note of the chord, represented by a position above the root (0).
+		chord_notes (list[str]): An array of string numbers, which indicate all notes in a chord variation based on their position above the root (0).
+		override_scale_mode_notes (bool): Should we override the scale mode notes?
+		key_offset (str): The pitch offset for a given key.
+		ignore_notes (list[int], optional): A list of note positions that we should not adjust to a given mode. Defaults to [].
+
+	Returns:
+		list[int]: A list of melody notes adjusted to a given octave/key/scale mode.
+	"""
+	# Get the adjusted notes, then shift them to the proper octave for the instrument
+	melody_notes = adjust_to_chord_in_scale_mode(
+		notes=notes,
+		scale_mode_notes=scale_mode_notes,
+		chord_base_note=chord_base_note,
+		chord_notes=chord_notes,
+		mode="melody",
+		override_scale_mode_notes=override_scale_mode_notes,
+		ignore_notes=ignore_notes
+	)
+	# Shift up by whole octaves until the lowest note is at or above the base note (all at once, rather than an octave at a time)
+	lowest_note = min(int(note) for note in melody_notes) + int(key_offset)
+	octave_shift = max(0, -((lowest_note - int(base_note)) // 12)) * 12
+	return [int(note) + int(key_offset) + octave_shift for note in melody_notes]
+
+# endregion
+
+# region Batch Planning
+
+class HarmonicPlan:
+	"""The harmonic step of a beat, worked out once and shared by every audible scene.
+
+	Voicings only depend on the voice count (and on being a bass), and absolute MIDI notes only
+	depend on (being a bass, base note, voice count), so both are worked out the first time an
+	instrument asks for them and reused by every other instrument, whichever scene it's in.
+	A plan can be reset for the next beat, so one plan (and its dicts) serves every beat.
+	"""
+	# Props
+	current_chord_notes: List[str]
+	new_chord_notes: List[str]
+	key_offset: int
+	previous_key_offset: int # The key offset of the chord being left (only different on a key change)
+	voicings: Dict[Tuple[bool, int], List[int]]
+	group_notes: Dict[Tuple[bool, int, int], Tuple[str, ...]] # Tuples, as every instrument of the group shares them as its playing notes
+	modulated_notes: Dict[tuple, Tuple[str, ...]] # On a key change: (is_bass, base note, voice count, held notes) -> new notes
+
+	# Methods
+	def __init__(self, current_chord_notes: List[str], new_chord_notes: List[str], key_offset: int, previous_key_offset: int = None):
+		self.voicings = {}
+		self.group_notes = {}
+		self.modulated_notes = {}
+		self.reset(current_chord_notes, new_chord_notes, key_offset, previous_key_offset)
+
+	def reset(self, current_chord_notes, new_chord_notes, key_offset, previous_key_offset=None):
+		"""Starts the plan over for another harmonic step, reusing its dicts."""
+		self.current_chord_notes = current_chord_notes
+		self.new_chord_notes = new_chord_notes
+		self.key_offset = int(key_offset)
+		self.previous_key_offset = self.key_offset if previous_key_offset is None else int(previous_key_offset)
+		self.voicings.clear()
+		self.group_notes.clear()
+		self.modulated_notes.clear()
+		return self
+
+	def voicing(self, is_bass, num_voices):
+		"""Gets the new chord's voicing for a voice count, in positions above a root (0)."""
+		voicing_key = (is_bass, num_voices)
+		new_chord = self.voicings.get(voicing_key)
+		if new_chord is None:
+			new_chord = bass_note(self.new_chord_notes) if is_bass else voice_lead(self.current_chord_notes, self.new_chord_notes, num_voices)
+			self.voicings[voicing_key] = new_chord
+		return new_chord
+
+	def instrument_notes(self, is_bass, base_note, num_voices, playing_notes=()):
+		"""Gets the new MIDI notes of a group of instruments, as a tuple of strings like in playing_notes.
+
+		On a key change, an instrument that's playing gets the placement that keeps the most of its notes instead.
+		"""
+		if playing_notes and self.key_offset != self.previous_key_offset:
+			return self.modulated_instrument_notes(is_bass, base_note, num_voices, playing_notes)
+
+		group = (is_bass, base_note, num_voices)
+		new_instrument_notes = self.group_notes.get(group)
+		if new_instrument_notes is None:
+			base_note = int(base_note) + self.key_offset
+			new_instrument_notes = tuple(midi_note_string(base_note + note) for note in self.voicing(is_bass, num_voices)) # For example, 60 + 5 would 65, so F
+			self.group_notes[group] = new_instrument_notes
+		return new_instrument_notes
+
+	def modulated_instrument_notes(self, is_bass, base_note, num_voices, playing_notes):
+		"""Gets the new MIDI notes of an instrument across a key change, keeping as many of its playing notes as it can."""
+		modulation = (is_bass, base_note, num_voices, tuple(playing_notes))
+		new_instrument_notes = self.modulated_notes.get(modulation)
+		if new_instrument_notes is None:
+			# Stay within the octaves the standard voicing uses in either key, so any common tone can be held (the bass sticks to
+			# its one octave), but no lower than the instrument's range
+			root = int(base_note) + self.key_offset
+			previous_root = int(base_note) + self.previous_key_offset
+			standard_notes = [root + note for note in self.voicing(is_bass, num_voices)]
+			held_notes = [int(note) for note in playing_notes]
+			low = max(min(root, previous_root) - (0 if is_bass else 12), int(base_note) - HELD_RANGE_BELOW)
+			new_notes = lead_across_keys(held_notes, standard_notes, low, max(root, previous_root) + 11)
+			new_instrument_notes = tuple(midi_note_string(note) for note in new_notes)
+			self.modulated_notes[modulation] = new_instrument_notes
+		return new_instrument_notes
+
+def plan_scene_notes(instruments, harmonic_plan):
+	"""Plans the MIDI note changes for every sustained instrument of a scene in one batch.
+
+	Args:
+		instruments (Dictionary of Instruments): A Dictionary of Instruments for a given scene.
+		harmonic_plan (HarmonicPlan): The beat's harmonic step.
+
+	Returns:
+		list[tuple]: One (instrument_name, notes_to_off, notes_to_on, new_instrument_notes) entry per
+			bass/chords/effects instrument, where the notes are string MIDI notes like in playing_notes.
+	"""
+	changes = []
+	for instrument_name, instrument_props in instruments.items():
+		if instrument_props.instrument_role not in VOICED_ROLES:
+			continue
+
+		new_instrument_notes = harmonic_plan.instrument_notes(instrument_props.instrument_role == 'bass', instrument_props.base_note, instrument_props.num_voices, instrument_props.playing_notes)
+
+		# Diff against what the instrument is already playing, so held notes aren't re-triggered
+		current_instrument_notes = instrument_props.playing_notes
+		if current_instrument_notes == new_instrument_notes:
+			notes_to_off = notes_to_on = ()
+		else:
+			notes_to_off = [note for note in current_instrument_notes if note not in new_instrument_notes]
+			notes_to_on = [note for note in new_instrument_notes if note not in current_instrument_notes]
+
+		changes.append((instrument_name, notes_to_off, notes_to_on, new_instrument_notes))
+
+	return changes
+
+# endregion
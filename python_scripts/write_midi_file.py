@@ -0,0 +1,123 @@
+import argparse
+import struct
+import sys
+
+from beat_engine import BeatEngine, played_notes
+from simulated_td import DEFAULT_PULSE_SECONDS
+
+# Writes the generated music to a standard MIDI file.
+#
+# Consumes the beat stream from beat_engine for a stretch of show time, and writes a type 1
+# MIDI file with one track per instrument (named after it), percussion on the drum channel.
+# SFX clips have no notes, so each fire is written as a marker on the tempo track instead.
+#
+# Usage: python write_midi_file.py [--seconds 600] [--output show.mid] [--seed 0] [--pulse-seconds 8]
+
+# region Constants
+
+TICKS_PER_QUARTER = 480
+PERCUSSION_CHANNEL = 9 # Channel 10, the General MIDI drum channel
+MELODIC_CHANNELS = [channel for channel in range(16) if channel != PERCUSSION_CHANNEL]
+
+# endregion
+
+# region Encoding
+
+def variable_length(value):
+	"""Encodes a MIDI variable-length quantity."""
+	encoded = [value & 0x7F]
+	value >>= 7
+	while value:
+		encoded.append(0x80 | (value & 0x7F))
+		value >>= 7
+	return bytes(reversed(encoded))
+
+def track_chunk(events):
+	"""Encodes a track.
+
+	Args:
+		events (list[tuple]): (tick, order, bytes) for every event. Order breaks ties, so note offs go before note ons at the same tick.
+
+	Returns:
+		bytes: The MTrk chunk, with its end of track.
+	"""
+	data = bytearray()
+	last_tick = 0
+	for tick, _, event_bytes in sorted(events, key=lambda event: event[:2]):
+		data += variable_length(tick - last_tick) + event_bytes
+		last_tick = tick
+	data += variable_length(0) + b'\xff\x2f\x00'
+	return b'MTrk' + struct.pack('>I', len(data)) + bytes(data)
+
+def meta_event(meta_type, data):
+	return bytes((0xFF, meta_type)) + variable_length(len(data)) + data
+
+# endregion
+
+def write_midi_file(output_path, beats, seconds_per_beat, end_seconds):
+	"""Writes a beat stream to a MIDI file.
+
+	Args:
+		output_path (str): Where to write the file.
+		beats (iterable of Beats): The stream, from BeatEngine.beats().
+		seconds_per_beat (float): The tempo.
+		end_seconds (float): Where the file ends (anything still held stops here).
+
+	Returns:
+		int: How many notes were written.
+	"""
+	def to_tick(seconds):
+		return round(seconds / seconds_per_beat * TICKS_PER_QUARTER)
+
+	tempo_track = [
+		(0, 0, meta_event(0x51, round(seconds_per_beat * 1_000_000).to_bytes(3, 'big'))),
+		(0, 0, meta_event(0x58, bytes((4, 2, 24, 8)))),
+	]
+	instrument_tracks = {} # instrument_name -> (channel, events)
+	num_melodic_tracks = 0
+	num_notes = 0
+
+	# SFX only need their start, so any length does
+	for note in played_notes(beats, seconds_per_beat, end_seconds, seconds_per_beat):
+		if note.kind == 'sfx':
+			tempo_track.append((to_tick(note.start), 1, meta_event(0x06, note.instrument_name.encode())))
+			continue
+
+		if note.instrument_name not in instrument_tracks:
+			if note.kind == 'percussion':
+				channel = PERCUSSION_CHANNEL
+			else:
+				# Melodic instruments take the other channels in turn
+				channel = MELODIC_CHANNELS[num_melodic_tracks % len(MELODIC_CHANNELS)]
+				num_melodic_tracks += 1
+			instrument_tracks[note.instrument_name] = (channel, [(0, 0, meta_event(0x03, note.instrument_name.encode()))])
+
+		channel, events = instrument_tracks[note.instrument_name]
+		events.append((to_tick(note.start), 1, bytes((0x90 | channel, note.pitch, note.velocity))))
+		events.append((max(to_tick(note.end), to_tick(note.start) + 1), 0, bytes((0x80 | channel, note.pitch, 0))))
+		num_notes += 1
+
+	tracks = [tempo_track] + [events for _, events in instrument_tracks.values()]
+	with open(output_path, 'wb') as midi_file:
+		midi_file.write(b'MThd' + struct.pack('>IHHH', 6, 1, len(tracks), TICKS_PER_QUARTER))
+		for events in tracks:
+			midi_file.write(track_chunk(events))
+
+	return num_notes
+
+def main():
+	parser = argparse.ArgumentParser(description='Write the generated music to a standard MIDI file.')
+	parser.add_argument('--seconds', type=float, default=600, help='show time to write')
+	parser.add_argument('--output', default='show.mid')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--pulse-seconds', type=float, default=DEFAULT_PULSE_SECONDS, help='show time between Beat CHOP pulses')
+	args = parser.parse_args()
+
+	engine = BeatEngine(seed=args.seed, pulse_seconds=args.pulse_seconds)
+	num_notes = write_midi_file(args.output, engine.beats(), engine.seconds_per_beat, args.seconds)
+	print(f'wrote {num_notes} notes from {args.seconds:.0f} s of show time to {args.output}')
+	if num_notes == 0:
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()